@@ -1,12 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 from datetime import datetime
-import statsmodels.api as sm
-import matplotlib.cm as cm
-import matplotlib.colors as colors
 import csv
+from trajectory_store import TrajectoryStore
+
+# matplotlib and statsmodels are imported in the functions that use them, so that workers which only
+# compute q-k-v points (calibration.py) do not load them (see import_budget.py)
+
+
+def _chunks(agent_pos):
+    # data frame, memory-mapped store or iterator of data frame chunks (e.g. loader.iter_agent_pos) -> iterator of data frames
+    if isinstance(agent_pos, pd.DataFrame):
+        return iter([agent_pos])
+    if isinstance(agent_pos, TrajectoryStore):
+        return agent_pos.iter_chunks()
+    return iter(agent_pos)
 
 
 def plot_space_time(agent_pos, 
@@ -14,16 +24,30 @@ def plot_space_time(agent_pos,
                     space_time_filename = 'space_time'
                     ):
     
+    import matplotlib.pyplot as plt
     pd.set_option('display.max_columns', None)
-    unique_cyclists = agent_pos.AgentID.unique()
-    print(unique_cyclists)
-    
-    agent_pos['Time'] = agent_pos['Step'] * dt
-    print(agent_pos)
     fig, ax = plt.subplots(figsize=(6,4), layout='constrained')
-    for i in unique_cyclists:
-        cyclist_traj = agent_pos[agent_pos.AgentID == i]
-        ax.plot(cyclist_traj['Time'], cyclist_traj['Position_x'], color='black', linewidth=0.5)
+    if isinstance(agent_pos, pd.DataFrame):
+        unique_cyclists = agent_pos.AgentID.unique()
+        print(unique_cyclists)
+        
+        agent_pos['Time'] = agent_pos['Step'] * dt
+        print(agent_pos)
+        for i in unique_cyclists:
+            cyclist_traj = agent_pos[agent_pos.AgentID == i]
+            ax.plot(cyclist_traj['Time'], cyclist_traj['Position_x'], color='black', linewidth=0.5)
+    else:
+        # store or chunk iterator: plot the trajectories chunk by chunk; the last rows of each
+        # cyclist are carried over to the next chunk so that the lines stay connected
+        carry = None
+        for chunk in _chunks(agent_pos):
+            chunk = chunk[['Step', 'AgentID', 'Position_x']]
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            for i, cyclist_traj in chunk.groupby('AgentID', sort=False):
+                ax.plot(cyclist_traj['Step'] * dt, cyclist_traj['Position_x'], color='black', linewidth=0.5)
+            last_steps = chunk['Step'].drop_duplicates().nlargest(2)  # a step may be split between two chunks
+            carry = chunk[chunk['Step'] >= last_steps.min()].groupby('AgentID', sort=False).tail(1)
     ax.set_title(space_time_filename)
     ax.set_xlabel('Time (s)')
     ax.set_ylabel('Distance (m)')
@@ -37,59 +61,89 @@ def plot_space_time(agent_pos,
         fig.savefig("figures/" + space_time_filename + "_ST_" + datetime.now().strftime("_%Y-%m-%d_%H%M") + ".png", format='png', dpi=400)
 
 
-def plot_fd(agent_pos,  # model data frame
-            dt = 0.5,  # time step size (s)
-            duration = 3600,  # simulation duration (s)
-            agg_time = 30,  # aggregation interval for fundamental diagram (s)
-            agg_dist = [200, 250],  # aggregation distance / space for fundamental diagram (min and max value in m)
-            path_width = 2,
-            fd_filename = "fundamental_diagram"):
+def compute_qkv(agent_pos,  # data frame, TrajectoryStore or iterator of data frame chunks (see loader.py)
+                dt = 0.5,  # time step size (s)
+                duration = 3600,  # simulation duration (s)
+                agg_time = 30,  # aggregation interval for fundamental diagram (s)
+                agg_dist = [200, 250],  # aggregation distance / space for fundamental diagram (min and max value in m)
+                record_interval = None):  # time between two recorded steps (s); None reads it from agent_pos.attrs (see recording.py) or uses dt
     
+    # flow, density and speed per aggregation interval (Edie's definitions) inside agg_dist; the chunks
+    # are reduced to the travelled time and distance per cyclist and interval, only these are kept in memory
+    if record_interval is None:
+        record_interval = agent_pos.attrs.get('record_interval', dt) if isinstance(agent_pos, pd.DataFrame) else dt
     agg_steps = int(agg_time/dt)
-    agent_pos['Time'] = agent_pos['Step'] * dt
-    print(agent_pos)
     agg_temp = 0
     agg_intervals = []
     while agg_temp <= (duration/dt):
         agg_intervals.append(agg_temp)
         agg_temp += agg_steps
-        
-    # for i in agg_intervals
-    print(agg_intervals)
-    q_k_v = pd.DataFrame(columns=['Time_(s)', 'Flow', 'Density', 'Speed'])
-    print(q_k_v)
     
-    for i in range(1,len(agg_intervals)):
-        # print('\n\n', i)
-        agent_pos_temp = agent_pos[(agent_pos['Step'] <= agg_intervals[i]) & (agent_pos['Step'] > agg_intervals[i-1])]
-        agent_pos_temp = agent_pos_temp[(agent_pos_temp['Position_x'] <= agg_dist[1]) & (agent_pos_temp['Position_x'] > agg_dist[0])]
-        # print(agent_pos_temp)
-        unique_cyclists_temp = agent_pos_temp['AgentID'].unique()
-        # print(unique_cyclists_temp)
-        vkt_sum = 0
-        vht_sum = 0
-        T = agg_time
-        L = agg_dist[1]-agg_dist[0]  # length to derive the FD from
-        for j in unique_cyclists_temp:
-            agent = agent_pos_temp[agent_pos_temp['AgentID']==j]
-            # print(agent)
-            d_time = len(agent)*dt
-            d_distance = agent['Position_x'].max() - agent['Position_x'].min()
-            # print('dt: ', d_time, '; dx: ', d_distance)
-            vkt_sum += d_distance
-            vht_sum += d_time
-        # print(vkt_sum, vht_sum)
-        Q = vkt_sum / (T*L)
-        K = vht_sum / (T*L)
-        if vht_sum != 0:
-            V = vkt_sum/vht_sum
-        else: V = 0
-        new_row = pd.DataFrame({'Time_(s)': [i*agg_time], 'Flow': [Q], 'Density': [K], 'Speed': [V]})
-        q_k_v = pd.concat([q_k_v, new_row], ignore_index=True)
+    partials = []
+    for chunk in _chunks(agent_pos):
+        chunk = chunk[(chunk['Step'] > 0) & (chunk['Step'] <= agg_intervals[-1])]
+        chunk = chunk[(chunk['Position_x'] <= agg_dist[1]) & (chunk['Position_x'] > agg_dist[0])]
+        interval = ((chunk['Step'] + agg_steps - 1) // agg_steps).rename('Interval')  # steps in (agg_intervals[i-1], agg_intervals[i]] belong to interval i
+        partials.append(chunk.groupby([interval, chunk['AgentID']])['Position_x'].agg(['size', 'min', 'max']))
+    
+    intervals = pd.RangeIndex(1, len(agg_intervals), name='Interval')
+    if len(partials) > 0:
+        per_agent = pd.concat(partials).groupby(level=[0,1]).agg({'size': 'sum', 'min': 'min', 'max': 'max'})
+        # sub-sampled data: the first and last recorded position of a cyclist lie further inside the interval than at
+        # the resolution dt; scale the travelled distance to the span that the same number of steps of length dt covers
+        k = record_interval / dt
+        span = (per_agent['max'] - per_agent['min']) * ((per_agent['size']*k - 1) / ((per_agent['size'] - 1).clip(lower=1) * k))
+        vkt_sum = span.groupby(level=0).sum().reindex(intervals, fill_value=0)
+        vht_sum = (per_agent['size'] * record_interval).groupby(level=0).sum().reindex(intervals, fill_value=0)
+    else:
+        vkt_sum = pd.Series(0.0, index=intervals)
+        vht_sum = pd.Series(0.0, index=intervals)
+    T = agg_time
+    L = agg_dist[1]-agg_dist[0]  # length to derive the FD from
+    q_k_v = pd.DataFrame({'Time_(s)': intervals * agg_time,
+                          'Flow': (vkt_sum / (T*L)).to_numpy(dtype=float),
+                          'Density': (vht_sum / (T*L)).to_numpy(dtype=float),
+                          'Speed': (vkt_sum / vht_sum.where(vht_sum != 0)).fillna(0).to_numpy(dtype=float)})
+    return q_k_v
+
+
+def plot_fd(agent_pos,  # model data frame, TrajectoryStore or iterator of data frame chunks (see loader.py)
+            dt = 0.5,  # time step size (s)
+            duration = 3600,  # simulation duration (s)
+            agg_time = 30,  # aggregation interval for fundamental diagram (s)
+            agg_dist = [200, 250],  # aggregation distance / space for fundamental diagram (min and max value in m)
+            path_width = 2,
+            fd_filename = "fundamental_diagram",
+            record_interval = None):  # time between two recorded steps (s); None reads it from agent_pos.attrs or uses dt
+    
+    if isinstance(agent_pos, pd.DataFrame):
+        agent_pos['Time'] = agent_pos['Step'] * dt
+        print(agent_pos)
+    q_k_v = fit_fd(agent_pos, dt=dt, duration=duration, agg_time=agg_time, agg_dist=agg_dist, path_width=path_width, record_interval=record_interval)
+    draw_fd(q_k_v, fd_filename=fd_filename)
+    return q_k_v
+
+
+def fit_fd(agent_pos,  # model data frame, TrajectoryStore or iterator of data frame chunks (see loader.py)
+           dt = 0.5,  # time step size (s)
+           duration = 3600,  # simulation duration (s)
+           agg_time = 30,  # aggregation interval for fundamental diagram (s)
+           agg_dist = [200, 250],  # aggregation distance / space for fundamental diagram (min and max value in m)
+           path_width = 2,
+           record_interval = None):  # time between two recorded steps (s); None reads it from agent_pos.attrs or uses dt
+    
+    # q-k-v points per path width with the lowess curves of plot_fd, without plotting
+    q_k_v = compute_qkv(agent_pos, dt=dt, duration=duration, agg_time=agg_time, agg_dist=agg_dist, record_interval=record_interval)
     print(q_k_v)
     q_k_v['Flow_(/h/m)'] = (q_k_v['Flow']*3600)/path_width
     q_k_v['Density_(/m2)'] = q_k_v['Density']/path_width
+    return smooth_fd(q_k_v)
+
+
+def smooth_fd(q_k_v):  # q-k-v points with the columns 'Density_(/m2)', 'Flow_(/h/m)' and 'Speed'
     
+    # sorted by density, with the lowess curves of flow and speed (Flow_Lowess, Speed_Lowess) that draw_fd plots
+    from statsmodels.nonparametric.smoothers_lowess import lowess  # same as statsmodels.api.nonparametric.lowess
     
     '''
     ********************
@@ -101,15 +155,21 @@ def plot_fd(agent_pos,  # model data frame
     # print(q_k_v)
     
     # lowess smoothing flow
-    lowess = sm.nonparametric.lowess
     lowess_temp = lowess(q_k_v['Flow_(/h/m)'], q_k_v['Density_(/m2)'], frac=1./2, it=1)
     q_k_v['Flow_Lowess'] = lowess_temp[:,1]
     
     # lowess smoothing speed
-    lowess = sm.nonparametric.lowess
     lowess_temp = lowess(q_k_v['Speed'], q_k_v['Density_(/m2)'], frac=1./2, it=1)
     q_k_v['Speed_Lowess'] = lowess_temp[:,1]
+    return q_k_v
+
+
+def draw_fd(q_k_v,  # q-k-v points as returned by fit_fd
+            fd_filename = "fundamental_diagram"):
     
+    import matplotlib.pyplot as plt
+    import matplotlib.cm as cm
+    import matplotlib.colors as colors
     
     '''
     ***************
@@ -152,9 +212,9 @@ def plot_fd(agent_pos,  # model data frame
         #writer.writerow(q_k_v['Flow_Lowess'])
         #writer.writerow(q_k_v['Speed_Lowess'])
     
-    return q_k_v
-    
 def plot_fd_comp(states,names,fd_filename = "comparison"): 
+    
+    import matplotlib.pyplot as plt
         
     # read states    
     q_k_v = [None for i in range(len(states))]
@@ -191,7 +251,107 @@ def plot_fd_comp(states,names,fd_filename = "comparison"):
     if type(fd_filename) is str:
         fig.savefig("figures/" + fd_filename + datetime.now().strftime("_%Y-%m-%d_%H%M") + ".png", format='png', dpi=400)
 
+
+def compute_xt_fields(agent_pos,  # data frame, TrajectoryStore or iterator of data frame chunks (see loader.py)
+                      dt = 0.5,  # time step size (s)
+                      duration = 3600,  # simulation duration (s)
+                      agg_time = 30,  # length of the time cells (s)
+                      cell_length = 10,  # length of the space cells (m)
+                      path_length = 300,  # length of the cycle path (m)
+                      lateral_bins = None,  # edges of the lateral bins (m) of the occupancy cube, e.g. np.arange(0, 2.75, 0.25); None leaves it out
+                      record_interval = None):  # time between two recorded steps (s); None reads it from agent_pos.attrs or uses dt
+    
+    # time x space fields of density, flow and speed (Edie's definitions per cell, as compute_qkv for one zone) in one
+    # pass over the trajectories; every row stands for record_interval seconds and the distance travelled since the
+    # previous row of the cyclist (the first row of a cyclist uses the distance to its next row). The rows are summed
+    # into the cells with np.bincount, chunk by chunk; the last row of each cyclist is carried over to the next chunk, and a
+    # row that is the only one of its cyclist in a chunk is counted once the next chunk gives its next row.
+    # Returns a dict of numpy arrays:
+    #     time, x             cell edges (s, m)
+    #     density            time spent per cell / (agg_time*cell_length) (bic/m), shape (time cells, space cells)
+    #     flow               distance travelled per cell / (agg_time*cell_length) (bic/s)
+    #     speed              flow / density (m/s; NaN in empty cells)
+    #     y, lateral         with lateral_bins: the bin edges and the share of the time spent per cell in each lateral
+    #                        bin, shape (time cells, space cells, lateral bins)
+    if record_interval is None:
+        record_interval = agent_pos.attrs.get('record_interval', dt) if isinstance(agent_pos, pd.DataFrame) else dt
+    agg_steps = int(agg_time/dt)
+    n_t = int(duration/dt) // agg_steps  # complete time cells, as the intervals of compute_qkv
+    n_x = int(np.ceil(path_length/cell_length))
+    y_edges = None if lateral_bins is None else np.asarray(lateral_bins, dtype=float)
+    n_y = 0 if y_edges is None else len(y_edges) - 1
+    time_spent = np.zeros(n_t*n_x)
+    distance = np.zeros(n_t*n_x)
+    occupancy = np.zeros(n_t*n_x*n_y)
     
+    def add(step, x, dx, y):
+        valid = (step > 0) & (step <= n_t*agg_steps) & (x >= 0) & (x < n_x*cell_length)
+        cell = ((step[valid] - 1) // agg_steps) * n_x + (x[valid] // cell_length).astype(np.int64)
+        time_spent[:] += np.bincount(cell, minlength=n_t*n_x) * record_interval
+        distance[:] += np.bincount(cell, weights=dx[valid], minlength=n_t*n_x)
+        if y_edges is not None:
+            lat = np.searchsorted(y_edges, y[valid], side='right') - 1
+            inside = (lat >= 0) & (lat < n_y)
+            occupancy[:] += np.bincount(cell[inside]*n_y + lat[inside], minlength=n_t*n_x*n_y) * record_interval
+    
+    columns = ['Step', 'AgentID', 'Position_x'] + ([] if y_edges is None else ['Position_y'])
+    carry = None  # last row of each cyclist so far; Counted is False for a row that was alone in its chunk
+    for chunk in _chunks(agent_pos):
+        chunk = chunk[columns].assign(Counted=False)
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        chunk = chunk.sort_values(['AgentID', 'Step'], kind='stable')
+        agent = chunk['AgentID'].to_numpy()
+        x = chunk['Position_x'].to_numpy(dtype=float)
+        same = agent[1:] == agent[:-1]  # row i+1 continues the cyclist of row i
+        forward = np.where(same, x[1:] - x[:-1], 0)
+        dx = np.concatenate([[np.nan], np.where(same, forward, np.nan)])
+        dx = np.where(np.isnan(dx), np.append(forward, 0), dx)
+        
+        # a row without previous and next row of its cyclist waits for the next chunk to get its distance;
+        # carried rows that were counted in a previous chunk are skipped
+        alone = np.insert(~same, 0, True) & np.append(~same, True)
+        counted = chunk['Counted'].to_numpy()
+        new = ~counted & ~alone
+        add(chunk['Step'].to_numpy()[new], x[new], dx[new],
+            None if y_edges is None else chunk['Position_y'].to_numpy(dtype=float)[new])
+        
+        last = np.append(~same, True)
+        carry = chunk[last].assign(Counted=(counted | ~alone)[last])
     
+    # cyclists with a single row in total travel no distance there
+    if carry is not None:
+        rest = carry[~carry['Counted'].to_numpy()]
+        add(rest['Step'].to_numpy(), rest['Position_x'].to_numpy(dtype=float), np.zeros(len(rest)),
+            None if y_edges is None else rest['Position_y'].to_numpy(dtype=float))
     
+    area = agg_time * cell_length
+    fields = {'time': np.arange(n_t + 1) * agg_time,
+              'x': np.minimum(np.arange(n_x + 1) * cell_length, path_length),
+              'density': (time_spent / area).reshape(n_t, n_x),
+              'flow': (distance / area).reshape(n_t, n_x)}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fields['speed'] = np.where(time_spent > 0, distance / time_spent, np.nan).reshape(n_t, n_x)
+        if y_edges is not None:
+            fields['y'] = y_edges
+            fields['lateral'] = (occupancy.reshape(n_t, n_x, n_y) / time_spent.reshape(n_t, n_x, 1))
+    return fields
 
+
+def plot_xt_fields(fields,  # as returned by compute_xt_fields
+                   field = 'density',  # 'density', 'flow' or 'speed'
+                   xt_filename = 'xt_fields'):
+    
+    import matplotlib.pyplot as plt
+    labels = {'density': 'Bicycle density (bic/m)', 'flow': 'Bicycle flow (bic/s)', 'speed': 'Bicycle speed (m/s)'}
+    fig, ax = plt.subplots(figsize=(8,4), layout='constrained')
+    image = ax.imshow(fields[field].T, origin='lower', aspect='auto', interpolation='nearest', cmap='plasma',
+                      extent=[fields['time'][0], fields['time'][-1], fields['x'][0], fields['x'][-1]])
+    plt.colorbar(image, ax=ax, label=labels[field])
+    ax.set_title(xt_filename)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Distance (m)')
+    plt.show()
+    
+    if type(xt_filename) is str:
+        fig.savefig("figures/" + xt_filename + "_XT_" + field + datetime.now().strftime("_%Y-%m-%d_%H%M") + ".png", format='png', dpi=400)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+*****************************
+*** PARAMETER CALIBRATION ***
+*****************************
+'''
+#%%
+import io
+import inspect
+import contextlib
+import multiprocessing
+import numpy as np
+from model import micromodel
+from analysis import compute_qkv
+#%%
+
+# calibrated parameters and their search bounds
+DEFAULT_BOUNDS = {'alpha': (0.4, 1.2),  # coefficient of the length of the safety region
+                  'beta': (0.02, 0.12),  # coefficient of the width of the safety region
+                  'gamma': (0.7, 1.0),  # passing threshold
+                  'phi': (2, 6),  # coefficient of the length of the consideration range
+                  'v0_sd': (0.5, 1.5)}  # standard deviation of desired longitudinal speed (m/s)
+
+
+def simulate_fd(params,  # micromodel parameters
+                agg_time = 30,  # aggregation interval for fundamental diagram (s)
+                agg_dist = [200, 250]):  # aggregation space for fundamental diagram (min and max value in m)
+    # run micromodel without console output and files, q-k-v points as in plot_fd (without fitting and plotting)
+    defaults = inspect.signature(micromodel).parameters
+    get = lambda name: params.get(name, defaults[name].default)
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent_pos = micromodel(**dict(params, data_filename=0))
+    q_k_v = compute_qkv(agent_pos, dt=get('dt'), duration=get('duration'), agg_time=agg_time, agg_dist=agg_dist)
+    q_k_v['Flow_(/h/m)'] = (q_k_v['Flow']*3600)/get('path_width')
+    q_k_v['Density_(/m2)'] = q_k_v['Density']/get('path_width')
+    return q_k_v
+
+
+def fd_error(q_k_v,  # simulated q-k-v points (see simulate_fd)
+             target,  # observed q-k-v points with the columns 'Density_(/m2)', 'Flow_(/h/m)' and 'Speed'
+             density_bins = np.arange(0, 0.32, 0.02),  # density classes in which flow and speed are compared (bic/m2)
+             common_only = False):  # compare only the density classes reached by the simulation
+    # relative RMSE of mean flow and mean speed per density class; classes of the target that the simulation
+    # does not reach count as a relative error of 1
+    def binned(df):
+        classes = np.digitize(df['Density_(/m2)'], density_bins)
+        return df.groupby(classes)[['Flow_(/h/m)', 'Speed']].mean()
+    sim, obs = binned(q_k_v), binned(target)
+    if common_only:
+        obs = obs[obs.index.isin(sim.index)]
+        if len(obs) == 0:
+            return np.inf
+    sim = sim.reindex(obs.index)
+    error = 0
+    for c in ['Flow_(/h/m)', 'Speed']:
+        rel = ((sim[c] - obs[c]) / obs[c].abs().mean()).fillna(1)
+        error += np.sqrt((rel**2).mean())
+    return float(error)
+
+
+def prefix_params(params,  # micromodel parameters
+                  fraction):  # share of the demand profile to simulate
+    # parameters of a shorter run that only covers the first demand intervals
+    defaults = inspect.signature(micromodel).parameters
+    demand = list(params.get('demand', defaults['demand'].default))
+    duration = params.get('duration', defaults['duration'].default)
+    m = max(1, int(round(len(demand) * fraction)))
+    return dict(params, demand=demand[:m], duration=duration*m/len(demand))
+
+
+def _evaluate(task):
+    # worker function: error of one candidate (full run or screening run on a prefix of the demand profile)
+    params, target, fraction, agg_time, agg_dist = task
+    if fraction < 1:
+        params = prefix_params(params, fraction)
+    return fd_error(simulate_fd(params, agg_time, agg_dist), target, common_only=(fraction < 1))
+
+
+class Calibration:
+    '''
+    Fit micromodel parameters to an observed fundamental diagram with differential evolution.
+
+    Every generation is evaluated in a process pool. Candidates are rounded to `decimals` and
+    memoized, so repeated candidates are not simulated again. Each new candidate is first
+    screened on the first `screen_fraction` of the demand profile; only candidates whose
+    screening error is within `abort_factor` times the best screening error are simulated in full;
+    the others get an error of inf.
+    '''
+
+    def __init__(self, target,  # observed q-k-v points with the columns 'Density_(/m2)', 'Flow_(/h/m)' and 'Speed'
+                 bounds = DEFAULT_BOUNDS,  # dict of calibrated parameters and their (min, max) values
+                 base_params = {},  # fixed micromodel parameters (e.g. duration, demand, path_width)
+                 processes = None,  # size of the process pool; None uses all cores
+                 screen_fraction = 0.5,  # share of the demand profile in the screening run; 1 disables the screening
+                 abort_factor = 1.5,  # candidates with a screening error above abort_factor * best screening error are not run in full
+                 agg_time = 30,  # aggregation interval for fundamental diagram (s)
+                 agg_dist = [200, 250],  # aggregation space for fundamental diagram (min and max value in m)
+                 decimals = 3):  # rounding of the candidate parameters
+        self.target = target
+        self.names = list(bounds)
+        self.bounds = [bounds[n] for n in self.names]
+        self.base_params = dict(base_params)
+        self.processes = processes
+        self.screen_fraction = screen_fraction
+        self.abort_factor = abort_factor
+        self.agg_time = agg_time
+        self.agg_dist = agg_dist
+        self.decimals = decimals
+        self.cache = {}  # rounded candidate -> error
+        self.history = []  # one dict per simulated candidate: parameters, error, screened_out (and screen_error)
+        self.best_screen = np.inf
+        self.pool = None
+
+    def params(self, x):
+        return dict(self.base_params, **{n: float(v) for n, v in zip(self.names, np.round(x, self.decimals))})
+
+    def _map(self, tasks):
+        if self.pool is None:
+            return list(map(_evaluate, tasks))
+        return self.pool.map(_evaluate, tasks)
+
+    def evaluate(self, candidates):  # list of parameter vectors (in the order of self.names)
+        keys = [tuple(np.round(x, self.decimals)) for x in candidates]
+        new = list(dict.fromkeys(k for k in keys if k not in self.cache))
+        full = new
+        if self.screen_fraction < 1 and len(new) > 0:
+            screen = self._map([(self.params(k), self.target, self.screen_fraction, self.agg_time, self.agg_dist) for k in new])
+            self.best_screen = min([self.best_screen] + screen)
+            full = []
+            for k, e in zip(new, screen):
+                if e <= self.abort_factor * self.best_screen:
+                    full.append(k)
+                else:  # clearly worse than the best candidate so far: terminated after the screening run
+                    # (the screening error is on another scale than the full errors, so it ranks below every full run)
+                    self.cache[k] = np.inf
+                    self.history.append(dict(self.params(k), error=np.inf, screen_error=e, screened_out=True))
+        errors = self._map([(self.params(k), self.target, 1, self.agg_time, self.agg_dist) for k in full])
+        for k, e in zip(full, errors):
+            self.cache[k] = e
+            self.history.append(dict(self.params(k), error=e, screened_out=False))
+        return [self.cache[k] for k in keys]
+
+    def _objective(self, x):
+        return self.evaluate([x])[0]
+
+    def run(self, maxiter = 20,  # number of generations
+            popsize = 5,  # population size per calibrated parameter
+            seed = 0):  # seed of the optimizer
+        # returns the best parameters and their error
+        from scipy.optimize import differential_evolution  # only needed in the main process, not in the workers
+        with multiprocessing.Pool(self.processes) as pool:
+            self.pool = pool
+            try:
+                result = differential_evolution(self._objective, self.bounds, maxiter=maxiter, popsize=popsize, seed=seed,
+                                                updating='deferred', polish=False,
+                                                workers=lambda func, xs: self.evaluate(list(xs)))
+            finally:
+                self.pool = None
+        return self.params(result.x), result.fun
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+************************************************
+*** CONVERGENCE MONITORS / EARLY TERMINATION ***
+************************************************
+'''
+#%%
+import numpy as np
+#%%
+
+'''
+A monitor is passed to micromodel in the list stop_criteria. After every step micromodel calls
+monitor.update(model, dt) with the BikeLane model; the run stops as soon as a monitor returns
+the reason for stopping (a string) instead of None. Observers that never end the run (safety.py,
+live_metrics.py) go into the list monitors instead; their update is called before the stop criteria
+and its return value is ignored, the reset() and close() methods below apply to them as well. A monitor with a reset() method is reset before
+the first step, so that one instance can be passed to several runs (ensemble, calibration, paired).
+A monitor with a close() method (e.g. the server of live_metrics.LiveMetrics) is closed when the run
+ends, also if it raises or a stream is left early.
+'''
+
+
+class CorridorDrained:
+    ''' Stop when the whole demand has entered the path and the last cyclist has left it. '''
+
+    def cache_key(self):
+        # configuration hashed into the stage keys of pipeline.py
+        return {}
+
+    def update(self, model, dt):
+        if model.demand_done and len(model.schedule.agents) == 0:
+            return "corridor drained at {} s".format(model.time_step * dt)
+        return None
+
+
+class Stationary:
+    '''
+    Stop when density, mean speed and outflow have been stationary for `duration` seconds.
+
+    The measures (density and speed inside x_range, outflow at the end of the path) are
+    collected in blocks of `window` seconds. Their means over the last `duration` seconds are
+    compared with the means over the `duration` seconds before; the run is stationary when
+    they differ by less than `tolerance` (relative). Averaging over the whole duration keeps
+    the stochastic inflow from masking a stationary regime. An empty path is never considered
+    stationary, see CorridorDrained for that case.
+    '''
+
+    def __init__(self, duration = 300,  # time the measures have to be stationary (s)
+                 window = 60,  # block length (s)
+                 tolerance = 0.1,  # maximum relative difference between the means of the last two periods
+                 x_range = [200, 250]):  # space in which density and speed are measured (m)
+        self.duration = duration
+        self.window = window
+        self.tolerance = tolerance
+        self.x_range = x_range
+        self.reset()
+
+    def reset(self):
+        # state of a run
+        self.blocks = []  # [density (bic/m), speed (m/s), outflow (bic/s)] per finished window
+        self._sums = np.zeros(3)
+        self._steps = 0
+        self._finished = 0
+
+    def cache_key(self):
+        # configuration hashed into the stage keys of pipeline.py
+        return {'duration': self.duration, 'window': self.window, 'tolerance': self.tolerance, 'x_range': list(self.x_range)}
+
+    def update(self, model, dt):
+        x = np.array([a.pos[0] for a in model.schedule.agents]).reshape(-1)
+        v = np.array([a.speed for a in model.schedule.agents]).reshape(-1)
+        inside = (x > self.x_range[0]) & (x <= self.x_range[1])
+        self._sums[0] += inside.sum() / (self.x_range[1] - self.x_range[0])
+        self._sums[1] += v[inside].mean() if inside.any() else 0
+        self._sums[2] += (model.n_finished - self._finished) / dt
+        self._finished = model.n_finished
+        self._steps += 1
+        if self._steps * dt < self.window:
+            return None
+        self.blocks.append(self._sums / self._steps)
+        self._sums = np.zeros(3)
+        self._steps = 0
+        n = int(np.ceil(self.duration / self.window))
+        if len(self.blocks) < 2*n:
+            return None
+        mean = np.mean(self.blocks[-n:], axis=0)
+        previous = np.mean(self.blocks[-2*n:-n], axis=0)
+        if mean[0] == 0 or previous[0] == 0:
+            return None
+        if np.all(np.abs(mean - previous) <= self.tolerance * np.abs(previous)):
+            return "stationary for {} s at {} s (density {:.3f} bic/m, speed {:.2f} m/s, outflow {:.0f} bic/h)".format(
+                self.duration, model.time_step * dt, mean[0], mean[1], mean[2] * 3600)
+        return None
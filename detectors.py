@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+******************************
+*** VIRTUAL LOOP DETECTORS ***
+******************************
+'''
+#%%
+import numpy as np
+import pandas as pd
+#%%
+
+'''
+Detectors are passed to micromodel in the list detectors. Every cyclist whose position (Bicycle.pos,
+the centre of the bicycle, as in the recorded trajectories) passes a detector between two steps (old x < detector x <= new x) is recorded in Bicycle.advance; time,
+speed and lateral position of the passage are interpolated linearly within the step. Detector data
+does not need the trajectories, so it can be combined with recording = 'none' (see recording.py).
+The records of a previous run are cleared when a detector is passed to micromodel again.
+'''
+
+
+class LoopDetector:
+
+    def __init__(self, x,  # position of the detector along the path (m)
+                 agg_time = 60):  # aggregation interval (s)
+        self.x = x
+        self.agg_time = agg_time
+        self.records = []  # (time (s), ID, speed (m/s), lateral position (m)) per passage
+
+    def reset(self):
+        self.records = []
+
+    def cache_key(self):
+        # configuration hashed into the stage keys of pipeline.py
+        return {'x': self.x, 'agg_time': self.agg_time}
+
+    def record(self, time, unique_id, speed, y):
+        self.records.append((time, unique_id, speed, y))
+
+    def passages(self):
+        # one row per passage in the order of passing, with the time headway to the previous passage (s)
+        passages = pd.DataFrame.from_records(self.records, columns=['Time', 'AgentID', 'Speed', 'Position_y'])
+        passages = passages.sort_values('Time', kind='stable', ignore_index=True)
+        passages['Headway'] = passages['Time'].diff()
+        return passages
+
+    def aggregate(self, duration = None):  # simulation duration (s); None ends with the interval of the last passage
+        # count, flow and time-mean / space-mean speed per aggregation interval; intervals without
+        # passages have a count of 0 and no speeds. The space-mean speed is the harmonic mean of the
+        # spot speeds (passages at standstill are left out of it), the density is flow / space-mean speed.
+        passages = self.passages()
+        if duration is None:
+            duration = (np.floor(passages['Time'].max() / self.agg_time) + 1) * self.agg_time if len(passages) > 0 else 0
+        n = int(np.ceil(duration / self.agg_time))
+        interval = (passages['Time'] // self.agg_time).astype(int)
+        moving = passages['Speed'] > 0
+        groups = passages.assign(Interval=interval, invSpeed=(1 / passages['Speed'].where(moving))).groupby('Interval')
+        agg = pd.DataFrame({'Count': groups.size(),
+                            'TimeMeanSpeed': groups['Speed'].mean(),
+                            'SpaceMeanSpeed': 1 / groups['invSpeed'].mean()}).reindex(range(n))
+        agg['Count'] = agg['Count'].fillna(0).astype(int)
+        agg.insert(0, 'Time', agg.index * self.agg_time)  # start of the interval (s)
+        agg.insert(2, 'Flow', agg['Count'] * 3600 / self.agg_time)  # bic/h
+        agg['Density'] = agg['Flow'] / 3600 / agg['SpaceMeanSpeed']  # bic/m
+        return agg.reset_index(drop=True)
+
+
+def detector_array(positions,  # detector positions (m)
+                   agg_time = 60):  # aggregation interval (s)
+    return [LoopDetector(x, agg_time) for x in positions]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+*****************************
+*** ENSEMBLE REPLICATIONS ***
+*****************************
+'''
+#%%
+import io
+import itertools
+import contextlib
+import multiprocessing
+import pandas as pd
+from model import micromodel
+from shared_results import share_dataframe, SharedResult, discard
+#%%
+
+'''
+Replications are independent runs of micromodel: one after another in this process, or distributed
+over a process pool in which every worker runs whole replications. The perception of the decision
+levels of every run is vectorized (see perception.py, about 1.5x faster than the per-agent queries);
+more throughput comes from the process pool. Advancing several replications together step by step
+with one perception pass for all of them gave identical results but was slower than running them
+one after another (16 replications of 300 s at 100 bic/h on one core: 0.70 s against 0.51 s each),
+so replications are not batched.
+'''
+
+
+def replications(seeds = [4],  # random seeds
+                 param_sets = [{}]):  # parameter values that vary between the replications, e.g. [{'alpha': 0.2}, {'alpha': 0.3}]
+    # every combination of seed and parameter set, as keyword arguments for micromodel
+    return [dict(params, seed=seed) for params, seed in itertools.product(param_sets, seeds)]
+
+
+def run_ensemble(seeds = [4],  # random seeds
+                 param_sets = [{}],  # parameter values that vary between the replications
+                 quiet = True,  # suppress the console output of micromodel
+                 processes = 0,  # size of the process pool; 0 runs the replications in this process, None uses all cores
+                 **params):  # micromodel parameters shared by all replications (e.g. duration, demand)
+
+    '''
+    Run all replications and return one agent_pos data frame per replication (in the order of replications()).
+    In a process pool the data frames come back through shared memory (see shared_results.py) instead of
+    being pickled; they do not have the redundant Position column.
+    '''
+
+    params.setdefault('data_filename', 0)  # replications are not written to csv unless asked for
+    tasks = [dict(params, **replication) for replication in replications(seeds, param_sets)]
+    if processes == 0:
+        return [_run(task, quiet) for task in tasks]
+    results = []
+    with multiprocessing.Pool(processes) as pool:
+        outputs = pool.imap(_run_shared, [(task, quiet) for task in tasks])
+        try:
+            for shared, output in outputs:
+                results.append(SharedResult(output).to_dataframe() if shared else output)
+        except BaseException:  # remove the files of the results that were not opened
+            for shared, output in outputs:
+                if shared:
+                    discard(output)
+            raise
+    return results
+
+
+def _run(kwargs, quiet):
+    if quiet:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return micromodel(**kwargs)
+    return micromodel(**kwargs)
+
+
+def _run_shared(task):
+    # worker function: data frames are returned as shared-memory handles, other results (compact_output) are pickled
+    result = _run(*task)
+    return (True, share_dataframe(result)) if isinstance(result, pd.DataFrame) else (False, result)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+**************************
+*** MANEUVER EVENT LOG ***
+**************************
+'''
+#%%
+from array import array
+import numpy as np
+import pandas as pd
+from obstacles import StaticBlocker
+#%%
+
+'''
+ManeuverLog is passed to micromodel as event_log. An overtaking episode starts when findLatPos sets
+overtake from False to True and ends when it is set back (Completed = 1), when the cyclist leaves the
+path or when the run ends (Completed = 0). One row per episode is appended to typed column buffers
+(array.array, 4 bytes per value), about 40 bytes per episode:
+    AgentID, StartStep, EndStep       cyclist and the steps of the decisions (time = step * dt)
+    StartY, TargetY                   lateral position at the start and desired lateral position in the chosen gap (m)
+    GapRight, GapLeft                 borders of the chosen lateral gap (m; NaN if no gap was chosen)
+    StartLeader, EndLeader            direct leader before and after the episode (-1 none, -2 static obstacle)
+    LatDist                           lateral distance travelled during the episode (m); the sum over all episodes
+                                      is sum_lat_dist of micromodel
+    Completed                         1 if overtake was reset by the cyclist, 0 if the episode was cut off
+The records of a previous run are cleared when the log is passed to micromodel again.
+'''
+
+COLUMNS = {'AgentID': 'i', 'StartStep': 'i', 'EndStep': 'i', 'StartY': 'f', 'TargetY': 'f', 'GapRight': 'f', 'GapLeft': 'f',
+           'StartLeader': 'i', 'EndLeader': 'i', 'LatDist': 'f', 'Completed': 'b'}
+DTYPES = {'i': np.int32, 'f': np.float32, 'b': np.int8}
+
+
+def leader_id(leader):
+    # unique_id of a direct leader (Bicycle), -1 for no leader (0 in the model) and -2 for a static obstacle
+    if leader == 0:
+        return -1
+    if isinstance(leader, StaticBlocker):
+        return -2
+    return leader.unique_id
+
+
+class ManeuverLog:
+
+    def __init__(self):
+        self.reset()
+
+    def cache_key(self):
+        # configuration hashed into the stage keys of pipeline.py (the log has none)
+        return {}
+
+    def reset(self):
+        self.columns = {c: array(t) for c, t in COLUMNS.items()}
+        self.open = {}  # unique_id -> [start step, start y, target y, gap right, gap left, start leader, lateral distance]
+
+    def start(self, agent, step, leader):
+        gap = agent.chosen_gap if agent.chosen_gap is not None else (np.nan, np.nan)
+        self.open[agent.unique_id] = [step, agent.pos[1], agent.des_lat_pos, gap[0], gap[1], leader_id(leader), 0.0]
+
+    def lateral(self, agent, distance):
+        episode = self.open.get(agent.unique_id)
+        if episode is not None:
+            episode[6] += distance
+
+    def end(self, agent, step, completed = True):
+        episode = self.open.pop(agent.unique_id, None)
+        if episode is None:
+            return
+        values = [agent.unique_id, episode[0], step] + episode[1:6] + [leader_id(agent.leader), episode[6], int(completed)]
+        for column, value in zip(self.columns.values(), values):
+            column.append(value)
+
+    def end_all(self, agents, step):
+        # cut off the episodes that are still open at the end of the run
+        for agent in agents:
+            self.end(agent, step, completed=False)
+
+    def __len__(self):
+        return len(self.columns['AgentID'])
+
+    def nbytes(self):
+        return sum(c.itemsize * len(c) for c in self.columns.values())
+
+    def arrays(self):
+        # numpy copies of the column buffers (a view would keep the buffers from growing)
+        return {c: np.frombuffer(buf, dtype=DTYPES[buf.typecode]).copy() for c, buf in self.columns.items()}
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.arrays())
+
+    def save(self, path):  # .npz file with one array per column
+        np.savez(path, **self.arrays())
+
+
+def load_events(path):
+    # event table of a saved ManeuverLog as data frame
+    with np.load(path) as data:
+        return pd.DataFrame({c: data[c] for c in COLUMNS})
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+***************************************
+*** STATIONARY-DEMAND FD GENERATION ***
+***************************************
+'''
+#%%
+import multiprocessing
+import numpy as np
+import pandas as pd
+from calibration import simulate_fd
+#%%
+
+'''
+Fundamental diagram from many short runs at constant demand instead of one long run with a ramped
+demand profile. Every run simulates one demand level (bic/h; stochastic inflow) for `duration`
+seconds, drops the aggregation intervals that start within the warm-up and keeps the remaining q-k-v
+points, which sample the stationary state of that level. Only the positions inside agg_dist are
+recorded. The runs of a round go to a process pool. After each round the levels are sorted and the
+mean points (density, flow) of neighbouring levels are compared relative to the largest density and
+flow reached so far: where they are further apart than `resolution`, the demand between them is
+added in the next round. This puts the extra runs where the curve bends or breaks down, i.e. around
+capacity. The result has the columns of fit_fd (with the lowess curves, see analysis.smooth_fd) and
+can be passed to draw_fd; attrs['levels'] holds the mean point of every level.
+'''
+
+# demand levels of the first round (bic/h); the capacity of the default 2 m path is about 3500 bic/h
+LEVELS = [500, 1000, 1500, 2000, 2500, 3000, 4000, 5000, 6000]
+
+
+def level_params(level,  # demand level (bic/h)
+                 duration,  # length of the run (s)
+                 agg_dist,  # aggregation space (m), the recorded window
+                 params):  # further micromodel parameters (e.g. bottleneck_width)
+    # micromodel parameters of a run at constant demand: demand is the number of cyclists over the whole run
+    return dict(params, duration=duration, demand=[level * duration / 3600], demand_input='stochastic',
+                recording={'fields': ['Position'], 'interval': None, 'window': list(agg_dist)})
+
+
+def _level_points(task):
+    # worker function: stationary q-k-v points of one run
+    level, seed, duration, warmup, agg_time, agg_dist, params = task
+    q_k_v = simulate_fd(dict(level_params(level, duration, agg_dist, params), seed=seed), agg_time, agg_dist)
+    q_k_v = q_k_v[q_k_v['Time_(s)'] - agg_time >= warmup].copy()  # intervals that start after the warm-up
+    q_k_v['Demand_(/h)'] = level
+    q_k_v['Seed'] = seed
+    return q_k_v
+
+
+def refine_levels(summary,  # mean point per level, columns 'Demand_(/h)', 'Density_(/m2)' and 'Flow_(/h/m)'
+                  resolution = 0.15,  # largest accepted distance of neighbouring mean points (share of the maximum density and flow)
+                  min_step = 50):  # smallest difference of two levels (bic/h)
+    # demand levels to add between neighbouring levels whose mean points are too far apart
+    summary = summary.sort_values('Demand_(/h)')
+    levels = summary['Demand_(/h)'].to_numpy(dtype=float)
+    k = summary['Density_(/m2)'].to_numpy() / max(summary['Density_(/m2)'].max(), 1e-12)
+    q = summary['Flow_(/h/m)'].to_numpy() / max(summary['Flow_(/h/m)'].max(), 1e-12)
+    gaps = np.maximum(np.abs(np.diff(k)), np.abs(np.diff(q)))
+    return [float((levels[i] + levels[i+1]) / 2) for i in np.nonzero(gaps > resolution)[0]
+            if levels[i+1] - levels[i] >= 2 * min_step]
+
+
+def stationary_fd(levels = LEVELS,  # demand levels of the first round (bic/h)
+                  duration = 600,  # length of each run (s)
+                  warmup = 180,  # time dropped at the start of each run (s)
+                  seeds = [4],  # random seeds; every level is run once per seed
+                  rounds = 2,  # refinement rounds after the first one
+                  resolution = 0.15,  # see refine_levels
+                  min_step = 50,  # see refine_levels (bic/h)
+                  max_levels = 30,  # upper limit of the number of levels
+                  agg_time = 30,  # aggregation interval (s)
+                  agg_dist = [200, 250],  # aggregation space (min and max value in m)
+                  processes = None,  # size of the process pool; None uses all cores, 0 runs everything in this process
+                  **params):  # micromodel parameters shared by all runs (e.g. bottleneck_width, path_width)
+
+    # q-k-v points of all levels, sorted by density with the lowess curves; attrs['levels'] holds the mean point per level
+    from analysis import smooth_fd
+    tasks = lambda new: [(level, seed, duration, warmup, agg_time, agg_dist, params) for level in new for seed in seeds]
+    pool = multiprocessing.Pool(processes) if processes != 0 else None
+    points = []
+    try:
+        new = sorted(set(float(l) for l in levels))
+        for r in range(rounds + 1):
+            results = pool.map(_level_points, tasks(new)) if pool is not None else [_level_points(t) for t in tasks(new)]
+            points.extend(results)
+            q_k_v = pd.concat(points, ignore_index=True)
+            summary = q_k_v.groupby('Demand_(/h)', as_index=False)[['Density_(/m2)', 'Flow_(/h/m)', 'Speed']].mean()
+            room = max_levels - len(summary)
+            new = refine_levels(summary, resolution=resolution, min_step=min_step)[:max(room, 0)]
+            if r == rounds or len(new) == 0:
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+    q_k_v = smooth_fd(q_k_v)
+    q_k_v.attrs['levels'] = summary
+    return q_k_v
@@ -1,19 +1,27 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime
+from collections import OrderedDict
+import threading
+import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.animation import FuncAnimation
 from matplotlib.animation import PillowWriter
 import mpl_toolkits.axes_grid1
 import matplotlib.widgets
 from matplotlib.patches import Rectangle
 from matplotlib.patches import Polygon
+from trajectory_store import TrajectoryStore
+from obstacles import LateralProfile, bottleneck_profile
 
 
 class Player(FuncAnimation):  # Player class from https://stackoverflow.com/questions/44985966/managing-dynamic-plotting-in-matplotlib-animation-module/44989063#44989063
     def __init__(self, fig, func, frames=None, init_func=None, fargs=None,
-                 save_count=False, mini=0, maxi=18000, pos=(0.04, 0.02), **kwargs):
+                 save_count=False, mini=0, maxi=18000, pos=(0.04, 0.02), frame_cache=None, **kwargs):
         self.i = 0
+        self.frame_cache = frame_cache  # FrameCache with the rasters of frames already shown, None draws every frame
         self.min=mini
         self.max=maxi
         self.runs = True
@@ -62,7 +70,7 @@ class Player(FuncAnimation):  # Player class from https://stackoverflow.com/ques
             self.i+=1
         elif self.i == self.max and not self.forwards:
             self.i-=1
-        self.func(self.i)
+        self.show(self.i)
         self.slider.set_val(self.i)
         self.fig.canvas.draw_idle()
 
@@ -90,34 +98,208 @@ class Player(FuncAnimation):  # Player class from https://stackoverflow.com/ques
 
     def set_pos(self,i):
         self.i = int(self.slider.val)
-        self.func(self.i)
+        self.show(self.i)
+
+    def show(self, i):
+        # cached raster of the frame if available, otherwise draw it; then prefetch the next frames in playing direction
+        if self.frame_cache is None or not self.frame_cache.show(i):
+            self.func(i)
+        if self.frame_cache is not None:
+            self.frame_cache.prefetch(i, self.forwards)
 
     def update(self,i):
         self.slider.set_val(i)
 
 
+class FrameCache:
+    '''
+    Bounded LRU cache of rendered frames for the Player. A frame is stored as the RGBA raster of the
+    inside of the axes, keyed by (step, view window, highlighted cyclist, size in pixels); a cached
+    frame is shown as one image with the title and labels drawn on top, instead of drawing all
+    cyclists again. Frames drawn on screen are stored after their draw; a background thread renders
+    the next `prefetch` frames in playing direction on an off-screen Agg figure of the same size.
+    The oldest frames are dropped when the rasters exceed max_mb. close() stops the thread and frees
+    the rasters; it is called when the figure is closed.
+    '''
+
+    def __init__(self, fig, ax,
+                 draw_frame,  # draw_frame(ax, frame) draws a complete frame on ax
+                 decorate,  # decorate(ax, frame) sets limits, title and labels of ax
+                 view,  # view window and highlighted cyclist, part of the key
+                 max_mb = 256,  # memory cap of the rasters (MB)
+                 prefetch = 10):  # number of frames rendered ahead
+        self.fig = fig
+        self.ax = ax
+        self.draw_frame = draw_frame
+        self.decorate = decorate
+        self.view = view
+        self.max_bytes = max_mb * 1e6
+        self.n_prefetch = prefetch
+        self.rasters = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._drawn = None  # frame drawn on screen, stored after the next draw
+        self._request = None  # (first frame, direction) of the latest prefetch request
+        self._wake = threading.Condition(self._lock)
+        self._off = None  # off-screen figure and axes for prefetching
+        self._thread = None
+        self._closed = False  # stop signal of the prefetch thread
+        fig.canvas.mpl_connect('draw_event', self._on_draw)
+        fig.canvas.mpl_connect('close_event', self.close)
+
+    def _size(self, ax):
+        b = ax.bbox
+        return (int(round(b.width)), int(round(b.height)))
+
+    def key(self, frame):
+        return (frame, self.view, self._size(self.ax))
+
+    def _crop(self, canvas, ax):
+        buffer = np.asarray(canvas.buffer_rgba())
+        b = ax.bbox
+        x0, x1 = int(round(b.x0)), int(round(b.x1))
+        y0, y1 = buffer.shape[0] - int(round(b.y1)), buffer.shape[0] - int(round(b.y0))
+        return buffer[y0:y1, x0:x1].copy()
+
+    def _store(self, key, raster):
+        with self._lock:
+            if key in self.rasters:
+                return
+            self.rasters[key] = raster
+            self.nbytes += raster.nbytes
+            while self.nbytes > self.max_bytes and len(self.rasters) > 1:
+                self.nbytes -= self.rasters.popitem(last=False)[1].nbytes
+
+    def _on_draw(self, event):
+        if self._drawn is not None:
+            self._store(self.key(self._drawn), self._crop(self.fig.canvas, self.ax))
+            self._drawn = None
+
+    def show(self, frame):
+        # True if the frame was shown from the cache; False means it has to be drawn (and is stored after the draw)
+        with self._lock:
+            raster = self.rasters.get(self.key(frame))
+            if raster is not None:
+                self.rasters.move_to_end(self.key(frame))
+        if raster is None:
+            self.misses += 1
+            self._drawn = frame
+            return False
+        self.hits += 1
+        self._drawn = None
+        self.ax.clear()
+        self.decorate(self.ax, frame)
+        (x0, x1), (y0, y1) = self.ax.get_xlim(), self.ax.get_ylim()
+        self.ax.imshow(raster, extent=(x0, x1, y0, y1), aspect='auto', interpolation='nearest', zorder=0)
+        self.ax.set_xlim(x0, x1)
+        self.ax.set_ylim(y0, y1)
+        return True
+
+    def prefetch(self, frame, forwards):
+        if self.n_prefetch <= 0 or self._closed:
+            return
+        with self._lock:
+            self._request = (frame, 1 if forwards else -1)
+            self._wake.notify()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._prefetch_loop, daemon=True)
+            self._thread.start()
+
+    def close(self, event=None):
+        # stop the prefetch thread (after the frame it renders) and free the rasters
+        with self._lock:
+            self._closed = True
+            self._request = None
+            self._wake.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        self._off = None
+        with self._lock:
+            self.rasters.clear()
+            self.nbytes = 0
+
+    def _render(self, frame):
+        # draw the frame on the off-screen figure (same size and axes position as on screen) and return its raster
+        size = self.fig.get_size_inches()
+        if self._off is None or tuple(self._off[0].get_size_inches()) != tuple(size) or self._off[0].dpi != self.fig.dpi:
+            off_fig = Figure(figsize=size, dpi=self.fig.dpi)
+            FigureCanvasAgg(off_fig)
+            self._off = (off_fig, off_fig.add_axes(self.ax.get_position().bounds))
+        off_fig, off_ax = self._off
+        off_ax.set_position(self.ax.get_position().bounds)
+        off_ax.clear()
+        self.draw_frame(off_ax, frame)
+        off_fig.canvas.draw()
+        return self._crop(off_fig.canvas, off_ax)
+
+    def _prefetch_loop(self):
+        while True:
+            with self._lock:
+                while self._request is None and not self._closed:
+                    self._wake.wait()
+                if self._closed:
+                    return
+                request = self._request
+                self._request = None
+            frame, direction = request
+            for k in range(1, self.n_prefetch + 1):
+                if self._request is not None or self._closed:  # the player moved on or the figure was closed
+                    break
+                key = self.key(frame + k*direction)
+                with self._lock:
+                    cached = key in self.rasters
+                if not cached and self._size(self.ax) == key[2]:
+                    self._store(key, self._render(frame + k*direction))
+
+
 def plot_simulation(agent_pos, 
                     dt = 0.5, 
                     path_width = 2,
                     bottleneck_width = 0,
+                    obstacles = None,  # LateralProfile with the static obstacles of the run (see obstacles.py)
                     anim_interval = 500, # time to update (ms); 200 ms = 5 FPS
                     plot_length = [0,300],  # start and end of space to show the simulation (m)
                     check_cyclist_id = -1,
-                    animation_filename = "animation"
+                    animation_filename = "animation",
+                    cache_mb = 256,  # memory cap of the cache of rendered frames for scrubbing (MB); 0 disables it
+                    prefetch = 10  # number of frames rendered ahead in the background
                     ): 
             
+    # static obstacles as simulated by micromodel
+    obstacles = LateralProfile() if obstacles is None else obstacles.copy()
+    if bottleneck_width in [1.0,1.5,2.0]:
+        bottleneck_profile(bottleneck_width, path_width, profile=obstacles)
+    
     # create figure
     fig, ax = plt.subplots(figsize=(20,3), layout='constrained')
     
-    # animation function
-    def animate(frame):
-        
-        # clear canvas
-        ax.clear()
+    # limits, title and labels of a frame
+    def decorate(ax, frame):
         
         # set the boundaries of the plot
         ax.set_xlim([plot_length[0],plot_length[1]])
         ax.set_ylim([0,path_width+1])
+        
+        # get minutes and seconds from the simulation step
+        minutes = int(frame/(60/dt))
+        seconds = round((frame % (60/dt)) * dt, 2)
+        hundredth = int(round((seconds % 1) * 100, 0))
+        seconds = int(seconds)
+        
+        # naming the plot
+        ax.set_title(f'Time {minutes:02}:{seconds:02}.{hundredth:02}  |  Step {frame:04}  |  dt = {dt}  |  {datetime.now().strftime("%Y-%m-%d %H:%M")} ')
+        ax.set_xlabel('Cycle path length (m)')
+        ax.set_ylabel('Cycle path width (m)')
+    
+    # draw a complete frame on ax (the axes on screen or the off-screen axes of the frame cache)
+    def draw_frame(ax, frame):
+        
+        # clear canvas
+        ax.clear()
+        decorate(ax, frame)
         # rename the y-tick labels
         # ax.set_yticks([0, 0.5, 1, 1.5, 2, 2.5, 3, 3.5, 4], [-0.5, 0, 0.5, 1, 1.5, 2, 2.5, 3, 3.5])
         # draw the edges of the cycle path
@@ -131,7 +313,10 @@ def plot_simulation(agent_pos,
         
         
         # obtain agents visible in the current simulation step
-        agent_pos_frame = agent_pos[agent_pos['Step'] == frame]
+        if isinstance(agent_pos, TrajectoryStore):
+            agent_pos_frame = agent_pos.frame(frame)  # read only the rows of this step from the store
+        else:
+            agent_pos_frame = agent_pos[agent_pos['Step'] == frame]
         # obtain their position
         x_pos = agent_pos_frame['Position_x']
         y_pos = agent_pos_frame['Position_y']
@@ -168,39 +353,26 @@ def plot_simulation(agent_pos,
             ax.text(row['Position_x'], row['Position_y']+0.5, "{}/{}".format(round(row['Speed'],1),round(row['desSpeed'],1)), ha='center', va='bottom')
             ax.text(row['Position_x'], row['Position_y']-0.5, row['ID'], ha='center', va='top', fontsize='large')
         
-        # get minutes and seconds from the simulation step
-        minutes = int(frame/(60/dt))
-        seconds = round((frame % (60/dt)) * dt, 2)
-        hundredth = int(round((seconds % 1) * 100, 0))
-        seconds = int(seconds)
-        
-        # naming the plot
-        ax.set_title(f'Time {minutes:02}:{seconds:02}.{hundredth:02}  |  Step {frame:04}  |  dt = {dt}  |  {datetime.now().strftime("%Y-%m-%d %H:%M")} ')
-        ax.set_xlabel('Cycle path length (m)')
-        ax.set_ylabel('Cycle path width (m)')
-        
         for t in ax.texts:
             t.set_clip_on(True)
         
-        # bottleneck
-        if bottleneck_width in [1.0,1.5,2.0]:
-            coords = []
-            if bottleneck_width == 1.0:
-                # 4 cyclists
-                # virt_positions = [[254,2.4], [253,2.8], [252,3.2], [251,3.6]]
-                coords = [(249,4.0-(3-path_width)),(255.25,1.5-(3-path_width)),(300,1.5-(3-path_width)),(300,4.0-(3-path_width))]
-            elif bottleneck_width == 1.5:
-                # 3 cyclists
-                # virt_positions = [[253,2.9], [252,3.3], [251,3.7]]
-                coords = [(249,4.1-(3-path_width)),(254.25,2.0-(3-path_width)),(300,2.0-(3-path_width)),(300,4.1-(3-path_width))]
-            else:
-                # 2 cyclists
-                # virt_positions = [[252,3.4], [251,3.8]]
-                coords = [(249,4.3-1),(253.25,2.6-1),(300,2.6-1),(300,4.3-1)]
+        # static obstacles (bottleneck)
+        for name, coords, first, low, high in obstacles.obstacles:
             ax.add_patch(Polygon(coords, color='white', zorder=1.2))
+    
+    # animation function
+    def animate(frame):
+        draw_frame(ax, frame)
+        
+    # rendered frames for scrubbing back and forth
+    frame_cache = None
+    if cache_mb > 0:
+        frame_cache = FrameCache(fig, ax, draw_frame, decorate, view=(tuple(plot_length), path_width, check_cyclist_id),
+                                 max_mb=cache_mb, prefetch=prefetch)
         
     # matplotlib animation function
-    anim = Player(fig, animate, agent_pos['Step'].unique(), interval=anim_interval, cache_frame_data=True)
+    steps = agent_pos.steps if isinstance(agent_pos, TrajectoryStore) else agent_pos['Step'].unique()
+    anim = Player(fig, animate, steps, interval=anim_interval, cache_frame_data=True, frame_cache=frame_cache)
     fig.show()
     
     
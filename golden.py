@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+*********************************
+*** GOLDEN-TRAJECTORY CHECKER ***
+*********************************
+'''
+#%%
+import io
+import os
+import sys
+import contextlib
+import numpy as np
+import pandas as pd
+#%%
+
+'''
+Equivalence check of a candidate implementation (an optimized model.py, another engine) against the
+reference micromodel on a matrix of scenarios. The reference trajectories are either simulated in the
+same process or read from golden files written before the change:
+    python golden.py write golden/      on the reference version (e.g. the main branch)
+    python golden.py check golden/      on the candidate; exits with 1 if a scenario diverges
+Trajectories are compared row by row (Step, AgentID) on all numeric columns within atol + rtol*|reference|;
+a row that exists in only one of the runs is a divergence as well. The report names the first diverging
+step, agent and columns and shows the rows of the agent around that step in both runs. The q-k-v points
+of the fundamental diagram (compute_qkv) are compared with fd_rtol. Independent of the reference, every
+row of the candidate in the bottleneck scenarios must have its lateral position on the path (off_path); the
+path clamp of calPos only applies with static obstacles, so off_path is not checked in the other scenarios.
+'''
+
+# scenario matrix: base, each bottleneck width, narrow and wide path, no look-back
+SCENARIOS = {'base': {},
+             'bottleneck_1.0': {'bottleneck_width': 1.0},
+             'bottleneck_1.5': {'bottleneck_width': 1.5},
+             'bottleneck_2.0': {'bottleneck_width': 2.0},
+             'narrow_path': {'path_width': 1.5},
+             'wide_path': {'path_width': 3},
+             'no_lookback': {'lookback': 0}}
+
+# parameters shared by all scenarios (kept short, the check runs before every merge)
+BASE_PARAMS = {'duration': 300, 'demand': [150], 'seed': 4}
+
+
+def _simulate(model, params):
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent_pos = model(**dict(params, data_filename=0))
+    return agent_pos.drop(columns=['Position'], errors='ignore')
+
+
+def compare_trajectories(reference, candidate,  # agent_pos data frames
+                         atol = 1e-9,  # absolute tolerance
+                         rtol = 0,  # relative tolerance
+                         context = 3):  # steps before and after the first divergence shown in the report
+    # None if equivalent, otherwise a dict describing the first divergence
+    columns = [c for c in reference.columns if c in candidate.columns and c not in ('Step', 'AgentID')
+               and pd.api.types.is_numeric_dtype(reference[c])]
+    merged = reference[['Step', 'AgentID'] + columns].merge(candidate[['Step', 'AgentID'] + columns], on=['Step', 'AgentID'],
+                                                             how='outer', suffixes=('_ref', '_cand'), indicator=True)
+    bad = (merged['_merge'] != 'both').to_numpy().copy()
+    diverging = {}
+    for c in columns:
+        ref, cand = merged[c + '_ref'].to_numpy(dtype=float), merged[c + '_cand'].to_numpy(dtype=float)
+        with np.errstate(invalid='ignore'):
+            off = ~((np.abs(ref - cand) <= atol + rtol*np.abs(ref)) | (np.isnan(ref) & np.isnan(cand)))
+        diverging[c] = off & ~bad
+        bad |= off
+    if not bad.any():
+        return None
+    first = merged[bad].sort_values(['Step', 'AgentID']).iloc[0]
+    row = first.name
+    step, agent = int(first['Step']), first['AgentID']
+    window = lambda df: df[(df['AgentID'] == agent) & (df['Step'] >= step - context) & (df['Step'] <= step + context)]
+    return {'step': step,
+            'agent': agent,
+            'missing_in': {'left_only': 'candidate', 'right_only': 'reference'}.get(first['_merge'], None),
+            'columns': {c: (first[c + '_ref'], first[c + '_cand']) for c in columns if diverging[c][row]},
+            'diverging_rows': int(bad.sum()),
+            'reference': window(reference),
+            'candidate': window(candidate)}
+
+
+def off_path(agent_pos,  # agent_pos data frame
+             path_width = 2):  # width of the simulated path (m, excl. 2x 0.5 m space on side of the path), as passed to micromodel
+    # number of rows whose lateral position is outside the path
+    y = agent_pos['Position_y'].to_numpy()
+    return int(np.count_nonzero((y < 0.5) | (y > path_width + 0.5)))
+
+
+def _obstructed(params):
+    # True if the scenario has static obstacles (an active bottleneck or a LateralProfile)
+    return params.get('bottleneck_width') in [1.0, 1.5, 2.0] or (params.get('obstacles') is not None and len(params['obstacles']) > 0)
+
+
+def compare_fd(reference, candidate,  # agent_pos data frames
+               duration,  # simulation duration (s)
+               dt = 0.5,  # time step size (s)
+               fd_rtol = 1e-6,  # relative tolerance of flow, density and speed
+               agg_time = 30, agg_dist = [200, 250]):  # aggregation as in plot_fd
+    # maximum relative difference of the q-k-v points and whether it is within fd_rtol
+    from analysis import compute_qkv
+    q_ref = compute_qkv(reference, dt=dt, duration=duration, agg_time=agg_time, agg_dist=agg_dist)
+    q_cand = compute_qkv(candidate, dt=dt, duration=duration, agg_time=agg_time, agg_dist=agg_dist)
+    worst = 0.0
+    for c in ['Flow', 'Density', 'Speed']:
+        ref, cand = q_ref[c].to_numpy(dtype=float), q_cand[c].to_numpy(dtype=float)
+        if len(ref) != len(cand):
+            return np.inf, False
+        scale = np.maximum(np.abs(ref), 1e-12)
+        worst = max(worst, float(np.max(np.abs(ref - cand) / scale, initial=0)))
+    return worst, worst <= fd_rtol
+
+
+def write_golden(directory,  # directory of the golden files (created if it does not exist)
+                 scenarios = SCENARIOS,
+                 base_params = BASE_PARAMS):
+    # simulate the scenarios with the reference micromodel and save the trajectories
+    from model import micromodel
+    os.makedirs(directory, exist_ok=True)
+    for name, params in scenarios.items():
+        _simulate(micromodel, dict(base_params, **params)).to_pickle(os.path.join(directory, name + '.pkl'))
+        print("{}: written".format(name))
+
+
+def check_equivalence(candidate = None,  # callable with the signature of micromodel; None uses micromodel of this tree
+                      golden = None,  # directory written by write_golden; None simulates the reference micromodel
+                      scenarios = SCENARIOS,
+                      base_params = BASE_PARAMS,
+                      atol = 1e-9, rtol = 0, fd_rtol = 1e-6):
+    # returns {scenario: report}; a report has 'equivalent', 'fd_error', 'divergence' (None or see compare_trajectories) and 'off_path'
+    # (None in scenarios without static obstacles)
+    from model import micromodel
+    candidate = micromodel if candidate is None else candidate
+    reports = {}
+    for name, params in scenarios.items():
+        params = dict(base_params, **params)
+        if golden is None:
+            reference = _simulate(micromodel, params)
+        else:
+            reference = pd.read_pickle(os.path.join(golden, name + '.pkl'))
+        result = _simulate(candidate, params)
+        divergence = compare_trajectories(reference, result, atol=atol, rtol=rtol)
+        fd_error, fd_ok = compare_fd(reference, result, duration=params['duration'], dt=params.get('dt', 0.5), fd_rtol=fd_rtol)
+        reports[name] = {'equivalent': divergence is None and fd_ok, 'fd_error': fd_error, 'divergence': divergence,
+                         'off_path': off_path(result, params.get('path_width', 2)) if _obstructed(params) else None}
+    return reports
+
+
+def print_report(reports):
+    for name, r in reports.items():
+        print("{:<16} {}  (FD max. relative difference {:.2e})".format(name, 'ok' if r['equivalent'] else 'DIVERGES', r['fd_error']))
+        if r['off_path']:
+            print("    {} rows of the candidate are off the path".format(r['off_path']))
+        d = r['divergence']
+        if d is None:
+            continue
+        if d['missing_in'] is not None:
+            print("    first divergence at step {}, agent {}: row missing in the {}".format(d['step'], d['agent'], d['missing_in']))
+        else:
+            print("    first divergence at step {}, agent {}: {}".format(d['step'], d['agent'],
+                  ", ".join("{} {} -> {}".format(c, ref, cand) for c, (ref, cand) in d['columns'].items())))
+        print("    {} diverging rows; agent {} in the reference:".format(d['diverging_rows'], d['agent']))
+        print(d['reference'].to_string(index=False))
+        print("    and in the candidate:")
+        print(d['candidate'].to_string(index=False))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in ('write', 'check'):
+        print("usage: python golden.py write|check <directory>")
+        sys.exit(2)
+    if sys.argv[1] == 'write':
+        write_golden(sys.argv[2])
+    else:
+        reports = check_equivalence(golden=sys.argv[2])
+        print_report(reports)
+        sys.exit(0 if all(r['equivalent'] and not r['off_path'] for r in reports.values()) else 1)
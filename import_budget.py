@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+****************************
+*** WORKER IMPORT BUDGET ***
+****************************
+'''
+#%%
+import os
+import sys
+import json
+import subprocess
+#%%
+
+'''
+Batch runs start many short-lived worker processes that only simulate (ensemble.py, calibration.py,
+pipeline.py). Their startup cost is the import of the simulation path, which is mesa (with its own
+pandas and networkx imports), numpy and the model modules. Plotting and statistics are loaded on first
+use (analysis.py, calibration.Calibration.run); figures.py is plotting only and must not be imported
+by the simulation path. check_import_budget measures the cold import of each module in a fresh
+interpreter and fails if it takes longer than the budget or loads one of HEAVY_MODULES.
+Run it from the package directory:  python import_budget.py
+'''
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# modules imported by the worker processes of batch runs
+SIMULATION_MODULES = ['model', 'ensemble', 'calibration', 'pipeline']
+
+# dependencies that the simulation path must not load
+HEAVY_MODULES = ['matplotlib', 'statsmodels', 'scipy', 'figures']
+
+# cold import time of each simulation module (s); mesa alone takes about 0.8 s on a laptop
+IMPORT_BUDGET = 1.5
+
+
+def measure_import(module):
+    # cold import time (s) of module in a new interpreter and the heavy modules it loaded
+    code = ("import sys, time, json\n"
+            "t = time.perf_counter()\n"
+            "import {}\n"
+            "t = time.perf_counter() - t\n"
+            "print(json.dumps({{'time': t, 'heavy': [m for m in {} if m in sys.modules]}}))").format(module, HEAVY_MODULES)
+    out = subprocess.run([sys.executable, '-c', code], cwd=PACKAGE_DIR, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.splitlines()[-1])
+
+
+def check_import_budget(modules = SIMULATION_MODULES,  # modules to measure
+                        budget = IMPORT_BUDGET):  # maximum cold import time per module (s)
+    # returns {module: {'time', 'heavy'}}; raises RuntimeError if a module is over the budget or loads a heavy module
+    report = {m: measure_import(m) for m in modules}
+    failed = ["{} ({:.2f} s{})".format(m, r['time'], ", loads " + ", ".join(r['heavy']) if r['heavy'] else "")
+              for m, r in report.items() if r['time'] > budget or r['heavy']]
+    if failed:
+        raise RuntimeError("Import budget of {} s exceeded or heavy modules loaded: {}".format(budget, "; ".join(failed)))
+    return report
+
+
+if __name__ == '__main__':
+    for m, r in check_import_budget().items():
+        print("{:<12} {:.2f} s".format(m, r['time']))
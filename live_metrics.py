@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+*****************************
+*** LIVE METRICS ENDPOINT ***
+*****************************
+'''
+#%%
+import json
+import time
+import asyncio
+import threading
+from collections import deque
+from memory_budget import process_memory_mb as _memory_mb
+#%%
+
+'''
+LiveMetrics is passed to micromodel in the list monitors (see convergence.py). Every `every`
+steps the simulation loop computes a small snapshot dict and publishes it by replacing a single
+reference; the asyncio server runs in a daemon thread with its own event loop and only reads that
+reference, so the simulation never waits for a lock or a client. Endpoints on localhost:
+    GET /metrics   latest snapshot as JSON
+    GET /stream    server-sent events, one event per new snapshot
+    POST /stop     ends the run after the current step if live.remote_stop is in stop_criteria (reported as
+                   stop reason); a GET is answered with 405, so that link prefetching or reloading a page cannot end the run
+The server is started by reset(), which micromodel calls when the run starts, and stopped by close()
+when the run ends, so the port is only held during a run; latest keeps the last snapshot.
+'''
+
+
+class LiveMetrics:
+
+    def __init__(self, port = 8765,  # port on localhost
+                 every = 20,  # steps between two snapshots
+                 rolling = 15,  # number of snapshots in the rolling flow, density and speed
+                 x_range = [200, 250],  # space in which flow, density and speed are measured (m)
+                 poll = 0.2):  # interval in which the server checks for new snapshots (s)
+        self.port = port
+        self.every = every
+        self.x_range = x_range
+        self.poll = poll
+        self.latest = None  # published snapshot, replaced as a whole
+        self.stop_requested = False
+        self.remote_stop = RemoteStop(self)  # stop criterion of the POST /stop requests
+        self._samples = deque(maxlen=rolling)
+        self._last_wall = None
+        self._last_step = 0
+        self._loop = None
+        self._thread = None
+
+    def reset(self):
+        # start of a run: clear the rolling measures and start the server
+        self.latest = None
+        self.stop_requested = False
+        self._samples.clear()
+        self._last_wall = None
+        self._last_step = 0
+        if self._thread is None:
+            self._start()
+
+    '''
+    ***********************
+    *** SIMULATION SIDE ***
+    ***********************
+    '''
+
+    def update(self, model, dt):
+        if model.time_step % self.every != 0:
+            return
+        now = time.perf_counter()
+        rate = None if self._last_wall is None else (model.time_step - self._last_step) / (now - self._last_wall)
+        self._last_wall, self._last_step = now, model.time_step
+
+        agents = model.schedule.agents
+        inside = [a.speed for a in agents if self.x_range[0] < a.pos[0] <= self.x_range[1]]
+        self._samples.append((len(inside) / (self.x_range[1] - self.x_range[0]), sum(inside)))
+        density = sum(s[0] for s in self._samples) / len(self._samples)
+        n = sum(s[0] for s in self._samples) * (self.x_range[1] - self.x_range[0])
+        speed = sum(s[1] for s in self._samples) / n if n > 0 else 0
+        self.latest = {'step': model.time_step,
+                       'time_s': model.time_step * dt,
+                       'steps_per_s': rate,
+                       'agents': len(agents),
+                       'finished': model.n_finished,
+                       'density_bic_m': density,
+                       'speed_m_s': speed,
+                       'flow_bic_h': density * speed * 3600,
+                       'overtaking_ratio': model.num_decision / model.num_all_decision if model.num_all_decision > 0 else None,
+                       'memory_mb': _memory_mb()}
+
+    def close(self):
+        # disconnect the clients and stop the server thread
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+            self._thread.join()
+            self._loop = None
+        self._thread = None
+
+    '''
+    *******************
+    *** SERVER SIDE ***
+    *******************
+    '''
+
+    def _start(self):
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:  # e.g. port in use
+            self._thread = None
+            raise self._error
+
+    def _serve(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            server = loop.run_until_complete(asyncio.start_server(self._handle, '127.0.0.1', self.port))
+        except OSError as e:  # e.g. port in use, raised in reset
+            self._error = e
+            loop.close()
+            self._ready.set()
+            return
+        self._loop = loop
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            server.close()
+            self._loop.close()
+
+    async def _shutdown(self):
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        asyncio.get_running_loop().stop()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):  # skip the headers
+                pass
+            method = request[0] if len(request) > 0 else ''
+            path = request[1] if len(request) > 1 else '/'
+            if path == '/metrics':
+                await self._respond(writer, 'application/json', json.dumps(self.latest))
+            elif path == '/stop' and method != 'POST':
+                await self._respond(writer, 'text/plain', 'use POST to stop the run', status='405 Method Not Allowed', headers={'Allow': 'POST'})
+            elif path == '/stop':
+                self.stop_requested = True
+                await self._respond(writer, 'application/json', json.dumps({'stop_requested': True}))
+            elif path == '/stream':
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n')
+                sent = None
+                while True:
+                    snapshot = self.latest
+                    if snapshot is not sent:
+                        writer.write('data: {}\n\n'.format(json.dumps(snapshot)).encode())
+                        await writer.drain()
+                        sent = snapshot
+                    await asyncio.sleep(self.poll)
+            else:
+                await self._respond(writer, 'text/plain', 'endpoints: GET /metrics, GET /stream, POST /stop', status='404 Not Found')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, content_type, body, status = '200 OK', headers = {}):
+        body = body.encode()
+        extra = ''.join('{}: {}\r\n'.format(k, v) for k, v in headers.items())
+        writer.write('HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n{}Connection: close\r\n\r\n'.format(status, content_type, len(body), extra).encode() + body)
+        await writer.drain()
+
+
+class RemoteStop:
+    ''' Stop criterion that ends the run after a POST /stop to the endpoint of a LiveMetrics. '''
+
+    def __init__(self, live):
+        self.live = live
+
+    def cache_key(self):
+        # configuration hashed into the stage keys of pipeline.py
+        return {}
+
+    def reset(self):
+        self.live.stop_requested = False
+
+    def update(self, model, dt):
+        if self.live.stop_requested:
+            return "stopped through the live metrics endpoint at {} s".format(model.time_step * dt)
+        return None
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+*****************************************
+*** CHUNKED LOADING OF SAVED RUN DATA ***
+*****************************************
+'''
+#%%
+import os
+import numpy as np
+import pandas as pd
+#%%
+
+# columns loaded when no projection is given (the stringified Position column is skipped, it repeats Position_x and Position_y)
+DEFAULT_COLUMNS = ['Step', 'AgentID', 'Speed', 'latSpeed', 'ID', 'desSpeed', 'srLength', 'srWidth', 'crLength', 'Position_x', 'Position_y']
+
+
+def iter_agent_pos(path,  # .csv file written by micromodel (sep=';') or .parquet file
+                   chunksize = 1000000,  # number of rows per chunk
+                   columns = None,  # list of columns to load (projection); None loads DEFAULT_COLUMNS
+                   step_range = None):  # [first, last] step to keep (inclusive); None keeps all steps
+
+    ''' Yield the saved agent_pos data frame chunk by chunk, so that only one chunk is held in memory. '''
+
+    if columns is None:
+        columns = DEFAULT_COLUMNS
+    columns = list(columns)
+    if os.path.splitext(path)[1] == '.parquet':
+        chunks = _iter_parquet(path, chunksize, columns, step_range)
+    else:
+        chunks = _iter_csv(path, chunksize, columns, step_range)
+    for chunk in chunks:
+        if len(chunk) > 0:
+            yield chunk
+
+
+def _filter_steps(chunk, step_range):
+    if step_range is None:
+        return chunk
+    return chunk[(chunk['Step'] >= step_range[0]) & (chunk['Step'] <= step_range[1])]
+
+
+def _read_columns(columns, available):
+    # columns that need to be read from the file to return the requested ones
+    read = [c for c in columns if c in available]
+    if 'Step' not in read:
+        read.append('Step')  # always needed for the step filter
+    if any(c in columns and c not in available for c in ['Position_x', 'Position_y']) and 'Position' not in read:
+        read.append('Position')  # older files: derive the coordinates from the stringified position
+    return read
+
+
+def _split_position(chunk, columns):
+    if 'Position' not in chunk.columns:
+        return chunk
+    if ('Position_x' in columns and 'Position_x' not in chunk.columns) or ('Position_y' in columns and 'Position_y' not in chunk.columns):
+        xy = chunk['Position'].astype(str).str.strip('[]()').str.split(',', expand=True).astype(np.float64)
+        chunk = chunk.assign(Position_x=xy[0].to_numpy(), Position_y=xy[1].to_numpy())
+    return chunk
+
+
+def _iter_csv(path, chunksize, columns, step_range):
+    available = pd.read_csv(path, sep=';', nrows=0).columns
+    read = _read_columns(columns, available)
+    for chunk in pd.read_csv(path, sep=';', usecols=read, chunksize=chunksize):
+        if step_range is not None and chunk['Step'].iloc[0] > step_range[1]:
+            break  # micromodel writes the rows in step order, nothing more to read
+        chunk = _filter_steps(chunk, step_range)
+        if len(chunk) == 0:
+            continue  # before the step range; splitting an empty Position column would fail
+        yield _split_position(chunk, columns)[columns]
+
+
+def _iter_parquet(path, chunksize, columns, step_range):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Reading parquet files requires the pyarrow package")
+    pf = pq.ParquetFile(path)
+    available = pf.schema_arrow.names
+    read = _read_columns(columns, available)
+    step_col = available.index('Step')
+    for rg in range(pf.metadata.num_row_groups):
+        # skip row groups outside the step range with the column statistics
+        stats = pf.metadata.row_group(rg).column(step_col).statistics
+        if step_range is not None and stats is not None and stats.has_min_max:
+            if stats.max < step_range[0] or stats.min > step_range[1]:
+                continue
+        for batch in pf.iter_batches(batch_size=chunksize, row_groups=[rg], columns=read):
+            chunk = _filter_steps(batch.to_pandas(), step_range)
+            if len(chunk) > 0:
+                yield _split_position(chunk, columns)[columns]
+
+
+def csv_to_parquet(csv_path,  # .csv file written by micromodel
+                   parquet_path,  # output file
+                   chunksize = 1000000):  # rows per chunk and parquet row group
+
+    ''' Convert a saved run to the columnar parquet format without loading the whole file. '''
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Writing parquet files requires the pyarrow package")
+    writer = None
+    for chunk in iter_agent_pos(csv_path, chunksize=chunksize):
+        chunk = chunk.astype({'Step': np.int32, 'AgentID': str, 'ID': str} if chunk['AgentID'].dtype == object else {'Step': np.int32})
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(parquet_path, table.schema)
+        writer.write_table(table, row_group_size=chunksize)
+    if writer is not None:
+        writer.close()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+*********************
+*** MEMORY BUDGET ***
+*********************
+'''
+#%%
+import os
+import sys
+#%%
+
+'''
+Memory accounting of a running micromodel by component (memory_accounting, in MB):
+    agents              Bicycle objects on the path and in the reuse pool, with their own lists and tuples
+    spatial_index       agent cache of the Mesa ContinuousSpace (estimated from the number of agents, the cache
+                        is private to Mesa) and the neighbour distance matrix of the step
+    recorder            rows buffered by the TrajectoryRecorder (spilled rows are counted in recorder_spilled, on disk)
+    output_conversion   projected size of the agent_pos columns of the buffered rows at the end of the run
+    event_log           column buffers of the ManeuverLog, if any
+    process             resident memory of the process (None if it cannot be determined on this platform)
+The component sizes are estimates from sys.getsizeof of the objects and a sample of the recorded rows;
+they are computed in one pass over the agents and do not walk the recorded rows. micromodel prints the
+accounting at the end of the run and stores the components (without process, which differs between
+otherwise identical runs) in agent_pos.attrs['memory_mb'].
+
+MemoryBudget is passed to micromodel in the list stop_criteria (see convergence.py). Every `every` steps
+it adds the components to the memory the process used before the run; when the sum comes within
+`threshold` of limit_mb, it either spills the recorder buffer to disk (action='spill', the rows are read
+back when agent_pos is built) or ends the run (action='abort'), which returns the trajectories recorded
+so far with the reason in agent_pos.attrs['stop_reason']. If spilling does not bring the run below the
+budget (the agents alone are too large), the run is ended as well. Spilled rows do not count towards the
+budget: the budget bounds the memory of the running model, while agent_pos of all recorded rows is built
+after the run (one spilled chunk at a time, see recording.py). A run whose agent_pos does not fit into
+memory needs a coarser recording profile or a stream (see stream.py) instead.
+'''
+
+
+def process_memory_mb():
+    # resident memory of this process (MB); None if it cannot be determined on this platform
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3  # peak instead of current (kB on Linux)
+    except ImportError:
+        return None
+
+
+def _agent_bytes(agent):
+    # the object and the containers it owns (the agents in its lists are counted on their own)
+    size = sys.getsizeof(agent)
+    for name in type(agent).__slots__:
+        value = getattr(agent, name, None)
+        if isinstance(value, (list, tuple, dict)):
+            size += sys.getsizeof(value)
+    return size
+
+
+# bytes per entry of a dict (estimate for the agent cache of the ContinuousSpace)
+_DICT_ENTRY = (sys.getsizeof(dict.fromkeys(range(1000))) - sys.getsizeof({})) / 1000
+
+
+def _row_bytes(recorder):
+    # one buffered row: the references in the column lists and the values, from the last row
+    return sum(8 + sys.getsizeof(column[-1]) for column in recorder.buffer)
+
+
+def _conversion_bytes(recorder, rows):
+    # agent_pos of `rows` rows: 8 bytes per numeric column, the Position column of lists and its x and y columns
+    numeric = 2 + len([f for f in recorder.fields if f != 'Position'])
+    position = (8 + sys.getsizeof([0.0, 0.0]) + 2 * sys.getsizeof(0.0) + 2 * 8) if 'Position' in recorder.fields else 0
+    return rows * (numeric * 8 + position)
+
+
+def memory_accounting(model):
+    # estimated memory of the components of a running BikeLane model (MB), see the module docstring
+    agents = list(model.schedule.agents) + list(model.pool)
+    # agent cache of the space: two dicts between the agents and their rows and an array of the positions
+    n = len(model.schedule.agents)
+    spatial = 2 * (sys.getsizeof({}) + n * _DICT_ENTRY) + n * 2 * 8
+    if model.neighbor_step >= 0:
+        spatial += model.neighbor_points.nbytes + model.neighbor_dists.nbytes + sys.getsizeof(model.neighbor_index)
+    recorder = model.recorder
+    rows = recorder.rows
+    report = {'agents': sum(_agent_bytes(a) for a in agents) / 1e6,
+              'spatial_index': spatial / 1e6,
+              'recorder': (sum(sys.getsizeof(c) for c in recorder.buffer) + (rows * _row_bytes(recorder) if rows > 0 else 0)) / 1e6,
+              'recorder_spilled': recorder.spilled_bytes / 1e6,
+              'output_conversion': _conversion_bytes(recorder, rows) / 1e6,
+              'event_log': model.event_log.nbytes() / 1e6 if model.event_log is not None else 0.0,
+              'process': process_memory_mb()}
+    return report
+
+
+class MemoryBudget:
+
+    def __init__(self, limit_mb,  # memory budget of the run (MB), including what the process used before the run
+                 action = 'spill',  # 'spill' the recorder buffer to disk or 'abort' the run when the budget is approached
+                 threshold = 0.9,  # share of limit_mb at which the action is taken
+                 every = 20,  # steps between two checks
+                 spill_dir = None):  # directory of the spilled rows; None uses the temporary directory
+        if action not in ('spill', 'abort'):
+            raise ValueError("Unknown action {}, choose from ['spill', 'abort']".format(action))
+        self.limit_mb = limit_mb
+        self.action = action
+        self.threshold = threshold
+        self.every = every
+        self.spill_dir = spill_dir
+        self.reset()
+
+    def reset(self):
+        # state of a run; micromodel resets the monitors before the first step
+        self.baseline_mb = None  # memory of the process before the run
+        self.report = None  # latest accounting
+        self.peak_mb = 0.0
+        self.spills = 0
+
+    def cache_key(self):
+        # configuration hashed into the stage keys of pipeline.py; spill_dir does not change the result
+        return {'limit_mb': self.limit_mb, 'action': self.action, 'threshold': self.threshold, 'every': self.every}
+
+    def used_mb(self, report):
+        # baseline plus the run components; spilled rows are on disk and do not count
+        return (self.baseline_mb + report['agents'] + report['spatial_index'] + report['recorder'] + report['event_log']
+                + report['output_conversion'])
+
+    def update(self, model, dt):
+        if self.baseline_mb is None:  # first step of a run
+            self.baseline_mb = process_memory_mb() or 0.0
+        if model.time_step % self.every != 0:
+            return None
+        self.report = memory_accounting(model)
+        used = self.used_mb(self.report)
+        self.peak_mb = max(self.peak_mb, used)
+        if used < self.threshold * self.limit_mb:
+            return None
+        if self.action == 'spill' and model.recorder.rows > 0:
+            model.recorder.spill(self.spill_dir)
+            self.spills += 1
+            self.report = memory_accounting(model)
+            used = self.used_mb(self.report)
+            if used < self.threshold * self.limit_mb:
+                return None
+        return "memory budget of {} MB reached at {} s ({:.0f} MB)".format(self.limit_mb, model.time_step * dt, used)
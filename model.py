@@ -10,11 +10,19 @@
 from mesa import Agent, Model
 from mesa.time import SimultaneousActivation
 from mesa.space import ContinuousSpace
-from mesa.datacollection import DataCollector
 from datetime import datetime
 import pandas as pd
+import numpy as np
+from obstacles import LateralProfile, StaticBlocker, bottleneck_profile
+from recording import TrajectoryRecorder
+from memory_budget import memory_accounting
+from stream import SimulationStream, StepSnapshot
+from parallel_decisions import ThreadedActivation
+from perception import perceive
+from bisect import bisect_right
 import random
 import math
+from statistics import NormalDist
 import sys
 #%%
 
@@ -44,7 +52,17 @@ def micromodel(seed = 4,  # random seed
                lookback = 1,  # proportion of cyclists looking back before moving laterally [0,1]
                side_obstacle = 0.2,  # width deducted from both sides of the extended path to simulate obstacles (m)
                data_filename = "simulation_data",  # type 0 if file should not be saved
-               demand_input = 'stochastic'):
+               demand_input = 'stochastic',
+               compact_output = False,  # True returns a CompactTrajectory (see trajectory.py) instead of the data frame, 'delta' also delta encodes x
+               obstacles = None,  # LateralProfile (see obstacles.py) with static obstacles; an active bottleneck_width is added to it
+               stop_criteria = None,  # list of monitors (see convergence.py) that can end the run before the duration
+               monitors = None,  # list of observers updated after every step that never end the run (e.g. safety.SafetyMonitor, live_metrics.LiveMetrics)
+               recording = 'full',  # recording profile (see recording.py): 'full', 'space_time', 'fd', 'none' or dict with fields, interval (s) and window (m)
+               detectors = None,  # list of LoopDetector (see detectors.py) that record the passages at their positions
+               event_log = None,  # ManeuverLog (see events.py) that records the overtaking episodes
+               common_random_numbers = False,  # True draws arrivals and cyclist attributes from streams of (seed, cyclist), shared by scenarios with the same seed (see paired.py)
+               threads = 0,  # threads of the decision phase of a step (see parallel_decisions.py); 0 runs it serially
+               stream = False):  # True returns a SimulationStream of one StepSnapshot per step (see stream.py) instead of running the whole run
     
     ''' 
     **********************
@@ -55,6 +73,14 @@ def micromodel(seed = 4,  # random seed
     # We assume that bicycles are generated with a same interval (uniformly distributed) according to the demand.
     path_width += 1
     random.seed(seed)  # set the seed
+    
+    # common random numbers: the arrivals and every cyclist have their own stream with a fixed number of draws, so that
+    # parameters that change the number of draws (e.g. v0_sd in the truncation loop) do not shift the draws of others
+    arrivals = random.Random("{}:arrivals".format(seed)) if common_random_numbers else random
+    def cyclist_draws(unique_id):
+        rng = random.Random("{}:{}".format(seed, unique_id))
+        return [rng.random() for k in range(4)]  # desired speed, desired lateral position, look-back, entry position
+    trunc = NormalDist().cdf(-2)  # share of the gaussian below -2 sd
     time_steps = int(duration/dt)
     inflow_step = []  # time points that bicycles enter the bike lane
     
@@ -87,11 +113,40 @@ def micromodel(seed = 4,  # random seed
             probability = demand[i]/(time_steps/splits)
             print(probability)
             for j in range(int(time_steps/splits)):
-                rng = random.random()
+                rng = arrivals.random()
                 if rng < probability:
                     inflow_step.append(0 + int(time_steps/splits) * i + j)
         print(inflow_step, len(inflow_step))
 
+    ''' 
+    ************************
+    *** STATIC OBSTACLES ***
+    ************************
+    '''
+    
+    # obstacles are precomputed lateral profiles queried by the level functions, they are not agents
+    obstacles = LateralProfile() if obstacles is None else obstacles.copy()
+    if bottleneck_width in [1.0,1.5,2.0]:
+        print("Bottleneck is active with {} m".format(bottleneck_width))
+        bottleneck_profile(bottleneck_width, path_width-1, b_length, b_width, profile=obstacles)
+
+    ''' 
+    *****************
+    *** DETECTORS ***
+    *****************
+    '''
+    
+    # sorted by position, so that the detectors passed in a step are found by bisection
+    detectors = sorted(detectors or [], key=lambda d: d.x)
+    detector_x = [d.x for d in detectors]
+    for d in detectors:
+        d.reset()
+    if event_log is not None:
+        event_log.reset()
+    for monitor in (stop_criteria or []) + (monitors or []):
+        if hasattr(monitor, 'reset'):  # e.g. the blocks of convergence.Stationary
+            monitor.reset()
+
     ''' 
     *******************
     *** AGENT CLASS ***
@@ -100,6 +155,14 @@ def micromodel(seed = 4,  # random seed
     
     class Bicycle(Agent):
         
+        # the attributes of the cyclist are stored in slots. mesa.Agent has no __slots__, so instances still have a __dict__
+        # (empty, created on first access); measured with tracemalloc on Python 3.11: 1310 instead of 2550 bytes per new cyclist
+        __slots__ = ('unique_id', 'model', 'pos', 'length', 'width', 'v0', 'p', 'a_des', 'b_max', 'omega_max', 'omega_des', 'd_omega_max',
+                     'alpha', 'beta', 'gamma', 'phi', 'overtake', 'speed', 'acceleration', 'v_lat', 'v_lat_prev', 'next_speed', 'restr_lat_speed',
+                     'hyp_angle', 'next_coords', 'sr_length', 'sr_width', 'cr_length', 'cat1_cyclists', 'cat12_cyclists', 'cat3_behind',
+                     'all_lateral', 'blocked_space_indiv', 'des_lat_pos', 'trajectory', 'leader', 'leader_details', 'cut_off_flag', 'do_look_back',
+                     'chosen_gap', 'tally')
+        
         ''' 
         ************************************
         *** INITIALIZATION AND VARIABLES ***
@@ -108,7 +171,19 @@ def micromodel(seed = 4,  # random seed
         
         def __init__(self, unique_id, model):
             super().__init__(unique_id, model)
-            
+            self.tally = model  # receives the model writes of step(): the model, or a StepTally in the threaded decision phase (see parallel_decisions.py)
+            # auxiliary lists, refilled in place every step and kept when the object is reused (see BikeLane.new_bicycle)
+            self.cat1_cyclists = []  # list of significantly slower cyclists in consideration range
+            self.cat12_cyclists = []  # list of slightly slower cyclists in consideration range
+            self.cat3_behind = []  # list of faster cyclists in the backward view
+            self.all_lateral = [] # list of cyclists in the forward view to prevent lateral collision with
+            self.blocked_space_indiv = []  # auxiliary list used across level 1 and 2
+            self.trajectory = []  # list including the coordinates for the desired path (therefore also implicitly the moving angle)
+            self.leader_details = []
+            self.reset(unique_id)
+        
+        # (re)initialize a new cyclist; also used for recycled objects of cyclists that finished their trip
+        def reset(self, unique_id):
             # Fixed attributes
             self.unique_id = unique_id
             self.length = b_length  # bicycle length
@@ -117,10 +192,15 @@ def micromodel(seed = 4,  # random seed
             # self.v0 = random.uniform(v0_mean-v0_sd, v0_mean+v0_sd)  # distribution of desired lateral position
             # self.v0 = random.triangular(v0_mean-v0_sd, v0_mean+v0_sd, v0_mean)
             # truncate gaussian distribution at +- 2 sd
-            self.v0 = 0
-            while (self.v0 < v0_mean-2*v0_sd) or (self.v0 > v0_mean+2*v0_sd):
-                self.v0 = random.gauss(v0_mean, v0_sd)
-            self.p = random.uniform(p_mean-p_sd, p_mean+p_sd)  # distribution of desired lateral position
+            if common_random_numbers:  # inverse transform of the cyclist's own draws: a faster cyclist stays faster when v0_sd changes
+                u_v0, u_p, u_look, u_entry = cyclist_draws(unique_id)
+                self.v0 = NormalDist(v0_mean, v0_sd).inv_cdf(trunc + u_v0*(1-2*trunc)) if v0_sd > 0 else v0_mean
+                self.p = p_mean-p_sd + u_p*2*p_sd
+            else:
+                self.v0 = 0
+                while (self.v0 < v0_mean-2*v0_sd) or (self.v0 > v0_mean+2*v0_sd):
+                    self.v0 = random.gauss(v0_mean, v0_sd)
+                self.p = random.uniform(p_mean-p_sd, p_mean+p_sd)  # distribution of desired lateral position
             self.a_des = a_des  # feasible relaxation time for acceleration
             self.b_max = b_max  # m/s**2 maximum braking force (positive value)
             
@@ -149,17 +229,18 @@ def micromodel(seed = 4,  # random seed
             self.sr_width = self.width/2 + 0.1 + self.v0*self.beta  # width of the safety region
             self.cr_length = 4 + self.v0*self.phi  # consideration range length
             # auxiliary variables
-            self.cat1_cyclists = []  # list of significantly slower cyclists in consideration range
-            self.cat12_cyclists = []  # list of slightly slower cyclists in consideration range
-            self.cat3_behind = []  # list of faster cyclists in the backward view
-            self.all_lateral = [] # list of cyclists in the forward view to prevent lateral collision with
-            self.blocked_space_indiv = []  # auxiliary list used across level 1 and 2
+            self.cat1_cyclists.clear()
+            self.cat12_cyclists.clear()
+            self.cat3_behind.clear()
+            self.all_lateral.clear()
+            self.blocked_space_indiv.clear()
             self.des_lat_pos = 0  # desired lateral position
-            self.trajectory = []  # list including the coordinates for the desired path (therefore also implicitly the moving angle)
+            self.trajectory.clear()
             self.leader = 0  # variable to save leading cyclist's object id
-            self.leader_details = []
+            self.leader_details.clear()
             self.cut_off_flag = False  # True if cyclist would cut-off somebody else
-            if random.random() <= lookback:
+            self.chosen_gap = None  # (right, left) border of the lateral gap chosen for overtaking
+            if (u_look if common_random_numbers else random.random()) <= lookback:
                 self.do_look_back = True
             else:
                 self.do_look_back = False
@@ -184,24 +265,71 @@ def micromodel(seed = 4,  # random seed
         '''
         
         
+        # the cyclists in the ranges below are found for all agents of the step at once, see perception.py
         def findCat1(self):
-            neighbors = self.model.space.get_neighbors(self.pos,self.cr_length+10,False) # add 10 metres so that the circular radius does not matter anymore
-            leaders = [l for l in neighbors if l.getPos()[0] > self.pos[0] and l.getPos()[0] < (self.pos[0]+self.cr_length)] # obtain cyclists in consideration range
-            self.cat1_cyclists = [l for l in leaders if l.getSpeed() <= (self.gamma*self.v0)] # obtain cat1 cyclists
+            self.cat1_cyclists.clear()
+            self.cat1_cyclists.extend(self.model.perceived(self, 'cat1')) # obtain cat1 cyclists in consideration range
+            self.cat1_cyclists += obstacles.blockers(self.pos[0], self.pos[0]+self.cr_length, self.pos[1], self.width) # static obstacles behave like standing cyclists
         
         def findCat12(self):
-            neighbors = self.model.space.get_neighbors(self.pos,self.cr_length+10,False) # add 10 metres so that the circular radius does not matter anymore
-            leaders = [l for l in neighbors if l.getPos()[0] > self.pos[0] and l.getPos()[0] < (self.pos[0]+self.cr_length)] # obtain cyclists in consideration range
-            self.cat12_cyclists = [l for l in leaders if l.getSpeed() <= (self.v0)] # obtain cat1 and cat2 cyclists
+            self.cat12_cyclists.clear()
+            self.cat12_cyclists.extend(self.model.perceived(self, 'cat12')) # obtain cat1 and cat2 cyclists in consideration range
+            self.cat12_cyclists += obstacles.leaders(self.pos[0], self.pos[0]+self.cr_length, self.pos[1], self.width, self.des_lat_pos, self.getSpeed(), self.omega_max) # obstacles ahead that cannot be avoided laterally
         
         def findCat3Behind(self):  # not really cat 3 but the cyclists that are currently faster than you are
-            neighbors = self.model.space.get_neighbors(self.pos,20,False)
-            followers = [l for l in neighbors if l.getPos()[0] < self.pos[0] and l.getPos()[0] > (self.pos[0]-20)] # obtain cyclists in backward view
-            self.cat3_behind = [l for l in followers if l.getSpeed() > (self.getSpeed())] # obtain cat3 cyclists
+            self.cat3_behind.clear()
+            self.cat3_behind.extend(self.model.perceived(self, 'behind')) # obtain faster cyclists in backward view (20 m)
+        
+        # same shape filters as the leader search in findTraj, for a single cyclist (same expressions, on local copies of the positions)
+        def isPotentialLeader(self, i, obstructing):
+            if self.cut_off_flag == False and i in obstructing:
+                return False
+            x, y = self.pos
+            xi, yi = i.pos
+            if self.des_lat_pos-y >= 0:  # move to the left
+                if not (yi >= y-(self.width) and yi <= self.des_lat_pos+(self.width)):
+                    return False
+                if self.speed > 0.5 and not yi <= (y+self.width)+(self.omega_max/self.speed)*(xi-x):
+                    return False
+            if self.des_lat_pos-y < 0:  # move to the right
+                if not (yi <= y+(self.width) and yi >= self.des_lat_pos-(self.width)):
+                    return False
+                if self.speed > 0.5 and not yi >= (y-self.width)-(self.omega_max/self.speed)*(xi-x):
+                    return False
+            return True
+        
+        # True if the leader of the previous step is still a potential leader and no other potential leader is as close;
+        # static obstacles are new objects every step and always go through the full search.
+        # Only the cyclists at the leader's distance or closer go through the shape filters: they move laterally
+        # every step, so they are re-checked even if nobody entered or left the consideration range
+        def keepLeader(self, leader, obstructing):
+            if leader == 0 or leader not in self.cat12_cyclists or not self.isPotentialLeader(leader, obstructing):
+                return False
+            x = leader.pos[0]
+            if x >= self.pos[0]+self.cr_length:
+                return False
+            for i in self.cat12_cyclists:
+                if i.pos[0] <= x and i is not leader and self.isPotentialLeader(i, obstructing):
+                    return False
+            return True
         
         def findAllLateral(self):  # all cyclists in the lateral collision prevention zone
-            neighbors = self.model.space.get_neighbors(self.pos,self.cr_length+10,False)
-            self.all_lateral = [l for l in neighbors if l.getPos()[0] >= self.pos[0] and l.getPos()[0] < (self.pos[0]+self.sr_length)] # obtain cyclists in the lateral collision prevention zone
+            self.all_lateral.clear()
+            self.all_lateral.extend(self.model.perceived(self, 'lateral')) # obtain cyclists in the lateral collision prevention zone
+            self.all_lateral += obstacles.blockers(self.pos[0], self.pos[0]+self.sr_length, self.pos[1], self.width)
+        
+        # desired lateral position limited to the usable path width (between the side obstacles)
+        def clampLat(self, y):
+            return min(max(y, side_obstacle+self.width/2), path_width-side_obstacle-self.width/2)
+        
+        # lateral position limited to the path (the centre of the cyclist does not enter the 0.5 m spaces on the sides);
+        # only applied with static obstacles, runs without them are unchanged
+        def clampPos(self, y):
+            return min(max(y, 0.5), path_width-0.5)
+        
+        # lateral speed of a cyclist halted in front of an obstacle: on the spot towards the desired lateral position, without overshooting it
+        def standingLatSpeed(self):
+            return max(min((self.des_lat_pos-self.pos[1])/dt, self.omega_des), -self.omega_des)
 
         ''' 
         ************************
@@ -211,27 +339,35 @@ def micromodel(seed = 4,  # random seed
         
         # Calculate and update the attributes in the next step
         def calPos(self): 
-            if isinstance(self.unique_id, str):  # exclude cyclists from virtual bottleneck from calculations and updating
-                self.speed, self.acceleration, self.v_lat = 0, 0, 0
             if self.speed*dt + self.acceleration*dt <= 0:
                 self.acceleration = -self.speed
             self.next_coords = (self.pos[0] + self.speed*dt + self.acceleration*0.5*dt**2, self.pos[1] + self.v_lat*dt)  # new x and y position values
+            if len(obstacles) > 0:  # static obstacles cannot be passed through: the cyclist stops in front of them
+                lat_pos = self.clampPos(self.next_coords[1])
+                if lat_pos != self.next_coords[1]:  # lateral movement ends at the side of the path
+                    self.v_lat = (lat_pos-self.pos[1])/dt
+                    self.next_coords = (self.next_coords[0], lat_pos)
+                next_coords = obstacles.clamp(self.pos, self.next_coords, self.length, self.width)
+                if next_coords[1] != self.next_coords[1]:
+                    self.v_lat = 0
+                if next_coords[0] < self.next_coords[0]:
+                    self.acceleration = -self.speed/dt
+                self.next_coords = next_coords
             if self.overtake == True:
-                self.model.sum_lat_dist += abs(self.v_lat*dt)
+                self.tally.lateral(self, abs(self.v_lat*dt))
         
         # Determine and update the next speed
         def calSpeed(self):
-            if isinstance(self.unique_id, str):  # exclude cyclists from virtual bottleneck from calculations and updating
-                self.speed, self.acceleration, self.v_lat = 0, 0, 0
             self.next_speed = self.speed + self.acceleration * dt # apply acceleration from ndm
         
         def calLatSpeed(self):
+            lat_speed = self.next_speed * self.hyp_angle if self.speed > 0 else self.standingLatSpeed()  # cyclists halted in front of an obstacle steer on the spot
             if self.restr_lat_speed == 0:
                 self.v_lat = 0
             elif self.restr_lat_speed != 0 and self.v_lat > 0:
-                self.v_lat = min(self.next_speed * self.hyp_angle, self.restr_lat_speed)
+                self.v_lat = min(lat_speed, self.restr_lat_speed)
             else:
-                self.v_lat = max(self.next_speed * self.hyp_angle, self.restr_lat_speed)
+                self.v_lat = max(lat_speed, self.restr_lat_speed)
         
         def updateCR(self):
             self.cr_length = 4 + self.phi*self.next_speed
@@ -249,7 +385,7 @@ def micromodel(seed = 4,  # random seed
         ''' LEVEL 1: Desired lateral position '''
         def findLatPos(self): 
             if self.unique_id==check_cyclist_id: print("\n****** LEVEL 1: LATERAL POSITION ******")
-            self.model.num_all_decision += 1
+            self.tally.num_all_decision += 1
             # find cat1 cyclists in consideration range
             self.findCat1()
             # if there is no cat. 1 cyclist in the consideration range
@@ -259,13 +395,16 @@ def micromodel(seed = 4,  # random seed
                 if self.unique_id==check_cyclist_id: print("No cat. 1 leader, des_lat_pos={}".format(round(self.des_lat_pos,2)))
             else:
                 self.overtake = True
-                self.model.num_decision = self.model.num_decision + 1
-                self.blocked_space_indiv = []  # empty list the touples with lateral positions of cat1 cyclists
+                self.tally.num_decision += 1
+                self.blocked_space_indiv.clear()  # empty list the touples with lateral positions of cat1 cyclists
                 unblocked_space = []  # will contain the borders and width of the lateral gap(s)
                 
                 # obtain lateral positions blocked by cat. 1 cyclists in consideration range
                 for i in self.cat1_cyclists:
-                    self.blocked_space_indiv.append((i, i.getPos()[1]-self.width/2, i.getPos()[1]+self.width/2))  # change 0.4 to the actual width including stabilization
+                    if isinstance(i, StaticBlocker):  # static obstacles block their whole lateral extent in the consideration range
+                        self.blocked_space_indiv.append((i, i.low, i.high))
+                    else:
+                        self.blocked_space_indiv.append((i, i.getPos()[1]-self.width/2, i.getPos()[1]+self.width/2))  # change 0.4 to the actual width including stabilization
                     
                 self.blocked_space_indiv.sort(key=lambda a: a[2], reverse=True)  # sort cyclists from left to right                
                 
@@ -277,6 +416,7 @@ def micromodel(seed = 4,  # random seed
                     if len(self.blocked_space_indiv)==0:
                         unblocked_space.append([path_width-side_obstacle,side_obstacle,path_width-2*side_obstacle])
                         self.des_lat_pos = self.p
+                        self.chosen_gap = (side_obstacle, path_width-side_obstacle)
                         break
                     
                     # find gaps/unblocked spaces between cyclists
@@ -294,21 +434,40 @@ def micromodel(seed = 4,  # random seed
                     for i in unblocked_space:
                         if i[2] >= 2*self.sr_width:
                             self.des_lat_pos = i[1]+self.sr_width
+                            self.chosen_gap = (i[1], i[0])
                             gap_found = True
                             break
                     if gap_found==True:
                         break
                     
+                    # if only static obstacles are left, there is no way around them: squeeze through the widest gap
+                    if all(isinstance(i[0], StaticBlocker) for i in self.blocked_space_indiv):
+                        widest_gap = max(unblocked_space, key=lambda a: a[2])
+                        self.des_lat_pos = widest_gap[1]+widest_gap[2]/2
+                        self.chosen_gap = (widest_gap[1], widest_gap[0])
+                        break
+                    
                     # remove cyclist the furthest downstream if no gap is found
                     furthest_agent_pos = 0
                     furthest_agent = ...
                     for i in range(len(self.blocked_space_indiv)):
+                        if isinstance(self.blocked_space_indiv[i][0], StaticBlocker):  # obstacles cannot be removed
+                            continue
                         if self.blocked_space_indiv[i][0].getPos()[0] > furthest_agent_pos:
                             furthest_agent_pos = self.blocked_space_indiv[i][0].getPos()[0]
                             furthest_agent = i
                     
                     # delete furthest downstream cyclist from the list of blocking cyclists
                     del self.blocked_space_indiv[furthest_agent]
+                
+                # keep the own width clear of static obstacles (the gaps above are sized for the safety region only)
+                for i in self.blocked_space_indiv:
+                    if isinstance(i[0], StaticBlocker) and i[1] < self.des_lat_pos+self.width/2 and i[2] > self.des_lat_pos-self.width/2:
+                        if (i[1]+i[2])/2 > self.des_lat_pos:
+                            self.des_lat_pos = i[1]-self.width/2-d_standing
+                        else:
+                            self.des_lat_pos = i[2]+self.width/2+d_standing
+                        self.des_lat_pos = self.clampLat(self.des_lat_pos)
                 if self.unique_id==check_cyclist_id: print("Cat. 1 present, des_lat_pos={}".format(round(self.des_lat_pos,2)))
     
         ''' LEVEL 2: Moving angle and leader '''
@@ -365,11 +524,7 @@ def micromodel(seed = 4,  # random seed
                         v1 = self.v0
                         p2 = obstr_cyclists[i].getPos()[0]
                         v2 = obstr_cyclists[i].getSpeed()
-                        time_to_pass = 10000
-                        if isinstance(self.unique_id, str):
-                            time_to_pass = 10000
-                        else:
-                            time_to_pass = (p2-p1)/(v1-v2)
+                        time_to_pass = (p2-p1)/(v1-v2)
                         dist_to_pass = v1*time_to_pass
                         
                         # calculate lateral passing point
@@ -389,7 +544,9 @@ def micromodel(seed = 4,  # random seed
                             steepest_angle_temp = obstr_cyclists[i][1]
                     
                     # actually required lateral speed
-                    if req_lat_move < 0:
+                    if self.getSpeed() == 0:  # halted in front of an obstacle: shift on the spot
+                        self.v_lat = self.standingLatSpeed()
+                    elif req_lat_move < 0:
                         self.v_lat = -(self.getSpeed()*math.tan(steepest_angle_temp))
                     else:
                         self.v_lat = (self.getSpeed()*math.tan(steepest_angle_temp))
@@ -411,7 +568,7 @@ def micromodel(seed = 4,  # random seed
                         self.v_lat = 0
                         self.cut_off_flag = True
                 
-                lateral_neighbors = self.model.space.get_neighbors(self.pos,self.length,False)
+                lateral_neighbors = self.model.perceived(self, 'close')  # cyclists within the own length
                 if req_lat_move <= 0:
                     lateral_neighbors = [l for l in lateral_neighbors if l.getPos()[1] < self.getPos()[1]]
                 else:
@@ -443,7 +600,7 @@ def micromodel(seed = 4,  # random seed
                 self.v_lat = -self.omega_max
                 self.cut_off_flag = True            
             
-            self.hyp_angle = self.v_lat / self.speed
+            self.hyp_angle = self.v_lat / self.speed if self.speed > 0 else 0  # cyclists can come to a halt in front of obstacles
             
             if self.unique_id==check_cyclist_id: print("Max_speed_left={}, max_speed_right={}".format(round(max_speed_left,2), round(max_speed_right,2)))
             if self.unique_id==check_cyclist_id: print("Cat. 1 present, v_lat={}".format(round(self.v_lat,2)))
@@ -453,6 +610,7 @@ def micromodel(seed = 4,  # random seed
             # find the leader
             self.findCat12() # get slower cyclists in front
             potential_leaders = []
+            previous_leader = self.leader
             self.leader = 0
             if len(self.cat12_cyclists)==0: # if there is no leader
                 self.leader = 0
@@ -462,29 +620,36 @@ def micromodel(seed = 4,  # random seed
                 for i in obstr_cyclists:
                     del_from_pot_lead.append(i[0])
                 if self.unique_id==check_cyclist_id: print("Obstr_cyclists: ", [i.unique_id for i in del_from_pot_lead])
-                if self.cut_off_flag == False:
-                    potential_leaders = list(set(self.cat12_cyclists) - set(del_from_pot_lead))
+                
+                # keep the leader of the previous step if it is still the closest potential leader (same result as the full search)
+                self.tally.leader_queries += 1
+                if self.keepLeader(previous_leader, del_from_pot_lead):
+                    self.leader = previous_leader
+                    self.tally.leader_hits += 1
                 else:
-                    potential_leaders = self.cat12_cyclists
+                    if self.cut_off_flag == False:
+                        potential_leaders = list(set(self.cat12_cyclists) - set(del_from_pot_lead))
+                    else:
+                        potential_leaders = self.cat12_cyclists
                 
-                if self.des_lat_pos-self.getPos()[1] >= 0:  # move to the left
-                    potential_leaders = [i for i in potential_leaders if i.getPos()[1] >= self.getPos()[1]-(self.width) and i.getPos()[1] <= self.des_lat_pos+(self.width)]
-                    if self.getSpeed() > 0.5:
-                        potential_leaders = [i for i in potential_leaders if i.getPos()[1] <= (self.getPos()[1]+self.width)+(self.omega_max/self.getSpeed())*(i.getPos()[0]-self.getPos()[0])]
-                if self.des_lat_pos-self.getPos()[1] < 0:  # move to the right
-                    potential_leaders = [i for i in potential_leaders if i.getPos()[1] <= self.getPos()[1]+(self.width) and i.getPos()[1] >= self.des_lat_pos-(self.width)]
-                    if self.getSpeed() > 0.5:
-                        potential_leaders = [i for i in potential_leaders if i.getPos()[1] >= (self.getPos()[1]-self.width)-(self.omega_max/self.getSpeed())*(i.getPos()[0]-self.getPos()[0])]
+                    if self.des_lat_pos-self.getPos()[1] >= 0:  # move to the left
+                        potential_leaders = [i for i in potential_leaders if i.getPos()[1] >= self.getPos()[1]-(self.width) and i.getPos()[1] <= self.des_lat_pos+(self.width)]
+                        if self.getSpeed() > 0.5:
+                            potential_leaders = [i for i in potential_leaders if i.getPos()[1] <= (self.getPos()[1]+self.width)+(self.omega_max/self.getSpeed())*(i.getPos()[0]-self.getPos()[0])]
+                    if self.des_lat_pos-self.getPos()[1] < 0:  # move to the right
+                        potential_leaders = [i for i in potential_leaders if i.getPos()[1] <= self.getPos()[1]+(self.width) and i.getPos()[1] >= self.des_lat_pos-(self.width)]
+                        if self.getSpeed() > 0.5:
+                            potential_leaders = [i for i in potential_leaders if i.getPos()[1] >= (self.getPos()[1]-self.width)-(self.omega_max/self.getSpeed())*(i.getPos()[0]-self.getPos()[0])]
                 
-                if len(potential_leaders) != 0:
-                    # obtain closest of those inside the shape
-                    closest_pos = self.getPos()[0]+self.cr_length # start finding closest leader in consideration range
-                    for i in potential_leaders: # find the closest potential leader
-                        if i.getPos()[0] < closest_pos:
-                            self.leader = i
-                            closest_pos = i.getPos()[0]
-                else:
-                    self.leader = 0
+                    if len(potential_leaders) != 0:
+                        # obtain closest of those inside the shape
+                        closest_pos = self.getPos()[0]+self.cr_length # start finding closest leader in consideration range
+                        for i in potential_leaders: # find the closest potential leader
+                            if i.getPos()[0] < closest_pos:
+                                self.leader = i
+                                closest_pos = i.getPos()[0]
+                    else:
+                        self.leader = 0
             
             if self.unique_id==check_cyclist_id: print("Cut_off_flag={}".format(self.cut_off_flag))
             if self.unique_id==check_cyclist_id and self.leader!=0: print("Direct leader {}".format(self.leader.unique_id))
@@ -492,6 +657,7 @@ def micromodel(seed = 4,  # random seed
             
             ''' Check lateral collision '''
             restr_lat_speed = self.omega_max
+            restricted = False  # True if a cyclist in the prevention zone restricted the lateral speed in this step
             self.findAllLateral() # get all cyclists in the prevention zone
             for i in self.all_lateral:
                 if (i.getPos()[1]-self.getPos()[1])*self.v_lat > 0: # on the side of the moving angle
@@ -499,13 +665,19 @@ def micromodel(seed = 4,  # random seed
                         restr_lat_speed = (abs(i.getPos()[1]-self.getPos()[1]) - self.sr_width) / dt
                         if self.v_lat > 0 and self.v_lat > restr_lat_speed:
                             self.restr_lat_speed = restr_lat_speed
+                            restricted = True
                         elif self.v_lat < 0 and self.v_lat < (-1) * restr_lat_speed:
                             self.restr_lat_speed = (-1) * restr_lat_speed
+                            restricted = True
                         else:
                             pass
                     else:
                         self.restr_lat_speed = 0
+                        restricted = True
                         break
+            # a cyclist held up by a static obstacle steers around it (otherwise only lateral neighbours release the lateral speed)
+            if isinstance(self.leader, StaticBlocker) and not restricted:
+                self.restr_lat_speed = self.v_lat if self.speed > 0 else self.standingLatSpeed()
             
             
         ''' LEVEL 3: Acceleration according to NDM '''
@@ -558,8 +730,14 @@ def micromodel(seed = 4,  # random seed
         def step(self):
             ''' CALL LEVEL FUNCTIONS '''                
             if self.unique_id==check_cyclist_id: print("active\n(v0={}, p={})".format(round(self.v0,2),round(self.p,2)))
+            overtaking, leader = self.overtake, self.leader  # state before the decisions, for the event log
             self.findLatPos() # level 1: lateral position
             self.findTraj() # level 2: moving angle and leader
+            if event_log is not None and self.overtake != overtaking:
+                if self.overtake:
+                    self.tally.start_episode(self, leader)
+                else:
+                    self.tally.end_episode(self)
             self.findAcc() # level 3: accelerations
             
             ''' CALL UPDATE FUNCTIONS '''
@@ -574,6 +752,11 @@ def micromodel(seed = 4,  # random seed
             
         # Take (physical) actions, this function would be called automatically after the step() function
         def advance(self):
+            # record the passages at the detectors between the old and the new position, interpolated within the step
+            for i in range(bisect_right(detector_x, self.pos[0]), bisect_right(detector_x, self.next_coords[0])):
+                frac = (detector_x[i] - self.pos[0]) / (self.next_coords[0] - self.pos[0])
+                detectors[i].record((self.model.time_step + frac) * dt, self.unique_id, self.speed + frac * (self.next_speed - self.speed),
+                                    self.pos[1] + frac * (self.next_coords[1] - self.pos[1]))
             self.model.space.move_agent(self,self.next_coords) # update on the canvas
             self.pos = (self.next_coords[0],self.next_coords[1]) # update self attributes
             self.speed = self.next_speed
@@ -589,7 +772,7 @@ def micromodel(seed = 4,  # random seed
     class BikeLane(Model):
         def __init__(self):
             super().__init__()
-            self.schedule = SimultaneousActivation(self)
+            self.schedule = SimultaneousActivation(self) if threads == 0 else ThreadedActivation(self, threads)
             
             self.space = ContinuousSpace(300.1, path_width, torus=True) # Changed the torus=False here: otherwise, there will be an error because agents are 'out of bounds'
             
@@ -599,38 +782,66 @@ def micromodel(seed = 4,  # random seed
             self.n_agents = 0  # Current number of agents (bicycles) on the entire bike lane
             self.initial_coords = (0,1)
             self.to_be_removed = [] # A list storing bicycles which finish the trip at the time step and to be removed
+            self.n_finished = 0 # number of bicycles which finished the trip
+            self.pool = [] # objects of bicycles which finished the trip, reused for the next inflow
+            self.demand_done = len(inflow_step) == 0 # True when all bicycles of the demand have entered
             
             self.num_all_decision = 0
             self.num_decision = 0 # counters for overtaking decisions
             self.sum_lat_dist = 0 # sum of lateral distance
+            self.leader_queries = 0
+            self.leader_hits = 0 # leader searches answered by the leader of the previous step, see Bicycle.keepLeader
+            self.obstacles = obstacles # static obstacles (bottleneck), see obstacles.py
+            self.event_log = event_log # ManeuverLog or None, see events.py
+            self.neighbor_step = -1 # step of the current neighbour distance matrix and perception, see perception.py
             
-            # Add virtual bicycles for the optional bottleneck
-            if bottleneck_width in [1.0,1.5,2.0]:
-                print("Bottleneck is active with {} m".format(bottleneck_width))
-                # add virtual bicycles at defined positions depending on bottleneck positions
-                virt_positions = []
-                if bottleneck_width == 1.0:
-                    # 4 cyclists
-                    virt_positions = [[254,2.4-(4-path_width)], [253,2.8-(4-path_width)], [252,3.2-(4-path_width)], [251,3.6-(4-path_width)]]
-                elif bottleneck_width == 1.5:
-                    # 3 cyclists
-                    virt_positions = [[253,2.9-(4-path_width)], [252,3.3-(4-path_width)], [251,3.7-(4-path_width)]]
-                else:
-                    # 2 cyclists
-                    virt_positions = [[252,3.4-(4-path_width)], [251,3.8-(4-path_width)]]
-                    
-                for i in range(len(virt_positions)):
-                    b = Bicycle('virtual_bn_{}'.format(i), self)
-                    b_pos = (virt_positions[i][0], virt_positions[i][1])
-                    self.schedule.add(b)
-                    self.space.place_agent(b, b_pos)    
-                    
-            # Data collection functions, collect positions of every bicycle at every step, namely trajectories
-            self.datacollector = DataCollector(agent_reporters={"Position": "pos", "Speed": "speed", "latSpeed": "v_lat", "ID": "unique_id", "desSpeed": "v0", "srLength": "sr_length", "srWidth": "sr_width", "crLength": "cr_length"})  # , "leaderDetails": "leader_details"
+            # Data collection functions, collect positions of every bicycle at every (recorded) step, namely trajectories
+            self.recorder = TrajectoryRecorder(recording, dt)
+            if compact_output and 'Position' not in self.recorder.fields:
+                raise ValueError("compact_output needs the positions, but the recording profile {!r} does not record 'Position'".format(recording))
         
         def deduct(self):
             self.n_agents = self.n_agents - 1
         
+        def new_bicycle(self, unique_id):
+            # reuse the object of a bicycle which finished its trip instead of allocating a new one
+            if len(self.pool) > 0:
+                b = self.pool.pop()
+                b.reset(unique_id)
+                return b
+            return Bicycle(unique_id, self)
+        
+        def update_neighbors(self):
+            # positions, squared (torus) distances and perceived cyclists of all agents, computed once per step: no agent moves
+            # before all agents have decided (SimultaneousActivation); monitors called after the step (e.g. safety.py) share them
+            # with the next step. Replications run together compute them for all models in one pass (see ensemble.py)
+            if self.neighbor_step != self.time_step:
+                perceive([self])
+        
+        # model writes of the decision phase, called through Bicycle.tally
+        def lateral(self, agent, distance):
+            self.sum_lat_dist += distance
+            if event_log is not None:
+                event_log.lateral(agent, distance)
+        
+        def start_episode(self, agent, leader):
+            event_log.start(agent, self.time_step, leader)
+        
+        def end_episode(self, agent):
+            event_log.end(agent, self.time_step)
+        
+        def perceived(self, agent, kind):
+            # cyclists of a kind (see perception.KINDS) perceived by the agent in this step
+            self.update_neighbors()
+            return self.perception[kind][self.neighbor_index[agent]]
+        
+        def get_neighbors(self, agent, radius):
+            # same as self.space.get_neighbors(agent.pos, radius, False), answered from the distance matrix of the step
+            self.update_neighbors()
+            dists = self.neighbor_dists[self.neighbor_index[agent]]
+            (idxs,) = np.nonzero((dists <= radius**2) & (dists > 0))
+            return [self.neighbor_agents[i] for i in idxs.tolist()]
+        
         def step(self):
             # Execute agents' functions, including both step and advance
             self.schedule.step()
@@ -639,22 +850,28 @@ def micromodel(seed = 4,  # random seed
                 #print("Remove Bicycle ",b.unique_id)
                 self.schedule.remove(b)
                 self.space.remove_agent(b)
+                self.n_finished += 1
+                if event_log is not None:
+                    event_log.end(b, self.time_step, completed=False)
+                self.pool.append(b)
             self.deduct() # reduce n_agents by 1
             self.to_be_removed = []
             
             # Add bicycle agents at certain time steps
             if self.inflow_count < len(inflow_step):
                 if self.time_step == inflow_step[self.inflow_count]:
-                    b = Bicycle(self.inflow_count, self)
+                    b = self.new_bicycle(self.inflow_count)
                     self.schedule.add(b)
-                    self.space.place_agent(b, (0,0.5+(random.random()*(path_width-1)))) # self.initial_coords
+                    entry = cyclist_draws(b.unique_id)[3] if common_random_numbers else random.random()
+                    self.space.place_agent(b, (0,0.5+(entry*(path_width-1)))) # self.initial_coords
                     self.inflow_count += 1
                     self.n_agents += 1
+                    self.demand_done = self.inflow_count == len(inflow_step)
             # Update the time
             self.time_step += 1
             print("\n\n\nStep {}, cyclist {}".format(self.time_step,check_cyclist_id))  # review steps in console
             # Execute data collector
-            self.datacollector.collect(self)
+            self.recorder.collect(self)
     
     
     '''
@@ -664,21 +881,74 @@ def micromodel(seed = 4,  # random seed
     '''
     
     model = BikeLane()
-    for i in range(time_steps):  # simulation time steps
-        model.step()
-    print('-------------------------------------------')
-    print('num_decision: ',model.num_all_decision)
-    print('num_overtake: ',model.num_decision)
-    print('avg_overtake: ',model.num_decision/model.num_all_decision)
-    print('sum_lat_dist: ',model.sum_lat_dist)
-    print('avg_lat_dist: ',model.sum_lat_dist/model.num_decision)
-    print('-------------------------------------------')
     
-    agent_pos = model.datacollector.get_agent_vars_dataframe()
-    agent_pos = agent_pos.reset_index(level=[0,1]) # reset index to make column callable
-    agent_pos['Position'] = agent_pos['Position'].apply(lambda pos: list(pos))
-    agent_pos[['Position_x', 'Position_y']] = pd.DataFrame(agent_pos['Position'].tolist(), index=agent_pos.index)
-    if type(data_filename) is str:
-        agent_pos.to_csv("data/" + data_filename + datetime.now().strftime("_%Y-%m-%d_%H%M") + ".csv", sep=';')
-        
-    return agent_pos
\ No newline at end of file
+    def run_steps(snapshot):
+        # advance the model step by step; with a StepSnapshot (stream=True, see stream.py) yield it after every step.
+        # Without a snapshot nothing is yielded and the result is the return value (StopIteration.value)
+        stop_reason = None
+        try:
+            for i in range(time_steps):  # simulation time steps
+                model.step()
+                for monitor in (monitors or []):
+                    monitor.update(model, dt)
+                for monitor in (stop_criteria or []):
+                    stop_reason = monitor.update(model, dt)
+                    if stop_reason is not None:
+                        break
+                if stop_reason is None and snapshot is not None:
+                    snapshot.fill(model, dt)
+                    yield snapshot
+                    stop_reason = snapshot.stop_reason
+                if stop_reason is not None:
+                    print("Run stopped after {} of {} steps: {}".format(model.time_step, time_steps, stop_reason))
+                    break
+            return finish_run(stop_reason)
+        finally:
+            release()
+    
+    def release():
+        # free the resources of the run, also if a step raises
+        if threads > 0:
+            model.schedule.close()
+        model.recorder.discard()  # spilled rows that were not read back into agent_pos
+        for monitor in (stop_criteria or []) + (monitors or []):
+            if hasattr(monitor, 'close'):  # e.g. the server of LiveMetrics
+                monitor.close()
+    
+    def finish_run(stop_reason):
+        if event_log is not None:
+            event_log.end_all(model.schedule.agents, model.time_step)
+        print('-------------------------------------------')
+        print('num_decision: ',model.num_all_decision)
+        print('num_overtake: ',model.num_decision)
+        print('avg_overtake: ',model.num_decision/model.num_all_decision)
+        print('sum_lat_dist: ',model.sum_lat_dist)
+        print('avg_lat_dist: ',model.sum_lat_dist/model.num_decision)
+        print('leader_hit_rate: ',model.leader_hits/model.leader_queries if model.leader_queries > 0 else None)
+        memory = memory_accounting(model)  # before the conversion to agent_pos, see memory_budget.py
+        print('memory_mb: ',{k: round(v, 2) if v is not None else None for k, v in memory.items()})
+        print('-------------------------------------------')
+        
+        agent_pos = model.recorder.to_dataframe()
+        if 'Position' in agent_pos.columns:
+            agent_pos['Position'] = agent_pos['Position'].apply(lambda pos: list(pos))
+            agent_pos[['Position_x', 'Position_y']] = pd.DataFrame(agent_pos['Position'].tolist(), index=agent_pos.index, columns=['Position_x', 'Position_y'])
+        agent_pos.attrs['stop_reason'] = stop_reason  # None if the run went over the whole duration
+        agent_pos.attrs['steps'] = model.time_step
+        agent_pos.attrs['leader_hit_rate'] = model.leader_hits/model.leader_queries if model.leader_queries > 0 else None
+        agent_pos.attrs['memory_mb'] = {k: v for k, v in memory.items() if k != 'process'}  # reproducible, unlike the process memory
+        if type(data_filename) is str:
+            agent_pos.to_csv("data/" + data_filename + datetime.now().strftime("_%Y-%m-%d_%H%M") + ".csv", sep=';')
+        
+        if compact_output:
+            from trajectory import CompactTrajectory
+            return CompactTrajectory.from_agent_pos(agent_pos, b_length=b_length, b_width=b_width, delta_x=(compact_output == 'delta'))
+        
+        return agent_pos
+        
+    if stream:
+        return SimulationStream(run_steps(StepSnapshot()), model)
+    try:
+        next(run_steps(None))
+    except StopIteration as end:
+        return end.value
\ No newline at end of file
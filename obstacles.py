@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+****************************************
+*** STATIC OBSTACLES AND BOTTLENECKS ***
+****************************************
+'''
+#%%
+import numpy as np
+#%%
+
+
+class StaticBlocker:
+    '''
+    Stand-in for a cyclist that is returned by the LateralProfile queries, so that the level
+    functions of the Bicycle agent can treat an obstacle like a standing cyclist (speed 0).
+    low and high are the lateral extent the obstacle blocks over the queried range.
+    '''
+    __slots__ = ('unique_id', 'x', 'y', 'low', 'high')
+
+    def __init__(self, unique_id, x, y, low, high):
+        self.unique_id = unique_id
+        self.x = x
+        self.y = y
+        self.low = low
+        self.high = high
+
+    @property
+    def pos(self):  # read-only, as the pos of a Bicycle for the checks that read it directly (Bicycle.keepLeader)
+        return (self.x, self.y)
+
+    def getPos(self):
+        return [self.x, self.y]
+
+    def getSpeed(self):
+        return 0
+
+
+class LateralProfile:
+    '''
+    Lateral availability of the path as a function of x.
+
+    Every obstacle is a polygon that is sampled once every `resolution` metres into the
+    lateral interval [low(x), high(x)] it blocks. The queries used by the agents only
+    slice these precomputed arrays, obstacles therefore cost nothing per step apart from
+    the cyclists that actually have them in their consideration range.
+    '''
+
+    touch = 1e-9  # overlap (m) that still counts as touching, so that a gap as wide as the cyclist can be passed
+
+    def __init__(self, length = 300.1,  # length of the simulated path (m)
+                 resolution = 0.05):  # sampling distance in x (m)
+        self.length = length
+        self.resolution = resolution
+        self.xs = np.arange(0, length + resolution, resolution)
+        self.obstacles = []  # list of [name, polygon coords, first sample index, low array, high array]
+
+    def copy(self):
+        profile = LateralProfile(self.length, self.resolution)
+        profile.obstacles = list(self.obstacles)
+        return profile
+
+    def __len__(self):
+        return len(self.obstacles)
+
+    def cache_key(self):
+        # configuration hashed into the stage keys of pipeline.py
+        return {'length': self.length, 'resolution': self.resolution, 'obstacles': [[o[0], o[1]] for o in self.obstacles]}
+
+    def add_polygon(self, coords,  # list of (x, y) corners of the obstacle (m, y from the right edge of the extended path)
+                    name = None):
+        # sample the lateral extent of the polygon at every x
+        coords = [(float(x), float(y)) for x, y in coords]
+        low = np.full(len(self.xs), np.inf)
+        high = np.full(len(self.xs), -np.inf)
+        for (x1, y1), (x2, y2) in zip(coords, coords[1:] + coords[:1]):
+            if x1 == x2:  # vertical edge
+                mask = np.abs(self.xs - x1) <= self.resolution/2
+                ys_low, ys_high = min(y1, y2), max(y1, y2)
+            else:
+                mask = (self.xs >= min(x1, x2)) & (self.xs <= max(x1, x2))
+                ys_low = ys_high = y1 + (self.xs[mask] - x1) * (y2 - y1) / (x2 - x1)
+            low[mask] = np.minimum(low[mask], ys_low)
+            high[mask] = np.maximum(high[mask], ys_high)
+        inside = np.flatnonzero(high >= low)
+        if len(inside) == 0:
+            raise ValueError("Obstacle {} does not cover any sample of the profile".format(coords))
+        first, last = inside[0], inside[-1] + 1
+        if name is None:
+            name = 'obstacle_{}'.format(len(self.obstacles))
+        self.obstacles.append([name, coords, first, low[first:last], high[first:last]])
+        return self
+
+    def add_rectangle(self, x_start, x_end, y_low, y_high, name = None):
+        return self.add_polygon([(x_start, y_low), (x_end, y_low), (x_end, y_high), (x_start, y_high)], name)
+
+    '''
+    ***************
+    *** QUERIES ***
+    ***************
+    '''
+
+    def _segments(self, x0, x1):
+        # obstacles sampled in [x0, x1): name, sample index offset, low and high slices
+        if len(self.obstacles) == 0:
+            return
+        i0 = max(int(np.ceil(x0 / self.resolution)), 0)
+        i1 = int(np.ceil(x1 / self.resolution))
+        for name, coords, first, low, high in self.obstacles:
+            lo, hi = max(i0 - first, 0), min(i1 - first, len(low))
+            if lo < hi:
+                yield name, first + lo, low[lo:hi], high[lo:hi]
+
+    def blockers(self, x0, x1,  # longitudinal range (m)
+                 y, width):  # lateral position and width of the querying cyclist (m)
+        # obstacles in the range as standing cyclists hugging the obstacle edge that faces the cyclist, with the blocked lateral extent
+        found = []
+        for name, offset, low, high in self._segments(x0, x1):
+            low_min, high_max = low.min(), high.max()
+            if (low_min + high_max) / 2 > y:  # obstacle on the left of the cyclist
+                k = int(np.argmin(low))
+                found.append(StaticBlocker(name, self.xs[offset + k], low[k] + width/2, low_min, high_max))
+            else:
+                k = int(np.argmax(high))
+                found.append(StaticBlocker(name, self.xs[offset + k], high[k] - width/2, low_min, high_max))
+        return found
+
+    def leaders(self, x0, x1,  # longitudinal range (m)
+                y, width,  # lateral position and width of the querying cyclist (m)
+                des_y = None,  # desired lateral position (m); None assumes that the cyclist keeps its lateral position
+                speed = 0,  # longitudinal speed (m/s)
+                lat_speed = 0):  # lateral speed available to the cyclist (m/s)
+        # obstacles that the cyclist would touch on its way to des_y, as a standing cyclist straight ahead at the first contact
+        found = []
+        for name, offset, low, high in self._segments(x0, x1):
+            dist = np.maximum(self.xs[offset:offset+len(low)] - x0, 0)
+            y_reach = np.full(len(low), y, dtype=float)
+            if des_y is not None:
+                # lateral position that can be reached until passing each sample; a halted cyclist has to steer clear first
+                with np.errstate(over='ignore'):  # creeping cyclists can reach any lateral position
+                    max_move = lat_speed * dist / speed if speed > 0 else np.zeros(len(low))
+                y_reach += np.clip(des_y - y, -max_move, max_move)
+            contact = np.flatnonzero((low < y_reach + width/2 - self.touch) & (high > y_reach - width/2 + self.touch))
+            if len(contact) > 0:
+                k = contact[0]
+                found.append(StaticBlocker(name, self.xs[offset + k], y, low[k], high[k]))
+        return found
+
+    def clamp(self, pos, next_pos,  # current and intended next position of a cyclist (m)
+              length, width):  # length and width of the cyclist (m)
+        # furthest position towards next_pos that does not overlap an obstacle: a lateral move into an obstacle
+        # is dropped, the longitudinal move ends in front of the first obstacle
+        x, y = pos
+        x1, y1 = next_pos
+        for name, offset, low, high in self._segments(x - length/2, x + length/2):
+            if np.any((low < y1 + width/2 - self.touch) & (high > y1 - width/2 + self.touch)):
+                y1 = y
+        for name, offset, low, high in self._segments(x + length/2, x1 + length/2 + self.resolution):
+            contact = np.flatnonzero((low < y1 + width/2 - self.touch) & (high > y1 - width/2 + self.touch))
+            if len(contact) > 0:
+                x1 = min(x1, self.xs[offset + contact[0]] - length/2 - self.resolution)
+        return (max(x1, x), y1)
+
+    def available(self, x,  # longitudinal position (m)
+                  y_min, y_max):  # lateral boundaries of the path (m)
+        # free lateral intervals at x
+        free = [[y_min, y_max]]
+        for name, offset, low, high in self._segments(x, x + self.resolution):
+            free = [part for a, b in free for part in ([a, min(b, low[0])], [max(a, high[0]), b]) if part[1] > part[0]]
+        return free
+
+
+def bottleneck_profile(bottleneck_width,  # width of the bottleneck (m); 1.0, 1.5 or 2.0
+                       path_width = 2,  # width of the simulated path (m, excl. 2x 0.5 m space on side of the path)
+                       b_length = 2,  # bicycle length (m)
+                       b_width = 0.8,  # bicycle width (m)
+                       profile = None):  # LateralProfile to add the bottleneck to; a new one is created if None
+
+    ''' Bottleneck narrowing the path from the left, as previously built from standing virtual cyclists. '''
+
+    P = path_width + 1  # width of the extended path
+    # positions of the standing cyclists that formed the bottleneck; their left edges form a taper
+    if bottleneck_width == 1.0:
+        virt_positions = [[254,2.4-(4-P)], [253,2.8-(4-P)], [252,3.2-(4-P)], [251,3.6-(4-P)]]
+    elif bottleneck_width == 1.5:
+        virt_positions = [[253,2.9-(4-P)], [252,3.3-(4-P)], [251,3.7-(4-P)]]
+    elif bottleneck_width == 2.0:
+        virt_positions = [[252,3.4-(4-P)], [251,3.8-(4-P)]]
+    else:
+        raise ValueError("bottleneck_width must be 1.0, 1.5 or 2.0")
+    if profile is None:
+        profile = LateralProfile()
+    start, end = virt_positions[-1], virt_positions[0]
+    coords = [(start[0]-b_length/2, P), (start[0]-b_length/2, start[1]-b_width/2), (end[0], end[1]-b_width/2), (profile.length, end[1]-b_width/2), (profile.length, P)]
+    return profile.add_polygon(coords, name='bottleneck_{}'.format(len(profile)))
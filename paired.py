@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+**************************
+*** PAIRED COMPARISONS ***
+**************************
+'''
+#%%
+import inspect
+import numpy as np
+import pandas as pd
+from model import micromodel
+from ensemble import run_ensemble
+from analysis import compute_qkv
+#%%
+
+'''
+Comparison of scenarios (e.g. SD-1 vs BS-S vs SD-2 of run.py) with common random numbers. All
+scenarios are run with common_random_numbers=True for the same seeds: the arrivals and the draws
+of every cyclist (v0, p, look-back, entry position) come from streams of (seed, cyclist) and are
+the same in all scenarios with that seed, whatever parameters change (see micromodel). For each
+seed, the metrics of a variant are compared with those of the baseline; the mean of these paired
+differences has a much smaller variance than the difference of independent runs, because the
+common noise of the arrivals and cyclists cancels. The report gives both standard errors, so the
+number of seeds needed for a confidence level can be read off directly.
+'''
+
+# metrics of a run (see run_metrics)
+METRICS = ['flow', 'density', 'speed', 'travel_time', 'travel_speed', 'finished']
+
+
+def run_metrics(agent_pos,  # data frame of one run
+                dt = 0.5,  # time step size (s)
+                duration = 3600,  # simulation duration (s)
+                agg_time = 30,  # aggregation interval for fundamental diagram (s)
+                agg_dist = [200, 250],  # aggregation space for fundamental diagram (min and max value in m)
+                path_length = 300):  # length of the cycle path (m)
+    # mean flow (bic/s), density (bic/m) and speed (m/s) in agg_dist over the intervals (as compute_qkv), and the mean
+    # travel time (s) and speed (m/s) over the path and the number of cyclists that reached its end
+    q_k_v = compute_qkv(agent_pos, dt=dt, duration=duration, agg_time=agg_time, agg_dist=agg_dist)
+    paths = agent_pos.groupby('AgentID').agg(first=('Step', 'min'), last=('Step', 'max'), x_first=('Position_x', 'min'), x_last=('Position_x', 'max'))
+    finished = paths[paths['x_last'] >= path_length - 10]  # recorded near the end of the path before removal
+    travel_time = (finished['last'] - finished['first']) * dt
+    return {'flow': q_k_v['Flow'].mean(),
+            'density': q_k_v['Density'].mean(),
+            'speed': (q_k_v['Flow'].sum() / q_k_v['Density'].sum()) if q_k_v['Density'].sum() > 0 else np.nan,
+            'travel_time': travel_time.mean(),
+            'travel_speed': ((finished['x_last'] - finished['x_first']) / travel_time.where(travel_time > 0)).mean(),
+            'finished': float(len(finished))}
+
+
+def paired_differences(base,  # data frame of the baseline metrics, one row per seed (index)
+                       variant,  # same for the variant
+                       confidence = 0.95):
+    # per metric: means, mean paired difference, its standard deviation, standard error and confidence interval,
+    # and the standard error the difference would have with independent runs
+    from scipy.stats import t
+    n = len(base)
+    diff = variant - base
+    se = diff.std(ddof=1) / np.sqrt(n)
+    half = t.ppf((1 + confidence) / 2, n - 1) * se if n > 1 else np.nan
+    return pd.DataFrame({'baseline': base.mean(),
+                         'variant': variant.mean(),
+                         'difference': diff.mean(),
+                         'difference_sd': diff.std(ddof=1),
+                         'se_paired': se,
+                         'ci_low': diff.mean() - half,
+                         'ci_high': diff.mean() + half,
+                         'se_independent': np.sqrt((base.var(ddof=1) + variant.var(ddof=1)) / n)})
+
+
+def paired_comparison(baseline = {},  # micromodel parameters of the baseline scenario (besides the shared ones)
+                      variants = {},  # scenario name -> micromodel parameters, e.g. {'SD-2': {'v0_sd': 1.5}}
+                      seeds = [1, 2, 3, 4, 5],  # random seeds; every scenario is run once per seed
+                      processes = 0,  # size of the process pool (see run_ensemble)
+                      confidence = 0.95,  # level of the confidence intervals
+                      agg_time = 30, agg_dist = [200, 250],  # aggregation of the fundamental diagram
+                      **params):  # micromodel parameters shared by all scenarios (e.g. duration, demand)
+
+    # data frame with one row per variant and metric (see paired_differences); attrs['metrics'] has the metrics of every run
+    defaults = inspect.signature(micromodel).parameters
+    names = ['baseline'] + list(variants)
+    param_sets = [dict(baseline)] + [dict(baseline, **v) for v in variants.values()]
+    results = run_ensemble(seeds=list(seeds), param_sets=param_sets, processes=processes, common_random_numbers=True, **params)
+    rows = []
+    for k, (name, scenario) in enumerate(zip(names, param_sets)):
+        get = lambda p: scenario.get(p, params.get(p, defaults[p].default))
+        for j, seed in enumerate(seeds):
+            metrics = run_metrics(results[k*len(seeds) + j], dt=get('dt'), duration=get('duration'), agg_time=agg_time, agg_dist=agg_dist)
+            rows.append(dict(metrics, scenario=name, seed=seed))
+    metrics = pd.DataFrame(rows)
+    base = metrics[metrics['scenario'] == 'baseline'].set_index('seed')[METRICS]
+    report = pd.concat({name: paired_differences(base, metrics[metrics['scenario'] == name].set_index('seed')[METRICS], confidence)
+                        for name in variants}, names=['variant', 'metric'])
+    report.attrs['metrics'] = metrics
+    return report
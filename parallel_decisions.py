@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+*******************************
+*** THREADED DECISION PHASE ***
+*******************************
+'''
+#%%
+from concurrent.futures import ThreadPoolExecutor
+from mesa.time import SimultaneousActivation
+#%%
+
+'''
+micromodel(..., threads=n) replaces SimultaneousActivation by ThreadedActivation. In Bicycle.step()
+a cyclist reads the other cyclists only through their position and speed, which change in advance(),
+so the decisions of one step do not depend on each other. ThreadedActivation splits the agents into
+contiguous chunks and runs step() for each chunk in a thread pool; advance() stays serial (it moves
+the agents in the Mesa space). The writes of the decision phase that go to the model (decision
+counters, sum_lat_dist, event log) go through Bicycle.tally: the model itself in a serial run, a
+StepTally per chunk here. After the phase the tallies are applied chunk by chunk, in agent order,
+so that sum_lat_dist is added up and the event log rows are written in the same order as in a
+serial run and the results are identical.
+The threads run in parallel on free-threaded CPython builds; with the GIL they only overlap where
+NumPy releases it, and the chunking adds overhead, so threads=0 is the default.
+'''
+
+COUNTERS = ['num_all_decision', 'num_decision', 'leader_queries', 'leader_hits']
+
+
+class StepTally:
+    ''' Model writes of the decisions of one chunk of agents, in call order (same methods as BikeLane). '''
+
+    def __init__(self):
+        for c in COUNTERS:
+            setattr(self, c, 0)
+        self.effects = []  # (BikeLane method, agent, arguments)
+
+    def lateral(self, agent, distance):
+        self.effects.append(('lateral', agent, (distance,)))
+
+    def start_episode(self, agent, leader):
+        self.effects.append(('start_episode', agent, (leader,)))
+
+    def end_episode(self, agent):
+        self.effects.append(('end_episode', agent, ()))
+
+    def apply(self, model):
+        for c in COUNTERS:
+            setattr(model, c, getattr(model, c) + getattr(self, c))
+        for method, agent, args in self.effects:
+            getattr(model, method)(agent, *args)
+
+
+def _decide(agents, tally):
+    for agent in agents:
+        agent.tally = tally
+        agent.step()
+
+
+class ThreadedActivation(SimultaneousActivation):
+
+    def __init__(self, model,
+                 threads,  # number of threads
+                 chunks_per_thread = 2):  # chunks of agents per thread and step
+        super().__init__(model)
+        self.threads = threads
+        self.chunks_per_thread = chunks_per_thread
+        self.pool = ThreadPoolExecutor(threads)
+
+    def step(self):
+        agents = list(self._agents)  # same order as do_each in SimultaneousActivation
+        self.model.update_neighbors()  # shared distance matrix of the step, computed before the threads read it
+        n = max(1, min(len(agents), self.threads * self.chunks_per_thread))
+        bounds = [len(agents) * i // n for i in range(n + 1)]
+        tallies = [StepTally() for i in range(n)]
+        futures = [self.pool.submit(_decide, agents[bounds[i]:bounds[i+1]], tallies[i]) for i in range(n)]
+        for future in futures:
+            future.result()  # raises the exception of a chunk
+        for tally in tallies:
+            tally.apply(self.model)
+        self.do_each("advance")
+        self.steps += 1
+        self.time += 1
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+*****************************
+*** VECTORIZED PERCEPTION ***
+*****************************
+'''
+#%%
+import numpy as np
+#%%
+
+'''
+The cyclists that the decision levels of a Bicycle look at (findCat1, findCat12, findCat3Behind,
+findAllLateral) only depend on the positions, speeds and ranges at the start of the step: no agent
+moves or changes its speed before all agents have decided (SimultaneousActivation). perceive()
+therefore computes them for all agents at once, as boolean masks over pairs of agents, instead of
+one neighbour query and list filter per agent and level. The agents of several models can be
+stacked along a first axis, padded to the largest number of agents, so that one pass of array
+operations serves all of them. The masks use the same operations on the same
+values as the filters of the agents, in the same (schedule) order, so the runs are bit-identical.
+Per model, perceive() sets:
+    neighbor_agents, neighbor_points     agents and positions of the step
+    neighbor_dists, neighbor_index       squared (torus) distances and row of every agent (BikeLane.get_neighbors)
+    perception                           kind -> one list of agents per row, for the kinds below
+'''
+
+# kinds of perceived cyclists (see the find... functions of the Bicycle):
+#   cat1      ahead in the consideration range and significantly slower (speed <= gamma*v0)
+#   cat12     ahead in the consideration range and slower than the desired speed
+#   behind    up to 20 m behind and faster
+#   lateral   ahead within the safety region length (lateral collision prevention zone)
+#   close     within the own length in any direction (look-back)
+KINDS = ('cat1', 'cat12', 'behind', 'lateral', 'close')
+
+
+def perceive(models):  # BikeLane models; those that already perceived their current step are skipped
+    models = [m for m in models if m.neighbor_step != m.time_step]
+    if len(models) == 0:
+        return
+    agents = [list(m.schedule.agents) for m in models]
+    R, N = len(models), max(len(a) for a in agents)
+    points = np.full((R, N, 2), np.nan)
+    size = np.empty((R, 1, 1, 2))
+    values = np.full((7, R, N), np.nan)  # speed, gamma*v0, v0, cr_length, sr_length, squared query radius and squared length per agent
+    objects = np.empty((R, N), dtype=object)
+    for r, (m, a) in enumerate(zip(models, agents)):
+        size[r, 0, 0] = m.space.size
+        if len(a) > 0:
+            points[r, :len(a)] = [b.pos for b in a]
+            values[:, r, :len(a)] = np.array([(b.speed, b.gamma*b.v0, b.v0, b.cr_length, b.sr_length, (b.cr_length+10)**2, b.length**2) for b in a]).T
+            objects[r, :len(a)] = a
+    speed, slow, v0, cr, sr, radius, length = values
+
+    # squared distances on the torus of the space, as ContinuousSpace.get_neighbors
+    deltas = np.abs(points[:, :, None, :] - points[:, None, :, :])
+    deltas = np.minimum(deltas, size - deltas)
+    dists = deltas[:, :, :, 0] ** 2 + deltas[:, :, :, 1] ** 2
+
+    # rows are the perceiving agents, columns the perceived ones
+    x = points[:, :, 0]
+    xi, xj = x[:, :, None], x[:, None, :]
+    near = (dists <= radius[:, :, None]) & (dists > 0)  # the consideration range plus 10 m, so that the circular radius does not matter
+    ahead = near & (xj > xi) & (xj < xi + cr[:, :, None])
+    masks = {'cat1': ahead & (speed[:, None, :] <= slow[:, :, None]),
+             'cat12': ahead & (speed[:, None, :] <= v0[:, :, None]),
+             'behind': (dists <= 20**2) & (dists > 0) & (xj < xi) & (xj > xi - 20) & (speed[:, None, :] > speed[:, :, None]),
+             'lateral': near & (xj >= xi) & (xj < xi + sr[:, :, None]),
+             'close': (dists <= length[:, :, None]) & (dists > 0)}
+
+    # one list of agents per row: the perceived agents of all rows are gathered at once, every row is a slice of them
+    lists = {}
+    for kind, mask in masks.items():
+        r, i, j = np.nonzero(mask)
+        found = objects[r, j].tolist()
+        ends = np.cumsum(mask.sum(axis=2)).tolist()  # end of every row in found, rows of all models one after the other
+        lists[kind] = (found, [0] + ends[:-1], ends)
+
+    for r, (m, a) in enumerate(zip(models, agents)):
+        n = len(a)
+        m.neighbor_agents = a
+        m.neighbor_points = points[r, :n]
+        m.neighbor_dists = dists[r, :n, :n]
+        m.neighbor_index = {b: k for k, b in enumerate(a)}
+        m.perception = {}
+        for kind, (found, starts, ends) in lists.items():
+            m.perception[kind] = [found[s:e] for s, e in zip(starts[r*N:r*N+n], ends[r*N:r*N+n])]
+        m.neighbor_step = m.time_step
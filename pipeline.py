@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+***************************
+*** EXPERIMENT PIPELINE ***
+***************************
+'''
+#%%
+import os
+import io
+import ast
+import json
+import pickle
+import hashlib
+import inspect
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+#%%
+
+'''
+The workflow of run.py (micromodel -> plot_fd -> plot_fd_comp / plot_space_time) as a dependency graph
+of stages. Every stage output is pickled to cache_dir under a key that hashes
+    the function (module and name) and the content of its source files (see STAGE_CODE and source_files),
+    its parameters, where objects (obstacles, stop criteria, detectors, event logs) are described by their
+    cache_key() method and the source files of their class; other objects that JSON cannot encode are rejected,
+    and the content hashes of the outputs of the stages it depends on.
+A stage whose key is unchanged is skipped. Changing agg_time or agg_dist of a fundamental diagram
+therefore only re-runs that diagram and the figures that use it; and if a re-run stage produces the
+same output as before, its dependents are skipped as well. Stages that do not depend on each other
+run in parallel in a process pool; stages added with local=True (figures) run in this process.
+Stage functions are called as func(*outputs of deps, **params) and must be module-level functions.
+Objects that collect records during a simulation (detectors, event_log, monitors, stop criteria) are
+filled in the copy of the worker process, and not at all when the stage is cached. simulate therefore
+returns them as StageRecords next to agent_pos: they are pickled to their own file, next to the output
+(the output hash and the dependents do not include them), and Pipeline.records(name) loads them.
+'''
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# modules of the stage functions below; they are hashed into the stage key with the modules of this package they import
+STAGE_CODE = {'simulate': ['model.py'],
+              'fundamental_diagram': ['analysis.py'],
+              'fd_figure': ['analysis.py'],
+              'fd_comparison': ['analysis.py'],
+              'space_time': ['analysis.py']}
+
+# micromodel parameters whose objects are filled during the run
+RECORD_PARAMS = ['detectors', 'event_log', 'monitors', 'stop_criteria']
+
+
+class StageRecords:
+    ''' Output of a stage with the records collected next to it (see Pipeline.records). '''
+
+    def __init__(self, output, records):  # stage output, dict of picklable records
+        self.output = output
+        self.records = records
+
+
+'''
+***********************
+*** STAGE FUNCTIONS ***
+***********************
+'''
+
+def simulate(**params):  # micromodel parameters
+    from model import micromodel
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent_pos = micromodel(**dict(params, data_filename=0))
+    records = {p: params[p] for p in RECORD_PARAMS if params.get(p)}
+    return StageRecords(agent_pos, records) if records else agent_pos
+
+
+def fundamental_diagram(agent_pos, **params):  # fit_fd parameters (dt, duration, agg_time, agg_dist, path_width)
+    from analysis import fit_fd
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fit_fd(agent_pos, **params)
+
+
+def fd_figure(q_k_v, fd_filename = "fundamental_diagram"):
+    from analysis import draw_fd
+    draw_fd(q_k_v, fd_filename=fd_filename)
+
+
+def fd_comparison(*states, names, fd_filename = "comparison"):
+    from analysis import plot_fd_comp
+    plot_fd_comp(list(states), names, fd_filename=fd_filename)
+
+
+def space_time(agent_pos, dt = 0.5, space_time_filename = 'space_time'):
+    from analysis import plot_space_time
+    with contextlib.redirect_stdout(io.StringIO()):
+        plot_space_time(agent_pos, dt=dt, space_time_filename=space_time_filename)
+
+
+'''
+****************
+*** PIPELINE ***
+****************
+'''
+
+def _hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def source_files(paths):  # source files
+    # the files and, transitively, the modules of this package that they import (also inside functions)
+    found, stack = [], list(paths)
+    while stack:
+        path = stack.pop()
+        if path in found:
+            continue
+        found.append(path)
+        with open(path, 'rb') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [a.name for a in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+                names = [node.module]
+            else:
+                continue
+            for n in names:
+                module = os.path.join(PACKAGE_DIR, n.split('.')[0] + '.py')
+                if os.path.exists(module):
+                    stack.append(module)
+    return sorted(found)
+
+
+def params_json(name, params, files):  # stage name, parameters and a set that receives the source files of parameter objects
+    # stable JSON text of the parameters of a stage
+    def describe(value):
+        if hasattr(value, 'cache_key'):
+            files.update(source_files([inspect.getsourcefile(type(value))]))
+            return {'class': '{}.{}'.format(type(value).__module__, type(value).__qualname__), 'config': value.cache_key()}
+        if hasattr(value, 'tolist'):  # numpy arrays and scalars
+            return value.tolist()
+        raise TypeError("Parameter value {!r} of stage {} cannot be hashed into the stage key: give its class a "
+                        "cache_key() method that returns its configuration".format(value, name))
+    return json.dumps(params, sort_keys=True, default=describe)
+
+
+def _records_file(output_file):
+    return output_file[:-len('.pkl')] + '.records.pkl'
+
+
+def _execute(func, params, input_files, output_file):
+    # runs one stage (in a worker process or locally): inputs and output go through the cache files
+    inputs = []
+    for path in input_files:
+        with open(path, 'rb') as f:
+            inputs.append(pickle.load(f))
+    output = func(*inputs, **params)
+    records = None
+    if isinstance(output, StageRecords):
+        output, records = output.output, output.records
+    with open(_records_file(output_file) + '.tmp', 'wb') as f:
+        pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(_records_file(output_file) + '.tmp', _records_file(output_file))
+    data = pickle.dumps(output, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(output_file + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(output_file + '.tmp', output_file)
+    return _hash_bytes(data)
+
+
+class Pipeline:
+
+    def __init__(self, cache_dir = 'pipeline_cache',  # directory of the stage outputs and the index
+                 processes = None):  # size of the process pool; None uses all cores, 0 runs everything in this process
+        self.cache_dir = cache_dir
+        self.processes = processes
+        self.stages = {}  # name -> dict(func, deps, params, local, code), in the order added
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index_file = os.path.join(cache_dir, 'index.json')
+        self.index = {}  # name -> {'key', 'output'} of the last run of each stage
+        if os.path.exists(self._index_file):
+            with open(self._index_file) as f:
+                self.index = json.load(f)
+
+    def add(self, name, func,
+            deps = [],  # names of the stages whose outputs are passed to func (in this order)
+            params = {},  # keyword arguments of func
+            local = False,  # run in this process (figures) instead of the process pool
+            code = None):  # source files hashed into the key; None uses STAGE_CODE or the file of func
+        for d in deps:
+            if d not in self.stages:
+                raise ValueError("Stage {} depends on {}, which has to be added before".format(name, d))
+        if code is None:
+            code = source_files([os.path.join(PACKAGE_DIR, f) for f in STAGE_CODE.get(func.__name__, [])] or [inspect.getsourcefile(func)])
+        params_json(name, params, set())  # rejects parameters that cannot be hashed
+        self.stages[name] = {'func': func, 'deps': list(deps), 'params': dict(params), 'local': local, 'code': list(code)}
+        return name
+
+    def add_scenario(self, name,  # scenario name, e.g. 'BS_S'
+                     sim_params = {},  # micromodel parameters
+                     fd_params = {},  # fit_fd parameters besides dt, duration and path_width (e.g. agg_time, agg_dist)
+                     figures = True):  # add the fundamental diagram and space-time figures
+        # stages <name> (simulation) and <name>_fd (q-k-v points); returns the name of the fd stage
+        from model import micromodel
+        defaults = inspect.signature(micromodel).parameters
+        get = lambda p: sim_params.get(p, defaults[p].default)
+        self.add(name, simulate, params=sim_params)
+        self.add(name + '_fd', fundamental_diagram, deps=[name],
+                 params=dict({'dt': get('dt'), 'duration': get('duration'), 'path_width': get('path_width')}, **fd_params))
+        if figures:
+            self.add(name + '_fd_figure', fd_figure, deps=[name + '_fd'], params={'fd_filename': name.replace('_', '-')}, local=True)
+            self.add(name + '_space_time', space_time, deps=[name], params={'dt': get('dt'), 'space_time_filename': name.replace('_', '-')}, local=True)
+        return name + '_fd'
+
+    def key(self, name, input_hashes):
+        stage = self.stages[name]
+        h = hashlib.sha256()
+        h.update('{}.{}'.format(stage['func'].__module__, stage['func'].__qualname__).encode())
+        files = set()
+        params = params_json(name, stage['params'], files)
+        for path in stage['code'] + sorted(files - set(stage['code'])):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+        h.update(params.encode())
+        for i in input_hashes:
+            h.update(i.encode())
+        return h.hexdigest()
+
+    def output_file(self, name):
+        return os.path.join(self.cache_dir, name + '.pkl')
+
+    def load(self, name):
+        with open(self.output_file(name), 'rb') as f:
+            return pickle.load(f)
+
+    def records(self, name):
+        # the objects filled during the last run of the stage (e.g. {'detectors': [...], 'event_log': ...}); None if it has none
+        with open(_records_file(self.output_file(name)), 'rb') as f:
+            return pickle.load(f)
+
+    def _needed(self, targets):
+        # the targets and all stages they depend on, in the order added
+        needed = set()
+        stack = list(targets)
+        while stack:
+            n = stack.pop()
+            if n not in needed:
+                needed.add(n)
+                stack.extend(self.stages[n]['deps'])
+        return [n for n in self.stages if n in needed]
+
+    def run(self, targets = None):  # stage names to bring up to date (with their dependencies); None runs all
+        # returns {stage: 'run' or 'cached'}
+        pending = self._needed(targets if targets is not None else list(self.stages))
+        status = {}
+        running = {}  # future -> (name, key)
+        pool = ProcessPoolExecutor(self.processes) if self.processes != 0 else None
+        try:
+            while pending or running:
+                for name in list(pending):
+                    stage = self.stages[name]
+                    if any(d not in status for d in stage['deps']):
+                        continue
+                    pending.remove(name)
+                    key = self.key(name, [self.index[d]['output'] for d in stage['deps']])
+                    if (self.index.get(name, {}).get('key') == key and os.path.exists(self.output_file(name))
+                            and os.path.exists(_records_file(self.output_file(name)))):
+                        status[name] = 'cached'
+                        continue
+                    args = (stage['func'], stage['params'], [self.output_file(d) for d in stage['deps']], self.output_file(name))
+                    if stage['local'] or pool is None:
+                        self._done(name, key, _execute(*args), status)
+                    else:
+                        running[pool.submit(_execute, *args)] = (name, key)
+                if running:
+                    done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name, key = running.pop(future)
+                        self._done(name, key, future.result(), status)
+                elif pending and all(any(d not in status for d in self.stages[n]['deps']) for n in pending):
+                    raise RuntimeError("Stages {} cannot be run".format(pending))
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        return status
+
+    def _done(self, name, key, output_hash, status):
+        self.index[name] = {'key': key, 'output': output_hash}
+        with open(self._index_file + '.tmp', 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(self._index_file + '.tmp', self._index_file)
+        status[name] = 'run'
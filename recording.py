@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+****************************
+*** TRAJECTORY RECORDING ***
+****************************
+'''
+#%%
+import os
+import tempfile
+from operator import attrgetter
+import numpy as np
+import pandas as pd
+#%%
+
+# recordable fields (column name: Bicycle attribute), in the column order of the agent_pos data frame
+FIELDS = {"Position": "pos", "Speed": "speed", "latSpeed": "v_lat", "ID": "unique_id", "desSpeed": "v0", "srLength": "sr_length", "srWidth": "sr_width", "crLength": "cr_length"}
+
+# recording profiles: recorded fields, recording interval (s; None records every step) and
+# spatial window ([x_min, x_max] in m; None records the whole path); 'none' records no trajectories (e.g. with detectors.py);
+# the compact format and the trajectory store (trajectory.py, trajectory_store.py) need a profile with 'Position'
+RECORDING_PROFILES = {'full': {'fields': list(FIELDS), 'interval': None, 'window': None},
+                      'space_time': {'fields': ['Position', 'Speed'], 'interval': 1, 'window': None},
+                      'fd': {'fields': ['Position', 'Speed'], 'interval': 1, 'window': [190, 260]},
+                      'none': {'fields': [], 'interval': None, 'window': None}}
+
+
+class TrajectoryRecorder:
+    '''
+    Agent data collection of micromodel (replaces the Mesa DataCollector).
+
+    Only the fields of the profile are read, only every `interval` seconds and only for
+    cyclists inside the window; the profile 'full' gives the same data frame as the
+    DataCollector. Step keeps counting simulation steps of length dt, so Time = Step * dt
+    stays valid for sub-sampled data; the recording interval is stored in agent_pos.attrs.
+    The rows are buffered as one list per column, with x and y of the position as two columns:
+    only numbers are appended, no tuple per row, so the buffer keeps no garbage-collected
+    containers alive and does not trigger collections during the run. The position tuples
+    are built once, when the data frame is built.
+    spill() moves the buffered rows to a file (e.g. from memory_budget.MemoryBudget); they are
+    read back in order when the data frame is built, one file at a time into preallocated columns,
+    so that the peak is the data frame plus one chunk. discard() removes the files of a run that
+    ends without a data frame (micromodel calls it when the run raises or a stream is left early).
+    '''
+
+    def __init__(self, profile = 'full',  # name in RECORDING_PROFILES or dict with the keys fields, interval and window
+                 dt = 0.5):  # simulation time step length (s)
+        if isinstance(profile, str):
+            if profile not in RECORDING_PROFILES:
+                raise ValueError("Unknown recording profile {}, choose from {}".format(profile, list(RECORDING_PROFILES)))
+            profile = RECORDING_PROFILES[profile]
+        profile = dict(RECORDING_PROFILES['full'], **profile)
+        unknown = [f for f in profile['fields'] if f not in FIELDS]
+        if unknown:
+            raise ValueError("Unknown fields {}, choose from {}".format(unknown, list(FIELDS)))
+        self.fields = [f for f in FIELDS if f in profile['fields']]  # keep the column order of the full data frame
+        self.every = 1 if profile['interval'] is None else max(1, int(round(profile['interval'] / dt)))
+        self.interval = self.every * dt
+        self.window = profile['window']
+        self.columns = ['Step', 'AgentID'] + self.fields
+        self._getters = [attrgetter('unique_id')]
+        for f in self.fields:
+            if f == 'Position':
+                self._getters += [lambda a: a.pos[0], lambda a: a.pos[1]]
+            else:
+                self._getters.append(attrgetter(FIELDS[f]))
+        self.buffer = [[] for g in range(1 + len(self._getters))]  # buffered rows, one list per column (Step first)
+        self.rows = 0  # number of buffered rows
+        self.spilled = []  # files of the spilled rows, in order
+        self.spilled_rows = 0
+        self.spilled_bytes = 0
+
+    def collect(self, model):
+        step = model.schedule.steps
+        if step % self.every != 0 or not self.fields:
+            return
+        agents = model.schedule.agents
+        if self.window is not None:
+            agents = [a for a in agents if self.window[0] <= a.pos[0] <= self.window[1]]
+        self.buffer[0].extend([step] * len(agents))
+        for column, get in zip(self.buffer[1:], self._getters):
+            column.extend(map(get, agents))
+        self.rows += len(agents)
+
+    def _buffer_to_frame(self):
+        if self.rows == 0:
+            return pd.DataFrame.from_records([], columns=self.columns)
+        columns = {}
+        values = iter(self.buffer)
+        for name in self.columns:
+            columns[name] = list(zip(next(values), next(values))) if name == 'Position' else next(values)
+        return pd.DataFrame(columns)
+
+    def spill(self, directory = None):  # directory of the file; None uses the temporary directory
+        # write the buffered rows to a file and clear the buffer
+        fd, path = tempfile.mkstemp(prefix='micromodel_records_', suffix='.pkl', dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            self._buffer_to_frame().to_pickle(f)
+        self.spilled.append(path)
+        self.spilled_rows += self.rows
+        self.spilled_bytes += os.path.getsize(path)
+        self.buffer = [[] for column in self.buffer]
+        self.rows = 0
+
+    def chunks(self):
+        # the recorded rows as data frames in order: the spilled files (removed once read), then the buffer
+        while self.spilled:
+            path = self.spilled.pop(0)
+            chunk = pd.read_pickle(path)
+            os.remove(path)
+            yield chunk
+        if self.rows > 0:
+            yield self._buffer_to_frame()
+
+    def discard(self):
+        # remove the spilled files without reading them
+        for path in self.spilled:
+            if os.path.exists(path):
+                os.remove(path)
+        self.spilled = []
+
+    def to_dataframe(self):
+        if self.spilled:
+            rows = self.spilled_rows + self.rows
+            columns = None
+            start = 0
+            for chunk in self.chunks():
+                if columns is None:
+                    columns = {c: np.empty(rows, dtype=chunk[c].dtype) for c in chunk.columns}
+                for c in chunk.columns:
+                    if chunk[c].dtype != columns[c].dtype:  # e.g. integer values in the first chunk only
+                        columns[c] = columns[c].astype(np.result_type(columns[c].dtype, chunk[c].dtype))
+                    columns[c][start:start + len(chunk)] = chunk[c].to_numpy()
+                start += len(chunk)
+            agent_pos = pd.DataFrame(columns, copy=False)
+        else:
+            agent_pos = self._buffer_to_frame()
+        agent_pos.attrs['record_interval'] = self.interval
+        agent_pos.attrs['record_window'] = self.window
+        return agent_pos
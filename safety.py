@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+*********************************
+*** SURROGATE SAFETY MEASURES ***
+*********************************
+'''
+#%%
+import numpy as np
+import pandas as pd
+#%%
+
+'''
+SafetyMonitor is passed to micromodel in the list monitors (see convergence.py), it never stops the
+run; the measures are reset at the start of every run. After every step it takes the positions and
+the distance matrix of BikeLane.update_neighbors (the next step reuses them for the neighbour queries)
+and evaluates all pairs of a follower and a leader ahead of it within `radius` at once:
+    time-to-collision (TTC)       gap / speed difference, if the bicycles overlap laterally and the follower is faster
+    required deceleration (DRAC)  speed difference^2 / (2 gap), for the same pairs
+    lateral clearance             distance between the sides of two bicycles riding next to each other (< 0: overlap)
+    encroachment                  a leader and a follower start to overlap laterally (the leader cuts in or the follower
+                                  moves behind it); time headway = gap / speed of the follower at that moment (this is
+                                  not a post-encroachment time, which needs the times a conflict area is entered and left)
+The gap is measured from the rear of the leader to the front of the follower. Per step, the minimum TTC
+and maximum DRAC of every follower and the minimum clearance of every cyclist go into histograms (values
+outside the bins are counted in the first or last bin); pairs below the TTC threshold and all
+encroachments go into event tables.
+'''
+
+
+class SafetyMonitor:
+
+    def __init__(self, radius = 20,  # distance to the leaders taken into account (m)
+                 ttc_threshold = 1.5,  # pairs with a smaller TTC are recorded as conflicts (s)
+                 ttc_bins = np.arange(0, 10.5, 0.5),  # bin edges of the TTC histogram (s)
+                 drac_bins = np.arange(0, 6.25, 0.25),  # bin edges of the DRAC histogram (m/s^2)
+                 clearance_bins = np.arange(-0.4, 2.05, 0.1)):  # bin edges of the lateral clearance histogram (m)
+        self.radius = radius
+        self.ttc_threshold = ttc_threshold
+        self.bins = {'TTC': np.asarray(ttc_bins), 'DRAC': np.asarray(drac_bins), 'Clearance': np.asarray(clearance_bins)}
+        self.reset()
+
+    def reset(self):
+        # measures of a run
+        self.counts = {k: np.zeros(len(b) - 1, dtype=np.int64) for k, b in self.bins.items()}
+        self.conflicts = []  # (time (s), follower ID, leader ID, gap (m), speed difference (m/s), TTC (s), DRAC (m/s^2))
+        self.encroachments = []  # (time (s), follower ID, leader ID, gap (m), time headway (s))
+        self._near = set()  # (follower ID, leader ID) of the pairs of the previous step
+        self._overlap = set()  # the same pairs if they overlapped laterally
+
+    def _add(self, name, values):
+        bins = self.bins[name]
+        values = np.clip(values, bins[0], np.nextafter(bins[-1], bins[0]))
+        self.counts[name] += np.histogram(values, bins)[0]
+
+    def cache_key(self):
+        # configuration hashed into the stage keys of pipeline.py
+        return {'radius': self.radius, 'ttc_threshold': self.ttc_threshold, 'bins': {k: b.tolist() for k, b in self.bins.items()}}
+
+    def update(self, model, dt):
+        model.update_neighbors()
+        agents = model.neighbor_agents
+        if len(agents) < 2:
+            self._near, self._overlap = set(), set()
+            return
+        points = model.neighbor_points
+        speed = np.array([a.speed for a in agents])
+        length = np.array([a.length for a in agents])
+        width = np.array([a.width for a in agents])
+        ids = np.array([a.unique_id for a in agents])
+        time = model.time_step * dt
+
+        # pairs of follower f and leader l ahead of it (without the torus wrap of the distance matrix)
+        dx = points[:, 0][None, :] - points[:, 0][:, None]
+        f, l = np.nonzero((model.neighbor_dists <= self.radius**2) & (dx > 0) & (dx <= self.radius))
+        gap = dx[f, l] - length[f]
+        dy = np.abs(points[l, 1] - points[f, 1])
+        half_widths = (width[f] + width[l]) / 2
+        overlap = dy < half_widths
+
+        # longitudinal conflicts: TTC and DRAC of the pairs on a collision course
+        dv = speed[f] - speed[l]
+        course = overlap & (gap > 0) & (dv > 0)
+        ttc = gap[course] / dv[course]
+        drac = dv[course]**2 / (2 * gap[course])
+        if course.any():
+            min_ttc = np.full(len(agents), np.inf)
+            np.minimum.at(min_ttc, f[course], ttc)
+            max_drac = np.full(len(agents), -np.inf)
+            np.maximum.at(max_drac, f[course], drac)
+            self._add('TTC', min_ttc[np.isfinite(min_ttc)])
+            self._add('DRAC', max_drac[np.isfinite(max_drac)])
+            low = ttc < self.ttc_threshold
+            fc, lc = f[course][low], l[course][low]
+            self.conflicts.extend(zip([time]*int(low.sum()), ids[fc].tolist(), ids[lc].tolist(), gap[course][low].tolist(),
+                                      dv[course][low].tolist(), ttc[low].tolist(), drac[low].tolist()))
+
+        # lateral clearance of the pairs riding next to each other
+        side = gap < 0
+        if side.any():
+            clearance = dy[side] - half_widths[side]
+            min_clearance = np.full(len(agents), np.inf)
+            np.minimum.at(min_clearance, f[side], clearance)
+            np.minimum.at(min_clearance, l[side], clearance)
+            self._add('Clearance', min_clearance[np.isfinite(min_clearance)])
+
+        # encroachments: pairs that were already close in the previous step and start to overlap laterally
+        pairs = list(zip(ids[f].tolist(), ids[l].tolist()))
+        ahead = overlap & (gap > 0)
+        overlapping = {p for p, o in zip(pairs, ahead.tolist()) if o}
+        for k in np.nonzero(ahead)[0].tolist():
+            p = pairs[k]
+            if p in self._near and p not in self._overlap:
+                headway = gap[k] / speed[f[k]] if speed[f[k]] > 0 else np.inf
+                self.encroachments.append((time, p[0], p[1], float(gap[k]), float(headway)))
+        self._near, self._overlap = set(pairs), overlapping
+
+    def histograms(self):
+        # one data frame per measure with the bin edges and the number of observations (cyclist-steps)
+        return {k: pd.DataFrame({'From': b[:-1], 'To': b[1:], 'Count': self.counts[k]}) for k, b in self.bins.items()}
+
+    def conflict_table(self):
+        return pd.DataFrame.from_records(self.conflicts, columns=['Time', 'Follower', 'Leader', 'Gap', 'SpeedDiff', 'TTC', 'DRAC'])
+
+    def encroachment_table(self):
+        return pd.DataFrame.from_records(self.encroachments, columns=['Time', 'Follower', 'Leader', 'Gap', 'Headway'])
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+*****************************
+*** SHARED-MEMORY RESULTS ***
+*****************************
+'''
+#%%
+import os
+import weakref
+import tempfile
+import numpy as np
+import pandas as pd
+#%%
+
+'''
+Transfer of agent_pos data frames from worker processes without pickling the rows. The worker writes
+the numeric columns into one file in shared memory (/dev/shm where available, otherwise the temporary
+directory) and returns a small handle with the path, the column layout and attrs (share_dataframe).
+The parent maps the file (SharedResult) and wraps the columns as numpy arrays on the mapping, so the
+rows are neither pickled nor copied. The file is removed as soon as it is mapped; the operating system
+frees the memory when the last array on it is gone, nothing has to be cleaned up by hand. The arrays
+are copy-on-write: changing them does not change the shared pages. Columns of dtype object (the
+redundant Position column of lists) are left out, as in CompactTrajectory.to_agent_pos(include_position=False).
+'''
+
+_ALIGN = 64  # byte alignment of the columns in the file
+
+
+def shared_dir():
+    # directory of the shared files: memory-backed on Linux
+    return '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+
+
+def share_dataframe(agent_pos, directory = None):  # directory of the file; None uses shared_dir()
+    # worker side: write the numeric columns into a new file and return its handle
+    columns = [(c, np.ascontiguousarray(agent_pos[c].to_numpy())) for c in agent_pos.columns if agent_pos[c].dtype != object]
+    layout = []
+    fd, path = tempfile.mkstemp(prefix='micromodel_', suffix='.bin', dir=directory or shared_dir())
+    with os.fdopen(fd, 'wb') as f:
+        offset = 0
+        for c, values in columns:
+            layout.append((c, values.dtype.str, offset, len(values)))
+            f.write(memoryview(values).cast('B'))
+            padding = -values.nbytes % _ALIGN
+            f.write(b'\0' * padding)
+            offset += values.nbytes + padding
+    return {'path': path, 'size': offset, 'columns': layout, 'index': None if isinstance(agent_pos.index, pd.RangeIndex) else agent_pos.index.to_numpy(),
+            'attrs': dict(agent_pos.attrs)}
+
+
+def discard(handle):
+    # remove the file of a handle that is not opened (e.g. after an error in the parent)
+    try:
+        os.remove(handle['path'])
+    except FileNotFoundError:
+        pass
+
+
+def _remove_later(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class SharedResult:
+    ''' Parent side: zero-copy view of a data frame written by share_dataframe. '''
+
+    def __init__(self, handle):
+        if handle['size'] > 0:
+            mapping = np.memmap(handle['path'], dtype=np.uint8, mode='c', shape=(handle['size'],))
+        else:  # empty data frame, nothing to map
+            mapping = np.zeros(0, dtype=np.uint8)
+        self.columns = {c: mapping[start:start + n*np.dtype(dtype).itemsize].view(dtype) for c, dtype, start, n in handle['columns']}
+        self.index = handle['index']
+        self.attrs = handle['attrs']
+        self.nbytes = handle['size']
+        try:
+            os.remove(handle['path'])  # the mapping stays valid
+        except PermissionError:  # Windows does not remove mapped files: remove it when the last array is gone
+            weakref.finalize(mapping.base, _remove_later, handle['path'])  # the mmap under all column arrays
+
+    def arrays(self):
+        return dict(self.columns)
+
+    def to_dataframe(self):
+        agent_pos = pd.DataFrame(self.columns, index=self.index, copy=False)
+        agent_pos.attrs.update(self.attrs)
+        return agent_pos
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+***************************
+*** STEP-WISE STREAMING ***
+***************************
+'''
+#%%
+import numpy as np
+import pandas as pd
+#%%
+
+'''
+micromodel(..., stream=True) returns a SimulationStream instead of running the whole run: iterating
+over it advances the model by one step per iteration and yields a StepSnapshot with the cyclists on
+the path and the step metrics. One snapshot is reused; its column arrays are views into buffers that
+are refilled at the next step, so a snapshot is only valid until the iteration continues (copy()
+keeps it). Memory is constant over the run if the recording profile 'none' is used (see recording.py).
+    stream = micromodel(duration=3600, recording='none', stream=True)
+    for snapshot in stream:
+        ... snapshot.x, snapshot.speed, snapshot.n_agents ...
+        if done: snapshot.request_stop("my reason")   # or break, which leaves the run without a result
+    agent_pos = stream.result
+Stop criteria (see convergence.py) work as in a normal run. When the run ends (duration reached, a
+monitor or request_stop), stream.result is what micromodel returns; in a generator,
+agent_pos = yield from stream gives the same. The resources of the run (thread pool, spill files,
+servers of monitors) are released in a finally of the step generator, so also when the loop is left
+with break or an exception and the generator is closed (GeneratorExit). The iterator of a for loop is
+closed when it is dropped; to release them at a defined point, use the stream as a context manager:
+    with micromodel(duration=3600, stream=True) as stream:
+        for snapshot in stream:
+            if done: break
+'''
+
+# columns of a snapshot (rows of the buffer): unique_id, pos (x and y), speed, v_lat, v0 and overtake of the cyclists
+COLUMNS = ('agent_id', 'x', 'y', 'speed', 'v_lat', 'v0', 'overtake')
+
+
+class SimulationStream:
+
+    def __init__(self, steps,  # generator of micromodel that yields the snapshots and returns the result
+                 model = None):  # BikeLane model of the run (e.g. for perception.perceive)
+        self._steps = steps
+        self.model = model
+        self.result = None  # set when the run has ended
+
+    def __iter__(self):
+        self.result = yield from self._steps
+        return self.result
+
+    def close(self):
+        # end the run without a result; runs the cleanup of the step generator
+        self._steps.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class StepSnapshot:
+
+    def __init__(self, capacity = 64):  # initial number of agent rows; the buffers grow when more agents are on the path
+        self._buffer = np.empty((len(COLUMNS), capacity))
+        self.step = 0
+        self.time = 0.0  # step * dt (s)
+        self.n_agents = 0
+        self.n_entered = 0  # cyclists that entered the path so far
+        self.n_finished = 0  # cyclists that left the path so far
+        self.num_decision = 0  # overtaking decisions so far (num_overtake of micromodel)
+        self.num_all_decision = 0
+        self.stop_reason = None
+
+    def fill(self, model, dt):
+        # refill the buffers with the agents of the current step
+        agents = model.schedule.agents
+        n = len(agents)
+        if n > self._buffer.shape[1]:
+            self._buffer = np.empty((len(COLUMNS), max(n, 2 * self._buffer.shape[1])))
+        buffer = self._buffer
+        if n > 0:
+            buffer[0, :n] = [a.unique_id for a in agents]
+            buffer[1:3, :n] = np.array([a.pos for a in agents]).T
+            buffer[3, :n] = [a.speed for a in agents]
+            buffer[4, :n] = [a.v_lat for a in agents]
+            buffer[5, :n] = [a.v0 for a in agents]
+            buffer[6, :n] = [a.overtake for a in agents]
+        self.n_agents = n
+        self.step = model.time_step
+        self.time = model.time_step * dt
+        self.n_entered = model.inflow_count
+        self.n_finished = model.n_finished
+        self.num_decision = model.num_decision
+        self.num_all_decision = model.num_all_decision
+
+    def request_stop(self, reason = "stopped by the stream consumer"):
+        # end the run after this step; the generator returns the result as for a stop criterion
+        self.stop_reason = reason
+
+    def column(self, name):
+        # view of one column for the agents of the step
+        return self._buffer[COLUMNS.index(name), :self.n_agents]
+
+    agent_id = property(lambda self: self.column('agent_id'))
+    x = property(lambda self: self.column('x'))
+    y = property(lambda self: self.column('y'))
+    speed = property(lambda self: self.column('speed'))
+    v_lat = property(lambda self: self.column('v_lat'))
+    v0 = property(lambda self: self.column('v0'))
+    overtake = property(lambda self: self.column('overtake'))
+
+    def metrics(self):
+        return {'step': self.step, 'time': self.time, 'agents': self.n_agents, 'entered': self.n_entered,
+                'finished': self.n_finished, 'num_overtake': self.num_decision, 'num_decision': self.num_all_decision}
+
+    def copy(self):
+        # independent copy that stays valid after the next step
+        other = StepSnapshot.__new__(StepSnapshot)
+        other.__dict__.update(self.__dict__)
+        other._buffer = self._buffer[:, :self.n_agents].copy()
+        return other
+
+    def to_dataframe(self):
+        df = pd.DataFrame({c: self.column(c).copy() for c in COLUMNS})
+        df['agent_id'] = df['agent_id'].astype(np.int64)
+        df['overtake'] = df['overtake'].astype(bool)
+        return df
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+import io
+import random
+import contextlib
+from model import micromodel
+
+
+def test_finished_cyclists_are_reused():
+    with contextlib.redirect_stdout(io.StringIO()):
+        stream = micromodel(duration=120, demand=[40], seed=4, data_filename=0, recording='none', stream=True)
+    objects, ids = {}, set()
+    with stream:
+        for snapshot in stream:
+            for a in stream.model.schedule.agents:
+                objects[id(a)] = a
+                ids.add(a.unique_id)
+    model = stream.model
+    assert len(objects) < len(ids)  # objects of finished cyclists carried the ids of later ones
+
+    # a recycled object draws the same attributes as a new one from the same random state
+    recycled = list(objects.values())[0]
+    state = random.getstate()
+    recycled.reset(10000)
+    random.setstate(state)
+    new = type(recycled)(10000, model)
+    for name in type(recycled).__slots__:
+        assert getattr(recycled, name) == getattr(new, name), name
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+from analysis import compute_xt_fields
+
+
+def _agent_pos(seed = 1, n_cyclists = 60, n_steps = 400, dt = 0.5):
+    # step-major trajectories of cyclists entering at random steps and leaving the 100 m path
+    rng = np.random.default_rng(seed)
+    rows = []
+    for agent in range(n_cyclists):
+        x, step, v = 0.0, int(rng.integers(1, n_steps)), rng.uniform(3, 6)
+        while x < 100 and step <= n_steps:
+            rows.append((step, agent, x, rng.uniform(0, 2.5)))
+            x, step = x + v*dt, step + 1
+    rows.append((n_steps, n_cyclists, 50.0, 1.0))  # a cyclist with a single row
+    agent_pos = pd.DataFrame(rows, columns=['Step', 'AgentID', 'Position_x', 'Position_y'])
+    return agent_pos.sort_values(['Step', 'AgentID'], ignore_index=True)
+
+
+def test_xt_fields_chunked_equal_in_memory():
+    agent_pos = _agent_pos()
+    kwargs = dict(duration=200, agg_time=10, cell_length=10, path_length=100, lateral_bins=np.arange(0, 2.75, 0.25))
+    expected = compute_xt_fields(agent_pos, **kwargs)
+    for chunksize in [1, 7, 50, 500]:
+        chunks = (agent_pos.iloc[i:i+chunksize] for i in range(0, len(agent_pos), chunksize))
+        fields = compute_xt_fields(chunks, **kwargs)
+        for name in ['density', 'flow', 'speed', 'lateral']:
+            np.testing.assert_allclose(fields[name], expected[name], equal_nan=True, err_msg=name)
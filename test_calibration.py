@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from calibration import Calibration, simulate_fd, fd_error
+
+BASE = dict(duration=60, demand=[600, 600], seed=4)
+
+
+def test_fd_error_of_the_target_itself():
+    target = simulate_fd(BASE, agg_time=10)
+    assert fd_error(target, target) == 0
+
+
+def test_screening_and_memoization():
+    target = simulate_fd(BASE, agg_time=10)
+    calibration = Calibration(target, bounds={'v0_mean': (3, 7)}, base_params=BASE, abort_factor=1, agg_time=10)
+    candidates = [np.array([3.0]), np.array([5.2]), np.array([7.0]), np.array([5.2])]
+    errors = calibration.evaluate(candidates)
+    assert len(calibration.history) == 3  # the repeated candidate is simulated once
+    assert errors[1] == errors[3]
+
+    # with abort_factor 1 only the candidate with the best screening error is run in full, the others rank last
+    full = [h for h in calibration.history if not h['screened_out']]
+    screened = [h for h in calibration.history if h['screened_out']]
+    assert len(full) == 1 and np.isfinite(full[0]['error'])
+    assert all(h['error'] == np.inf and h['screen_error'] > calibration.best_screen for h in screened)
+
+    assert calibration.evaluate(candidates) == errors
+    assert len(calibration.history) == 3
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+import numpy as np
+from model import micromodel
+from convergence import Stationary
+
+
+def _run(monitor):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return micromodel(duration=100, demand=[300], seed=4, data_filename=0, stop_criteria=[monitor])
+
+
+def test_reused_monitor_starts_from_scratch():
+    reused = Stationary(duration=30, window=15, tolerance=0.5)
+    _run(reused)
+    second = _run(reused)
+    fresh = Stationary(duration=30, window=15, tolerance=0.5)
+    expected = _run(fresh)
+    assert second.attrs['stop_reason'] == expected.attrs['stop_reason']
+    np.testing.assert_array_equal(reused.blocks, fresh.blocks)
+    assert (np.array(reused.blocks)[:, 2] >= 0).all()  # outflow
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+import numpy as np
+from model import micromodel
+from detectors import LoopDetector
+
+
+def test_passages_match_trajectories():
+    detector = LoopDetector(x=100)
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent_pos = micromodel(duration=60, demand=[300], seed=4, data_filename=0, detectors=[detector])
+    passages = detector.passages()
+    crossed = agent_pos.groupby('AgentID')['Position_x'].agg(['min', 'max'])
+    crossed = crossed[(crossed['min'] < 100) & (crossed['max'] >= 100)]
+    assert sorted(passages['AgentID']) == sorted(crossed.index)
+
+    # the interpolated time lies between the last recorded step before the detector and the first one after it
+    for agent, time in zip(passages['AgentID'], passages['Time']):
+        rows = agent_pos[agent_pos['AgentID'] == agent]
+        before = rows.loc[rows['Position_x'] < 100, 'Step'].max()
+        after = rows.loc[rows['Position_x'] >= 100, 'Step'].min()
+        assert before * 0.5 <= time <= after * 0.5
+    assert np.all(passages['Headway'].iloc[1:] >= 0)
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+import pandas as pd
+from model import micromodel
+from ensemble import run_ensemble
+
+
+def test_pool_results_equal_independent_runs():
+    params = dict(duration=60, demand=[200])
+    results = run_ensemble(seeds=[1, 2], param_sets=[{'alpha': 0.6}], processes=2, **params)
+    for seed, result in zip([1, 2], results):
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = micromodel(seed=seed, alpha=0.6, data_filename=0, **params)
+        # the copy turns the columns mapped from shared memory into plain arrays
+        pd.testing.assert_frame_equal(result.copy(deep=True), expected.drop(columns=['Position']), check_like=True)
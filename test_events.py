@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+import numpy as np
+from model import micromodel
+from events import ManeuverLog, load_events
+
+
+def _run(**params):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        agent_pos = micromodel(**dict(dict(duration=60, demand=[300], seed=4, data_filename=0), **params))
+    printed = dict(line.split(':', 1) for line in out.getvalue().splitlines() if line.startswith(('num_overtake:', 'avg_lat_dist:')))
+    return agent_pos, {k: float(v) for k, v in printed.items()}
+
+
+def test_episodes_of_a_run(tmp_path):
+    log = ManeuverLog()
+    agent_pos, printed = _run(event_log=log)
+    assert agent_pos.equals(_run()[0])  # logging does not change the run
+
+    events = log.to_dataframe()
+    assert len(events) > 0
+    assert (events['EndStep'] >= events['StartStep']).all()
+    assert set(events['Completed']) <= {0, 1}
+    # the lateral distances of the episodes add up to sum_lat_dist (avg_lat_dist * num_overtake)
+    assert np.isclose(events['LatDist'].astype(np.float64).sum(), printed['avg_lat_dist'] * printed['num_overtake'], rtol=1e-4)
+
+    log.save(str(tmp_path / 'events.npz'))
+    assert load_events(str(tmp_path / 'events.npz')).equals(events)
+
+    # the log is cleared when it is passed again
+    _run(event_log=log, duration=30)
+    assert len(log) < len(events)
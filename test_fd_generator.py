@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import pandas as pd
+from fd_generator import refine_levels, stationary_fd, _level_points
+
+
+def test_levels_are_added_where_the_curve_jumps():
+    summary = pd.DataFrame({'Demand_(/h)': [3000, 1000, 2000, 2050],
+                            'Density_(/m2)': [0.20, 0.02, 0.04, 0.10],
+                            'Flow_(/h/m)': [1400, 900, 1000, 1020]})
+    # 2000 -> 2050 jumps as well, but is closer than 2 * min_step
+    assert refine_levels(summary, resolution=0.15, min_step=50) == [2525.0]
+    assert refine_levels(summary, resolution=0.15, min_step=10) == [2025.0, 2525.0]
+
+
+def test_warmup_is_dropped():
+    q_k_v = _level_points((1500, 4, 240, 60, 30, [200, 250], {}))
+    assert len(q_k_v) > 0
+    assert (q_k_v['Time_(s)'] - 30 >= 60).all()
+    assert (q_k_v['Demand_(/h)'] == 1500).all() and (q_k_v['Seed'] == 4).all()
+
+
+def test_stationary_fd():
+    pytest.importorskip('statsmodels')
+    q_k_v = stationary_fd(levels=[500, 3000], duration=180, warmup=60, rounds=1, processes=0)
+    levels = q_k_v.attrs['levels']['Demand_(/h)'].tolist()
+    assert levels[0] == 500 and levels[-1] == 3000 and len(levels) <= 3
+    assert q_k_v['Density_(/m2)'].is_monotonic_increasing
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import time
+import pytest
+matplotlib = pytest.importorskip('matplotlib')
+matplotlib.use('Agg')
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from figures import FrameCache
+
+
+def decorate(ax, frame):
+    ax.set_xlim(0, 20)
+    ax.set_ylim(0, 1)
+
+
+def draw_frame(ax, frame):
+    decorate(ax, frame)
+    ax.axvline(frame, color='k')
+
+
+def _cache(**params):
+    fig = Figure(figsize=(4, 1), dpi=50)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes((0.1, 0.1, 0.8, 0.8))
+    return FrameCache(fig, ax, draw_frame, decorate, view=None, **params)
+
+
+def test_drawn_frames_are_shown_from_the_cache():
+    cache = _cache(prefetch=0)
+    assert not cache.show(0)
+    draw_frame(cache.ax, 0)
+    cache.fig.canvas.draw()  # stores the raster of the drawn frame
+    assert cache.show(0)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert np.array_equal(cache.rasters[cache.key(0)], cache._render(0))
+
+
+def test_prefetch_and_memory_cap():
+    cache = _cache(prefetch=3)
+    cache.prefetch(0, forwards=True)
+    deadline = time.time() + 10
+    while len(cache.rasters) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert set(cache.rasters) == {cache.key(k) for k in [1, 2, 3]}
+    cache.close()
+    assert cache._thread is None and len(cache.rasters) == 0 and cache.nbytes == 0
+
+    one_frame = cache._render(0).nbytes
+    cache = _cache(prefetch=3, max_mb=1.5 * one_frame / 1e6)
+    cache.prefetch(10, forwards=False)
+    deadline = time.time() + 10
+    while cache.key(7) not in cache.rasters and time.time() < deadline:
+        time.sleep(0.01)
+    assert list(cache.rasters) == [cache.key(7)]  # older frames dropped above the cap
+    assert cache.nbytes == one_frame
+    cache.close()
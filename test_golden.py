@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+from model import micromodel
+from golden import compare_trajectories, check_equivalence, write_golden
+
+SCENARIOS = {'base': {}, 'narrow_path': {'path_width': 1.5}}
+PARAMS = {'duration': 60, 'demand': [60], 'seed': 4}
+
+
+def test_first_divergence_is_reported():
+    with contextlib.redirect_stdout(io.StringIO()):
+        reference = micromodel(data_filename=0, **PARAMS).drop(columns=['Position'])
+    assert compare_trajectories(reference, reference.copy()) is None
+
+    candidate = reference.copy()
+    rows = candidate.index[candidate['Step'] >= 50]
+    candidate.loc[rows[3:], 'Speed'] += 0.01
+    divergence = compare_trajectories(reference, candidate)
+    assert (divergence['step'], divergence['agent']) == (candidate.loc[rows[3], 'Step'], candidate.loc[rows[3], 'AgentID'])
+    assert list(divergence['columns']) == ['Speed'] and divergence['missing_in'] is None
+    assert divergence['diverging_rows'] == len(rows) - 3
+
+    divergence = compare_trajectories(reference, reference.drop(index=rows[0]))
+    assert divergence['missing_in'] == 'candidate' and divergence['step'] == reference.loc[rows[0], 'Step']
+
+
+def test_check_against_golden_files(tmp_path):
+    with contextlib.redirect_stdout(io.StringIO()):
+        write_golden(str(tmp_path), scenarios=SCENARIOS, base_params=PARAMS)
+    reports = check_equivalence(golden=str(tmp_path), scenarios=SCENARIOS, base_params=PARAMS)
+    assert all(r['equivalent'] for r in reports.values())
+
+    slower = lambda **params: micromodel(**dict(params, v0_mean=5.0))
+    reports = check_equivalence(slower, golden=str(tmp_path), scenarios=SCENARIOS, base_params=PARAMS)
+    assert not any(r['equivalent'] for r in reports.values())
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from import_budget import check_import_budget, measure_import
+
+
+def test_simulation_path_loads_no_heavy_modules():
+    # the time budget depends on the machine, only the heavy modules are checked here
+    report = check_import_budget(budget=60)
+    assert all(r['heavy'] == [] for r in report.values())
+
+
+def test_heavy_imports_are_reported():
+    pytest.importorskip('matplotlib')
+    assert 'matplotlib' in measure_import('figures')['heavy']
+    with pytest.raises(RuntimeError, match='figures'):
+        check_import_budget(modules=['figures'], budget=60)
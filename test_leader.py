@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+from model import micromodel
+
+
+def _run(full_search):
+    with contextlib.redirect_stdout(io.StringIO()):
+        with micromodel(duration=60, demand=[300], seed=4, data_filename=0, stream=True) as stream:
+            for snapshot in stream:
+                if full_search and snapshot.n_agents > 0:
+                    # Bicycle is defined per run: switch off the shortcut before the first cyclist has a leader
+                    type(stream.model.schedule.agents[0]).keepLeader = lambda self, leader, obstructing: False
+    return stream.result
+
+
+def test_kept_leader_gives_the_full_search_result():
+    agent_pos = _run(full_search=False)
+    assert 0 < agent_pos.attrs['leader_hit_rate'] <= 1
+    reference = _run(full_search=True)
+    assert reference.attrs['leader_hit_rate'] == 0
+    assert agent_pos.equals(reference)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import socket
+import contextlib
+import urllib.error
+import urllib.request
+import pytest
+from model import micromodel
+from live_metrics import LiveMetrics
+
+PORT = 8797
+
+
+def _port_free():
+    with socket.socket() as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # connections of the run may be in TIME_WAIT
+        try:
+            s.bind(('127.0.0.1', PORT))
+        except OSError:
+            return False
+    return True
+
+
+def test_server_runs_with_the_run_and_stops_it_on_post():
+    live = LiveMetrics(port=PORT, every=10)
+    assert _port_free()  # nothing listens before the run
+    with contextlib.redirect_stdout(io.StringIO()):
+        stream = micromodel(duration=60, demand=[300], seed=4, data_filename=0, recording='none',
+                            monitors=[live], stop_criteria=[live.remote_stop], stream=True)
+        for snapshot in stream:
+            if snapshot.step == 20:
+                metrics = json.load(urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(PORT)))
+                assert metrics['step'] == 20
+                with pytest.raises(urllib.error.HTTPError) as error:
+                    urllib.request.urlopen('http://127.0.0.1:{}/stop'.format(PORT))
+                assert error.value.code == 405
+                urllib.request.urlopen(urllib.request.Request('http://127.0.0.1:{}/stop'.format(PORT), data=b'', method='POST'))
+    assert stream.result.attrs['steps'] == 21
+    assert 'live metrics endpoint' in stream.result.attrs['stop_reason']
+    assert _port_free()  # released when the run ended
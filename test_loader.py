@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+import pandas as pd
+from model import micromodel
+from loader import iter_agent_pos
+
+
+def _run(**params):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return micromodel(**dict(dict(duration=60, demand=[300], seed=4, data_filename=0), **params))
+
+
+def test_chunks_of_a_saved_run(tmp_path):
+    agent_pos = _run()
+    path = str(tmp_path / 'run.csv')
+    agent_pos.to_csv(path, sep=';')
+
+    chunks = list(iter_agent_pos(path, chunksize=500))
+    assert len(chunks) > 1
+    loaded = pd.concat(chunks, ignore_index=True)
+    assert loaded['Step'].tolist() == agent_pos['Step'].tolist()
+    assert (loaded['Position_x'] - agent_pos['Position_x']).abs().max() < 1e-9
+
+    # older files without Position_x and Position_y: the coordinates come from the Position column
+    agent_pos.drop(columns=['Position_x', 'Position_y']).to_csv(path, sep=';')
+    steps = [100, 200]
+    chunks = list(iter_agent_pos(path, chunksize=500, columns=['Step', 'AgentID', 'Position_x'], step_range=steps))
+    loaded = pd.concat(chunks, ignore_index=True)
+    expected = agent_pos[agent_pos['Step'].between(*steps)]
+    assert list(loaded.columns) == ['Step', 'AgentID', 'Position_x']
+    assert loaded['AgentID'].tolist() == expected['AgentID'].tolist()
+    assert (loaded['Position_x'].to_numpy() - expected['Position_x'].to_numpy()).max() < 1e-9
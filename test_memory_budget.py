@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import contextlib
+from model import micromodel
+from memory_budget import MemoryBudget, process_memory_mb
+
+
+def _run(**params):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return micromodel(**dict(dict(duration=60, demand=[300], seed=4, data_filename=0), **params))
+
+
+def _limit():
+    # budget that a run reaches halfway through: the memory of the process before the run plus half of the
+    # components at the end of a reference run
+    budget = MemoryBudget(limit_mb=1e9, every=1)
+    reference = _run(stop_criteria=[budget])
+    return reference, process_memory_mb() + (budget.used_mb(budget.report) - budget.baseline_mb) / 2
+
+
+def test_spill_keeps_the_run(tmp_path):
+    reference, limit = _limit()
+    budget = MemoryBudget(limit_mb=limit, threshold=1, every=10, spill_dir=str(tmp_path))
+    agent_pos = _run(stop_criteria=[budget])
+    assert budget.spills > 0
+    assert agent_pos.drop(columns=['Position']).equals(reference.drop(columns=['Position']))
+    assert os.listdir(str(tmp_path)) == []  # spilled files are removed once read
+
+
+def test_abort_returns_the_rows_so_far():
+    reference, limit = _limit()
+    agent_pos = _run(stop_criteria=[MemoryBudget(limit_mb=limit, action='abort', threshold=1, every=10)])
+    assert agent_pos.attrs['stop_reason'].startswith('memory budget of')
+    assert 0 < agent_pos['Step'].max() < reference['Step'].max()
+    assert agent_pos.drop(columns=['Position']).equals(reference[reference['Step'] <= agent_pos['Step'].max()].drop(columns=['Position']))
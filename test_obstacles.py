@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+from model import micromodel
+from golden import off_path
+from obstacles import LateralProfile
+
+
+def test_bottleneck_run_stays_on_path():
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent_pos = micromodel(duration=100, demand=[300], seed=4, bottleneck_width=1.0, data_filename=0)
+    assert agent_pos['Position_x'].max() > 260  # cyclists passed the bottleneck (x = 250 to 254 m)
+    assert off_path(agent_pos) == 0
+
+
+def test_queries_of_a_rectangle():
+    profile = LateralProfile().add_rectangle(100, 102, 1.5, 3)
+    assert profile.available(101, 0.5, 2.5) == [[0.5, 1.5]]
+    assert profile.available(90, 0.5, 2.5) == [[0.5, 2.5]]
+
+    # a cyclist riding into the obstacle stops in front of it, one riding next to it passes
+    x, y = profile.clamp((95, 2.0), (99.5, 2.0), length=2, width=0.8)
+    assert 95 <= x < 99 and y == 2.0
+    assert profile.clamp((95, 1.0), (99.5, 1.0), length=2, width=0.8) == (99.5, 1.0)
+
+    assert [round(b.x, 6) for b in profile.leaders(95, 110, 2.0, 0.8)] == [100]
+    assert profile.leaders(95, 110, 1.0, 0.8) == []
+    assert len(profile.leaders(95, 110, 1.0, 0.8, des_y=2.0, speed=5, lat_speed=0.3)) == 1
+
+
+def test_cyclists_pass_a_rectangle_on_the_right():
+    profile = LateralProfile().add_rectangle(100, 102, 1.5, 3)
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent_pos = micromodel(duration=120, demand=[40], seed=4, obstacles=profile, data_filename=0)
+    assert agent_pos['Position_x'].max() > 150
+    alongside = agent_pos[(agent_pos['Position_x'] + 1 > 100) & (agent_pos['Position_x'] - 1 < 102)]
+    assert len(alongside) > 0
+    assert (alongside['Position_y'] + 0.4 <= 1.5 + 1e-6).all()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+import numpy as np
+from model import micromodel
+from paired import paired_comparison, METRICS
+
+
+def _cyclists(**params):
+    # first step and desired speed of every cyclist
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent_pos = micromodel(**dict(dict(duration=60, demand=[40], seed=4, data_filename=0, common_random_numbers=True), **params))
+    return agent_pos.groupby('AgentID').agg(first=('Step', 'min'), desSpeed=('desSpeed', 'first'))
+
+
+def test_common_random_numbers():
+    base = _cyclists()
+    wider = _cyclists(v0_sd=1.5, alpha=0.6)
+    assert base['first'].equals(wider['first'])  # same arrivals
+    # the draws of every cyclist are kept: a faster cyclist stays faster
+    assert (np.argsort(base['desSpeed'].to_numpy()) == np.argsort(wider['desSpeed'].to_numpy())).all()
+    assert not np.allclose(base['desSpeed'], wider['desSpeed'])
+
+
+def test_unchanged_variant_has_no_difference():
+    report = paired_comparison(variants={'same': {'alpha': 0.8}, 'slower': {'v0_mean': 4.5}}, seeds=[1, 2],
+                               duration=120, demand=[40])
+    assert (report.loc['same', 'difference'] == 0).all()
+    assert report.loc['slower', 'travel_time']['difference'] > 0
+    assert len(report.attrs['metrics']) == 6 and set(METRICS) <= set(report.attrs['metrics'].columns)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+import pandas as pd
+from model import micromodel
+
+
+def _run(**params):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return micromodel(**dict(dict(duration=100, demand=[300], seed=4, data_filename=0), **params))
+
+
+def test_threaded_decisions_equal_serial():
+    serial = _run(threads=0)
+    threaded = _run(threads=3)
+    last_step = serial.groupby('AgentID')['Step'].max()
+    assert (last_step < serial['Step'].max()).any()  # cyclists left the path during the run
+    pd.testing.assert_frame_equal(threaded, serial)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+from pipeline import Pipeline, simulate
+from detectors import LoopDetector
+
+
+def test_records_of_pooled_stage_are_cached(tmp_path):
+    params = {'duration': 60, 'demand': [300], 'seed': 4, 'recording': 'none', 'detectors': [LoopDetector(x=100)]}
+    p = Pipeline(cache_dir=str(tmp_path), processes=1)
+    p.add('run', simulate, params=params)
+    assert p.run() == {'run': 'run'}
+    passages = p.records('run')['detectors'][0].passages()
+    assert len(passages) > 0
+
+    # a new pipeline on the same cache skips the run and still has the records
+    p = Pipeline(cache_dir=str(tmp_path), processes=1)
+    p.add('run', simulate, params=dict(params, detectors=[LoopDetector(x=100)]))
+    assert p.run() == {'run': 'cached'}
+    assert p.records('run')['detectors'][0].passages().equals(passages)
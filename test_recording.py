@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+import pytest
+from model import micromodel
+from trajectory_store import write_store
+
+
+def _run(**params):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return micromodel(**dict(dict(duration=30, demand=[300], seed=4, data_filename=0), **params))
+
+
+def test_compact_output_needs_positions(tmp_path):
+    with pytest.raises(ValueError, match="'Position'"):
+        _run(recording='none', compact_output=True)
+    with pytest.raises(ValueError, match="position columns"):
+        write_store(_run(recording={'fields': ['Speed']}), str(tmp_path / 'store'))
+    traj = _run(recording='space_time', compact_output='delta')
+    assert len(traj.step) > 0
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+import pandas as pd
+from model import micromodel
+from safety import SafetyMonitor
+
+
+def _run(**params):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return micromodel(**dict(dict(duration=100, demand=[300], seed=4, data_filename=0), **params))
+
+
+def test_safety_monitor_observes_without_changing_the_run():
+    safety = SafetyMonitor()
+    agent_pos = _run(monitors=[safety])
+    pd.testing.assert_frame_equal(agent_pos, _run())
+    assert agent_pos.attrs['stop_reason'] is None
+    assert safety.counts['TTC'].sum() > 0
+    encroachments = safety.encroachment_table()
+    assert list(encroachments.columns) == ['Time', 'Follower', 'Leader', 'Gap', 'Headway']
+    assert (encroachments['Headway'] >= 0).all()
+
+    # a reused monitor starts from scratch
+    first = safety.conflict_table()
+    _run(monitors=[safety])
+    pd.testing.assert_frame_equal(safety.conflict_table(), first)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pandas as pd
+from shared_results import share_dataframe, SharedResult
+
+
+def test_round_trip_through_shared_memory(tmp_path):
+    agent_pos = pd.DataFrame({'Step': np.arange(5, dtype=np.int64), 'Speed': np.linspace(0, 1, 5), 'Flag': np.array([1, 0, 1, 1, 0], dtype=np.int8),
+                              'Position': [[x, 1.0] for x in range(5)]})
+    agent_pos.attrs['stop_reason'] = 'duration'
+    handle = share_dataframe(agent_pos, directory=str(tmp_path))
+    assert os.path.exists(handle['path'])
+
+    shared = SharedResult(handle)
+    result = shared.to_dataframe()
+    assert not os.path.exists(handle['path'])  # removed once mapped
+    assert result.attrs == {'stop_reason': 'duration'}
+    pd.testing.assert_frame_equal(result.copy(deep=True), agent_pos.drop(columns=['Position']))
+    speed = shared.arrays()['Speed']
+    speed[0] = 5  # copy-on-write mapping
+    assert speed[0] == 5
+
+
+def test_empty_and_indexed_frames(tmp_path):
+    empty = SharedResult(share_dataframe(pd.DataFrame({'Step': np.zeros(0, dtype=np.int64)}), directory=str(tmp_path))).to_dataframe()
+    assert len(empty) == 0 and list(empty.columns) == ['Step']
+    indexed = pd.DataFrame({'Speed': [1.0, 2.0]}, index=[10, 20])
+    result = SharedResult(share_dataframe(indexed, directory=str(tmp_path))).to_dataframe()
+    pd.testing.assert_frame_equal(result.copy(deep=True), indexed)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+import numpy as np
+from model import micromodel
+
+
+def _run(**params):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return micromodel(**dict(dict(duration=60, demand=[300], seed=4, data_filename=0), **params))
+
+
+class Closed:
+    # monitor that only records whether the run released it
+    closed = False
+
+    def update(self, model, dt):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_snapshots_and_result():
+    reference = _run()
+    stream = _run(stream=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        snapshots = [snapshot.copy() for snapshot in stream]
+    assert [s.step for s in snapshots] == list(range(1, 121))
+    assert stream.result.equals(reference)
+
+    snapshot = snapshots[50]
+    rows = reference[reference['Step'] == snapshot.step]
+    assert np.array_equal(snapshot.agent_id, rows['AgentID'])
+    assert np.allclose(snapshot.x, rows['Position_x']) and np.allclose(snapshot.speed, rows['Speed'])
+
+
+def test_request_stop_and_break():
+    with contextlib.redirect_stdout(io.StringIO()):
+        stream = _run(stream=True)
+        for snapshot in stream:
+            if snapshot.step == 30:
+                snapshot.request_stop("enough")
+    assert stream.result.attrs['stop_reason'] == "enough"
+    assert stream.result['Step'].max() == 30
+
+    monitor = Closed()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with _run(stream=True, monitors=[monitor]) as stream:
+            for snapshot in stream:
+                if snapshot.step == 10:
+                    break
+    assert monitor.closed and stream.result is None
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import io
+import contextlib
+import numpy as np
+from model import micromodel
+from trajectory import CompactTrajectory
+
+
+def _run(**params):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return micromodel(**dict(dict(duration=60, demand=[300], seed=4, data_filename=0), **params))
+
+
+def test_compact_round_trip():
+    agent_pos = _run()
+    for delta_x in [False, True]:
+        traj = CompactTrajectory.from_agent_pos(agent_pos, delta_x=delta_x)
+        assert traj.nbytes < agent_pos.drop(columns=['Position']).memory_usage(deep=True).sum() / 2
+        back = traj.to_agent_pos()
+        assert (back['Step'].to_numpy() == agent_pos['Step'].to_numpy()).all()
+        assert (back['AgentID'].to_numpy() == agent_pos['AgentID'].to_numpy()).all()
+        np.testing.assert_allclose(back['Position_x'], agent_pos['Position_x'], atol=0.001 if delta_x else 1e-4)
+        for c in ['Position_y', 'Speed', 'latSpeed', 'desSpeed', 'crLength']:
+            np.testing.assert_allclose(back[c], agent_pos[c], rtol=1e-6, atol=1e-6)
+
+
+def test_compact_output_of_micromodel():
+    traj = _run(compact_output='delta')
+    expected = CompactTrajectory.from_agent_pos(_run(), delta_x=True)
+    assert (traj.step == expected.step).all()
+    assert (traj.x_delta == expected.x_delta).all()
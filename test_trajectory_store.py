@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import io
+import pickle
+import contextlib
+import numpy as np
+from model import micromodel
+from trajectory_store import write_store
+
+
+def _run(**params):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return micromodel(**dict(dict(duration=60, demand=[300], seed=4, data_filename=0), **params))
+
+
+def test_store_frames_and_paths(tmp_path):
+    agent_pos = _run()
+    store = write_store(agent_pos, str(tmp_path / 'store'))
+    assert len(store) == len(agent_pos)
+
+    step = int(agent_pos['Step'].iloc[len(agent_pos) // 2])
+    expected = agent_pos[agent_pos['Step'] == step]
+    frame = store.frame(step)
+    assert frame['AgentID'].tolist() == expected['AgentID'].tolist()
+    np.testing.assert_allclose(frame['Position_x'], expected['Position_x'], rtol=1e-6)
+
+    agent_id = agent_pos['AgentID'].iloc[-1]
+    expected = agent_pos[agent_pos['AgentID'] == agent_id]
+    path = pickle.loads(pickle.dumps(store)).agent_path(agent_id)
+    assert path['Step'].tolist() == expected['Step'].tolist()
+    np.testing.assert_allclose(path['Speed'], expected['Speed'], rtol=1e-6)
+
+    chunks = list(store.iter_chunks(chunk_steps=100))
+    assert sum(len(c) for c in chunks) == len(agent_pos)
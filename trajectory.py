@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+*****************************************
+*** COMPACT TRAJECTORY REPRESENTATION ***
+*****************************************
+'''
+#%%
+import numpy as np
+import pandas as pd
+#%%
+
+# columns of the agent_pos data frame that vary from step to step (stored as float32)
+KINEMATIC_COLUMNS = ['Position_x', 'Position_y', 'Speed', 'latSpeed', 'srLength', 'srWidth', 'crLength']
+
+
+class CompactTrajectory:
+    '''
+    Columnar trajectory of a simulation run with narrow dtypes.
+
+    Rows are stored agent-major (all steps of the first agent, then the next agent, ...),
+    step and id as int32 and the kinematics as float32. Attributes that do not change
+    during the trip (desired speed, bicycle dimensions) are kept once per agent in the
+    static table `agents`. Optionally, Position_x is delta encoded: x is quantized to
+    `x_resolution` metres and only the (non-negative) increments are stored as uint16.
+    '''
+
+    def __init__(self, step, agent_id, columns, agents, x_delta=None, x_resolution=None):
+        self.step = step  # int32 simulation step of each row
+        self.agent_id = agent_id  # int32 agent id of each row (virtual agents get negative ids)
+        self.columns = columns  # dict of float32 arrays, one per kinematic column
+        self.agents = agents  # static table indexed by agent id, in order of first appearance
+        self.x_delta = x_delta  # uint16 increments of the quantized x position (None if not delta encoded)
+        self.x_resolution = x_resolution  # quantization step of x for the delta encoding (m)
+
+    @classmethod
+    def from_agent_pos(cls, agent_pos,  # data frame as returned by micromodel
+                       b_length = 2,  # bicycle length (m), stored in the static table
+                       b_width = 0.8,  # bicycle width (m), stored in the static table
+                       delta_x = False,  # delta encode the longitudinal position
+                       x_resolution = 0.001):  # quantization step of x when delta encoded (m)
+
+        # map agent ids to int32 (string ids of virtual agents become negative numbers)
+        rank_of_row, labels = pd.factorize(agent_pos['AgentID'])  # agents numbered in order of first appearance
+        codes = []
+        n_virtual = 0
+        for label in labels:
+            if isinstance(label, str):
+                n_virtual += 1
+                codes.append(-n_virtual)
+            else:
+                codes.append(int(label))
+        agent_id = np.asarray(codes, dtype=np.int32)[rank_of_row]
+        step = agent_pos['Step'].to_numpy(dtype=np.int32)
+
+        # sort rows agent-major; agents keep the order of their first appearance
+        order = np.lexsort((step, rank_of_row))
+        step = step[order]
+        agent_id = agent_id[order]
+
+        if 'Position_x' in agent_pos.columns:
+            x = agent_pos['Position_x'].to_numpy(dtype=np.float64)[order]
+            y = agent_pos['Position_y'].to_numpy(dtype=np.float64)[order]
+        elif 'Position' not in agent_pos.columns:
+            raise ValueError("agent_pos has no position columns (recorded with a profile without 'Position', see recording.py); "
+                             "the compact format and the trajectory store need them")
+        else:
+            pos = np.array(agent_pos['Position'].tolist(), dtype=np.float64)
+            x, y = pos[order, 0], pos[order, 1]
+        columns = {'Position_x': x.astype(np.float32), 'Position_y': y.astype(np.float32)}
+        for c in KINEMATIC_COLUMNS[2:]:  # fields that were not recorded (see recording.py) are kept as NaN
+            columns[c] = agent_pos[c].to_numpy(dtype=np.float32)[order] if c in agent_pos.columns else np.full(len(order), np.nan, dtype=np.float32)
+
+        # static table, one row per agent
+        starts = np.flatnonzero(np.r_[True, agent_id[1:] != agent_id[:-1]]) if len(agent_id) else np.array([], dtype=np.int64)
+        agents = pd.DataFrame({'Label': list(labels),
+                               'desSpeed': agent_pos['desSpeed'].to_numpy(dtype=np.float32)[order][starts] if 'desSpeed' in agent_pos.columns else np.full(len(starts), np.nan, dtype=np.float32),
+                               'Length': np.full(len(starts), b_length, dtype=np.float32),
+                               'Width': np.full(len(starts), b_width, dtype=np.float32),
+                               'Start': starts.astype(np.int64),
+                               'Rows': np.diff(np.r_[starts, len(agent_id)]).astype(np.int64)},
+                              index=pd.Index(agent_id[starts], name='AgentID'))
+
+        trajectory = cls(step, agent_id, columns, agents)
+        if delta_x:
+            trajectory.encode_x(x, x_resolution)
+        return trajectory
+
+    '''
+    ***************************
+    *** DELTA ENCODING OF X ***
+    ***************************
+    '''
+
+    def encode_x(self, x, x_resolution = 0.001):
+        q = np.rint(np.asarray(x, dtype=np.float64) / x_resolution).astype(np.int64)
+        starts = self.agents['Start'].to_numpy()
+        delta = np.diff(q, prepend=0)
+        delta[starts] = 0
+        if len(delta) and (delta.min() < 0 or delta.max() > np.iinfo(np.uint16).max):
+            raise ValueError("Position_x is not monotonic per agent or moves more than {} m per step, cannot delta encode".format(np.iinfo(np.uint16).max * x_resolution))
+        self.agents['xStart'] = q[starts] if len(starts) else np.array([], dtype=np.int64)
+        self.x_delta = delta.astype(np.uint16)
+        self.x_resolution = x_resolution
+        del self.columns['Position_x']
+
+    def decode_x(self):
+        if self.x_delta is None:
+            return self.columns['Position_x'].astype(np.float64)
+        starts = self.agents['Start'].to_numpy()
+        segment = np.repeat(np.arange(len(starts)), self.agents['Rows'].to_numpy())
+        cs = np.cumsum(self.x_delta, dtype=np.int64)
+        q = cs - cs[starts][segment] + self.agents['xStart'].to_numpy()[segment]
+        return q * self.x_resolution
+
+    '''
+    ******************
+    *** CONVERSION ***
+    ******************
+    '''
+
+    def __len__(self):
+        return len(self.step)
+
+    @property
+    def nbytes(self):
+        n = self.step.nbytes + self.agent_id.nbytes + sum(c.nbytes for c in self.columns.values())
+        if self.x_delta is not None:
+            n += self.x_delta.nbytes
+        return n + int(self.agents.memory_usage(deep=True).sum())
+
+    def to_agent_pos(self, include_position = True):  # also rebuild the (redundant) Position column
+        row_agent = np.repeat(np.arange(len(self.agents)), self.agents['Rows'].to_numpy())
+        order = np.lexsort((row_agent, self.step))  # step-major, agents in order of appearance as in the DataCollector
+        labels = self.agents['Label'].to_numpy()[row_agent[order]]
+        if not any(isinstance(l, str) for l in self.agents['Label']):
+            labels = labels.astype(np.int64)
+        x = self.decode_x()[order]
+        y = self.columns['Position_y'][order].astype(np.float64)
+
+        agent_pos = pd.DataFrame({'Step': self.step[order].astype(np.int64), 'AgentID': labels})
+        if include_position:
+            agent_pos['Position'] = [[a, b] for a, b in zip(x.tolist(), y.tolist())]
+        agent_pos['Speed'] = self.columns['Speed'][order].astype(np.float64)
+        agent_pos['latSpeed'] = self.columns['latSpeed'][order].astype(np.float64)
+        agent_pos['ID'] = labels
+        agent_pos['desSpeed'] = self.agents['desSpeed'].to_numpy(dtype=np.float64)[row_agent[order]]
+        for c in ['srLength', 'srWidth', 'crLength']:
+            agent_pos[c] = self.columns[c][order].astype(np.float64)
+        agent_pos['Position_x'] = x
+        agent_pos['Position_y'] = y
+        return agent_pos
+
+    def agent_slice(self, agent_id):
+        # rows of one agent (contiguous because of the agent-major layout)
+        start, rows = self.agents.loc[agent_id, ['Start', 'Rows']]
+        return slice(int(start), int(start) + int(rows))
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+**************************************
+*** MEMORY-MAPPED TRAJECTORY STORE ***
+**************************************
+'''
+#%%
+import os
+import json
+import numpy as np
+import pandas as pd
+from trajectory import CompactTrajectory, KINEMATIC_COLUMNS
+#%%
+
+'''
+Layout of a store directory (all arrays are .npy files opened with mmap_mode='r'):
+    step.npy, agent.npy, <kinematic column>.npy   row data, sorted step-major (one frame after the other)
+    steps.npy, step_offsets.npy                   step index: rows of steps[k] are step_offsets[k]:step_offsets[k+1]
+    agent_ids.npy, agent_offsets.npy, agent_rows.npy
+                                                  agent index (CSR): rows of agent_ids[k] in step order are
+                                                  agent_rows[agent_offsets[k]:agent_offsets[k+1]]
+    agent_desSpeed.npy, agent_length.npy, agent_width.npy, meta.json
+                                                  static attributes per agent (in order of agent_ids)
+'''
+
+
+def write_store(trajectory,  # CompactTrajectory or data frame as returned by micromodel
+                path):  # directory of the store (created if it does not exist)
+
+    if not isinstance(trajectory, CompactTrajectory):
+        trajectory = CompactTrajectory.from_agent_pos(trajectory)
+    os.makedirs(path, exist_ok=True)
+
+    # step-major row order; within a step the agents keep their order of appearance
+    row_agent = np.repeat(np.arange(len(trajectory.agents)), trajectory.agents['Rows'].to_numpy())
+    order = np.lexsort((row_agent, trajectory.step))
+    step = trajectory.step[order]
+    np.save(os.path.join(path, 'step.npy'), step)
+    np.save(os.path.join(path, 'agent.npy'), row_agent[order].astype(np.int32))  # row in the static agent table
+    x = trajectory.decode_x().astype(np.float32)
+    for c in KINEMATIC_COLUMNS:
+        values = x if c == 'Position_x' else trajectory.columns[c]
+        np.save(os.path.join(path, c + '.npy'), values[order])
+
+    # step index
+    steps, step_starts = np.unique(step, return_index=True)
+    np.save(os.path.join(path, 'steps.npy'), steps.astype(np.int32))
+    np.save(os.path.join(path, 'step_offsets.npy'), np.r_[step_starts, len(step)].astype(np.int64))
+
+    # agent index: stable sort of the step-major rows by agent keeps every path in step order
+    agent_rows = np.argsort(row_agent[order], kind='stable')
+    np.save(os.path.join(path, 'agent_rows.npy'), agent_rows.astype(np.int64))
+    np.save(os.path.join(path, 'agent_offsets.npy'), np.r_[0, np.cumsum(trajectory.agents['Rows'].to_numpy())].astype(np.int64))
+    np.save(os.path.join(path, 'agent_ids.npy'), trajectory.agents.index.to_numpy(dtype=np.int32))
+    np.save(os.path.join(path, 'agent_desSpeed.npy'), trajectory.agents['desSpeed'].to_numpy(dtype=np.float32))
+    np.save(os.path.join(path, 'agent_length.npy'), trajectory.agents['Length'].to_numpy(dtype=np.float32))
+    np.save(os.path.join(path, 'agent_width.npy'), trajectory.agents['Width'].to_numpy(dtype=np.float32))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'rows': int(len(step)), 'labels': [l if isinstance(l, str) else int(l) for l in trajectory.agents['Label']]}, f)
+
+    return TrajectoryStore(path)
+
+
+class TrajectoryStore:
+    '''
+    Read-only, memory-mapped trajectory of a run written by write_store.
+
+    Frames (all agents of one step) and paths (all steps of one agent) are found through
+    the offset indexes, so reading either costs only the size of the slice. The files are
+    opened with mmap_mode='r', several processes can therefore share one store; pickling
+    a store only transfers its path.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        self.step = load('step')
+        self.agent = load('agent')
+        self.columns = {c: load(c) for c in KINEMATIC_COLUMNS}
+        self.steps = load('steps')
+        self.step_offsets = load('step_offsets')
+        self.agent_ids = load('agent_ids')
+        self.agent_offsets = load('agent_offsets')
+        self.agent_rows = load('agent_rows')
+        self.des_speed = load('agent_desSpeed')
+        self.length = load('agent_length')
+        self.width = load('agent_width')
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.labels = np.array(json.load(f)['labels'], dtype=object)
+        if not any(isinstance(l, str) for l in self.labels):
+            self.labels = self.labels.astype(np.int64)
+        self._agent_lookup = pd.Series(np.arange(len(self.agent_ids)), index=self.labels)
+
+    def __reduce__(self):
+        return (TrajectoryStore, (self.path,))
+
+    def __len__(self):
+        return len(self.step)
+
+    '''
+    ****************
+    *** INDEXING ***
+    ****************
+    '''
+
+    def step_rows(self, first_step, last_step = None):  # inclusive range of steps
+        if last_step is None:
+            last_step = first_step
+        lo = np.searchsorted(self.steps, first_step, side='left')
+        hi = np.searchsorted(self.steps, last_step, side='right')
+        return slice(int(self.step_offsets[lo]), int(self.step_offsets[hi]))
+
+    def agent_row_index(self, agent_id):
+        k = self._agent_lookup[agent_id]
+        return self.agent_rows[self.agent_offsets[k]:self.agent_offsets[k+1]]
+
+    def _rows_to_frame(self, rows):
+        # rows: slice (zero-copy views into the memory map) or array of row numbers
+        agent = np.asarray(self.agent[rows])
+        df = pd.DataFrame({'Step': np.asarray(self.step[rows], dtype=np.int64), 'AgentID': self.labels[agent]})
+        df['Speed'] = np.asarray(self.columns['Speed'][rows], dtype=np.float64)
+        df['latSpeed'] = np.asarray(self.columns['latSpeed'][rows], dtype=np.float64)
+        df['ID'] = df['AgentID']
+        df['desSpeed'] = self.des_speed[agent].astype(np.float64)
+        for c in ['srLength', 'srWidth', 'crLength', 'Position_x', 'Position_y']:
+            df[c] = np.asarray(self.columns[c][rows], dtype=np.float64)
+        return df
+
+    def frame(self, step):
+        # all agents of one simulation step, columns as in the agent_pos data frame
+        return self._rows_to_frame(self.step_rows(step))
+
+    def frames(self, first_step, last_step):
+        # all agents of an inclusive range of steps
+        return self._rows_to_frame(self.step_rows(first_step, last_step))
+
+    def agent_path(self, agent_id):
+        # trajectory of one cyclist in step order
+        return self._rows_to_frame(self.agent_row_index(agent_id))
+
+    def iter_chunks(self, chunk_steps = 1000):  # number of steps per chunk
+        # consecutive step ranges, for the chunked analysis functions
+        for k in range(0, len(self.steps), chunk_steps):
+            last = min(k + chunk_steps, len(self.steps)) - 1
+            yield self.frames(self.steps[k], self.steps[last])
+
+    def to_agent_pos(self):
+        # load the whole run into memory (without the redundant Position column)
+        return self._rows_to_frame(slice(0, len(self)))